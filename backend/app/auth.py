@@ -1,45 +1,87 @@
+import hashlib
+import hmac
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from typing import Annotated
 
 import jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jwt.exceptions import InvalidTokenError
-from pwdlib import PasswordHash
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from . import crud, database, models, schemas
+from . import crud, database, models, replicas, schemas
+from .hashing import password_hasher
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = float(
     os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 60 * 24 * 7)
 )  # minutes
+REFRESH_TOKEN_EXPIRE_DAYS = float(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 30))
 
-password_hash = PasswordHash.recommended()
+# Verified tokens are kept at most this long, so changes made by another
+# tracker process (e.g. a deleted user) are picked up eventually
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", 300))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", 10000))
+
+# Bearer token of /stats and /metrics. Unset, they only answer requests made
+# from this host without going through a proxy
+MONITORING_TOKEN = os.getenv("MONITORING_TOKEN")
+LOCAL_HOSTS = {"127.0.0.1", "::1"}
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+def verify_monitoring_access(request: Request) -> None:
+    """Dependency of the routes exposing the tracker's internals"""
+    if MONITORING_TOKEN:
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and hmac.compare_digest(
+            token.encode(), MONITORING_TOKEN.encode()
+        ):
+            return
+    elif (
+        request.client is not None
+        and request.client.host in LOCAL_HOSTS
+        and "x-forwarded-for" not in request.headers
+    ):
+        return
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+
+
+# Argon2 is CPU bound on purpose, it runs in the password hashing processes
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a plain password against the hashed password"""
-    return password_hash.verify(plain_password, hashed_password)
+    return await password_hasher.verify(plain_password, hashed_password)
 
 
-def get_password_hash(password: str) -> str:
+async def get_password_hash(password: str) -> str:
     """Hash a plain password"""
-    return password_hash.hash(password)
+    return await password_hasher.hash(password)
+
 
+async def get_user(db: AsyncSession, username: str) -> models.User | None:
+    """Look a user up, on the primary when a replica doesn't know it yet"""
+    user = await crud.get_user_by_username(db, username)
+    if user is None and replicas.is_replica(db):
+        # Signed up moments ago and not replicated yet
+        async with database.SessionLocal() as primary:
+            user = await crud.get_user_by_username(primary, username)
+    return user
 
-def authenticate_user(
+
+async def authenticate_user(
     username: str,
     password: str,
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(replicas.get_read_db),
 ) -> models.User:
     """Authenticate user by username and password"""
-    user = crud.get_user_by_username(db, username)
-    if not user or not verify_password(password, user.password_hash):
+    user = await get_user(db, username)
+    if not user or not await verify_password(password, user.password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -59,11 +101,117 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None) -> s
     return encoded_jwt
 
 
+def create_refresh_token(username: str) -> str:
+    """Create a long lived token that can only be exchanged for access tokens"""
+    return create_access_token(
+        {"sub": username, "type": "refresh"},
+        timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    )
+
+
+def create_token_pair(username: str) -> dict:
+    """Access and refresh token returned by signup, login and refresh"""
+    return {
+        "access_token": create_access_token({"sub": username}),
+        "refresh_token": create_refresh_token(username),
+        "token_type": "bearer",
+    }
+
+
+async def refresh_user(refresh_token: str, db: AsyncSession) -> models.User:
+    """Resolve the user of a refresh token, no password check involved"""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+    except InvalidTokenError:
+        raise credentials_exception
+    username = payload.get("sub")
+    if payload.get("type") != "refresh" or username is None:
+        raise credentials_exception
+    # Checked every time, so deleted users can't keep refreshing
+    user = await get_user(db, username)
+    if user is None:
+        raise credentials_exception
+    return user
+
+
+class TokenCache:
+    """Bounded cache of verified tokens and the user they resolve to.
+
+    Keyed by the token's SHA-256 so raw tokens are not kept in memory, each
+    entry lives until the token expires (capped by AUTH_CACHE_TTL_SECONDS).
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[bytes, tuple[schemas.CurrentUser, float]] = (
+            OrderedDict()
+        )
+        self._by_user: dict[int, set[bytes]] = {}
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> schemas.CurrentUser | None:
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at <= time.time():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def put(self, token: str, user: schemas.CurrentUser, expires_at: float) -> None:
+        if self.max_entries <= 0:
+            return
+        key = self._key(token)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (user, min(expires_at, time.time() + self.ttl_seconds))
+            self._by_user.setdefault(user.user_id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Forget every token of a user, e.g. when the user is deleted"""
+        with self._lock:
+            for key in list(self._by_user.get(user_id, ())):
+                self._drop(key)
+
+    def _drop(self, key: bytes) -> None:
+        user, _ = self._entries.pop(key)
+        keys = self._by_user.get(user.user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[user.user_id]
+
+
+token_cache = TokenCache(AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL_SECONDS)
+
+
 async def get_current_user(
     token: Annotated[str, Depends(oauth2_scheme)],
-    db: Session = Depends(database.get_db),
-) -> models.User:
+    db: AsyncSession = Depends(replicas.get_read_db),
+) -> schemas.CurrentUser:
     """Get the current user from the JWT token"""
+    # Tokens seen before are already verified, skip decoding and the DB
+    cached_user = token_cache.get(token)
+    if cached_user is not None:
+        return cached_user
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -73,7 +221,8 @@ async def get_current_user(
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username = payload.get("sub")
-        if username is None:
+        # Refresh tokens are only good for /token/refresh
+        if username is None or payload.get("type", "access") != "access":
             raise credentials_exception
         token_data = schemas.TokenData(username=username)
     except InvalidTokenError:
@@ -83,15 +232,21 @@ async def get_current_user(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid Authentication token",
         )
-    user = crud.get_user_by_username(db, token_data.username)
+    user = await get_user(db, token_data.username)
     if user is None:
         raise credentials_exception
-    return user
+
+    current_user = schemas.CurrentUser(
+        user_id=user.user_id, username=user.username, email=user.email
+    )
+    if "exp" in payload:
+        token_cache.put(token, current_user, float(payload["exp"]))
+    return current_user
 
 
 async def get_current_active_user(
-    current_user: Annotated[models.User, Depends(get_current_user)],
-) -> models.User:
+    current_user: Annotated[schemas.CurrentUser, Depends(get_current_user)],
+) -> schemas.CurrentUser:
     """Get the current active user"""
     # if current_user.disabled:
     #     raise HTTPException(status_code=400, detail="Inactive user")
@@ -1,148 +1,1007 @@
 from datetime import datetime, timedelta, timezone
-from typing import cast
+from typing import AsyncIterable, AsyncIterator, Callable, List, cast
 
-from sqlalchemy import delete, select, update
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import (
+    DOUBLE_PRECISION,
+    REAL,
+    BigInteger,
+    Boolean,
+    Row,
+    and_,
+    column,
+    delete,
+    exists,
+    false,
+    func,
+    literal,
+    or_,
+    select,
+    table,
+    text,
+    true,
+    tuple_,
+    union_all,
+    update,
+)
+from sqlalchemy import cast as cast_
+from sqlalchemy.dialects.postgresql import JSON, TSQUERY, insert
 from sqlalchemy.engine import CursorResult
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from sqlalchemy.orm import aliased
 
-from . import models, schemas
+from . import leases, metrics, models, schemas, search_index, utils
 
 
-def get_user_by_username(db: Session, username: str) -> models.User:
+@metrics.timed
+async def get_user_by_username(db: AsyncSession, username: str) -> models.User:
     """Get user by username"""
-    return db.scalar(select(models.User).where(models.User.username == username))
+    return await db.scalar(select(models.User).where(models.User.username == username))
 
 
-def get_user_by_email(db: Session, email: str) -> models.User:
+@metrics.timed
+async def get_user_by_email(db: AsyncSession, email: str) -> models.User:
     """Get user by email"""
-    return db.scalar(select(models.User).where(models.User.email == email))
+    return await db.scalar(select(models.User).where(models.User.email == email))
 
 
-def get_user(db: Session, user_id: int) -> models.User:
+@metrics.timed
+async def get_user(db: AsyncSession, user_id: int) -> models.User:
     """Get user by user_id"""
-    return db.scalar(select(models.User).where(models.User.user_id == user_id))
+    return await db.scalar(select(models.User).where(models.User.user_id == user_id))
 
 
-def create_user(db: Session, user: schemas.UserCreate) -> models.User:
+@metrics.timed
+async def create_user(db: AsyncSession, user: schemas.UserCreate) -> models.User:
     """Create a new user"""
     db_user = models.User(
         username=user.username, password_hash=user.password_hash, email=user.email
     )
 
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 
-def upsert_file_announcement(
-    db: Session, payload: schemas.FileAnnounce, client_ip: str
-) -> int:
-    """Handles adding files and updating active peer status"""
+@metrics.timed
+async def delete_user(db: AsyncSession, user_id: int) -> bool:
+    """Delete a user, their sessions go away with them (ON DELETE CASCADE)"""
+    result = cast(
+        CursorResult,
+        await db.execute(delete(models.User).where(models.User.user_id == user_id)),
+    )
+    await db.commit()
+    return result.rowcount > 0
+
 
-    # First, cleanup existing entries for this specific client instance
-    # This ensures we don't have stale files if the folder changed
-    cleanup_stmt = delete(models.ActivePeer).where(
-        models.ActivePeer.user_id == payload.user_id,
-        models.ActivePeer.ip_address == client_ip,
-        models.ActivePeer.port == payload.port,
+async def _upsert_session(
+    db: AsyncSession | AsyncConnection,
+    user_id: int,
+    client_ip: str,
+    port: int,
+    public_url: str | None,
+    version: int,
+    public_ip: str | None = None,
+) -> int:
+    """Create or refresh the session of a client instance, returns its id"""
+    now = datetime.now(timezone.utc)
+    stmt = insert(models.PeerSession).values(
+        user_id=user_id,
+        ip_address=client_ip,
+        port=port,
+        public_url=public_url,
+        public_ip=public_ip,
+        library_version=version,
+        last_heartbeat=now,
     )
-    db.execute(cleanup_stmt)
+    refreshed = {
+        "public_url": public_url,
+        "public_ip": public_ip,
+        "library_version": version,
+    }
+    changed = None
+    if leases.enabled():
+        # The lease renews the session, the row is only rewritten when one
+        # of its other columns changed
+        changed = or_(
+            *(
+                getattr(models.PeerSession, name).is_distinct_from(value)
+                for name, value in refreshed.items()
+            )
+        )
+    else:
+        refreshed["last_heartbeat"] = now
+    stmt = stmt.on_conflict_do_update(
+        constraint="peer_sessions_client_key", set_=refreshed, where=changed
+    ).returning(models.PeerSession.session_id)
+    session_id = (await db.execute(stmt)).scalar_one_or_none()
+    if session_id is None:
+        # Unchanged, the conflicting row is still locked by the insert
+        session_id = await db.scalar(
+            select(models.PeerSession.session_id).where(
+                models.PeerSession.user_id == user_id,
+                models.PeerSession.ip_address == client_ip,
+                models.PeerSession.port == port,
+            )
+        )
+    await _touch_lease(db, session_id)
+    return session_id
+
+
+async def _touch_lease(db: AsyncSession | AsyncConnection, session_id: int) -> None:
+    """Record a session in the current lease bucket, if leases are partitioned"""
+    if leases.enabled():
+        await db.execute(
+            insert(models.SessionLease)
+            .values(session_id=session_id, bucket=leases.current_bucket())
+            .on_conflict_do_nothing()
+        )
 
-    if not payload.files:
-        db.commit()
-        return 0
 
-    # Prepare data for bulk insert
+# asyncpg allows at most 32767 bind parameters per statement, bulk writes
+# are split into statements of this many rows
+BULK_CHUNK_SIZE = 5000
+
+
+def _chunks(items: list, size: int = BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+async def _add_session_files(
+    db: AsyncSession, session_id: int, files: list[schemas.FileBase]
+) -> None:
+    """Insert the given files and map them to the session"""
+    if not files:
+        return
+
+    # Prepare data for bulk insert. Rows are locked in hash order, so
+    # concurrent announces sharing files can't deadlock on each other
     file_values = [
         {
             "file_hash": file.file_hash,
             "file_name": file.file_name,
             "file_size": file.file_size,
         }
-        for file in payload.files
+        for file in sorted(files, key=lambda f: f.file_hash)
     ]
 
-    peer_values = [
-        {
-            "user_id": payload.user_id,
-            "file_hash": file.file_hash,
-            "ip_address": client_ip,
-            "port": payload.port,
-            "public_url": payload.public_url,
-            "last_heartbeat": datetime.now(timezone.utc),
-        }
-        for file in payload.files
+    mapping_values = [
+        {"session_id": session_id, "file_hash": file.file_hash} for file in files
     ]
 
     # bulk upsert Files
-    file_stmt = (
-        insert(models.File)
-        .values(file_values)
-        .on_conflict_do_nothing(index_elements=["file_hash"])
+    for chunk in _chunks(file_values):
+        file_stmt = (
+            insert(models.File)
+            .values(chunk)
+            .on_conflict_do_nothing(index_elements=["file_hash"])
+        )
+        await db.execute(file_stmt)
+
+    # map files to the session
+    for chunk in _chunks(mapping_values):
+        mapping_stmt = (
+            insert(models.SessionFile)
+            .values(chunk)
+            .on_conflict_do_nothing(index_elements=["session_id", "file_hash"])
+        )
+        await db.execute(mapping_stmt)
+
+
+async def _remove_session_files(
+    db: AsyncSession, session_id: int, file_hashes: list[str]
+) -> None:
+    """Unmap the given files from the session"""
+    if not file_hashes:
+        return
+
+    for chunk in _chunks(file_hashes):
+        stmt = delete(models.SessionFile).where(
+            models.SessionFile.session_id == session_id,
+            models.SessionFile.file_hash.in_(chunk),
+        )
+        await db.execute(stmt)
+
+
+@metrics.timed
+async def upsert_file_announcement(
+    db: AsyncSession,
+    payload: schemas.FileAnnounce,
+    client_ip: str,
+    public_ip: str | None = None,
+) -> schemas.AnnounceResult:
+    """Handles a full announce by resyncing the client's files with minimal writes"""
+
+    session_id = await _upsert_session(
+        db,
+        payload.user_id,
+        client_ip,
+        payload.port,
+        payload.public_url,
+        payload.version,
+        public_ip,
     )
-    db.execute(file_stmt)
 
-    # upsert ActivePeers
-    peer_stmt = (
-        insert(models.ActivePeer)
-        .values(peer_values)
-        .on_conflict_do_update(
-            constraint="active_peers_user_id_file_hash_key",
-            set_={
-                "last_heartbeat": datetime.now(timezone.utc),
-                "ip_address": client_ip,
-                "port": payload.port,
-                "public_url": payload.public_url,
-            },
+    # Diff against what this session already shares,
+    # so unchanged files are not deleted and re-inserted
+    existing = set(
+        await db.scalars(
+            select(models.SessionFile.file_hash).where(
+                models.SessionFile.session_id == session_id
+            )
         )
     )
-    db.execute(peer_stmt)
+    announced = {file.file_hash: file for file in payload.files}
 
-    db.commit()
-    return len(payload.files)
+    removed = [file_hash for file_hash in existing if file_hash not in announced]
+    added = [file for file_hash, file in announced.items() if file_hash not in existing]
 
+    await _remove_session_files(db, session_id, removed)
+    await _add_session_files(db, session_id, added)
+
+    await db.commit()
+    return schemas.AnnounceResult(
+        announced=len(announced),
+        version=payload.version,
+        added=added,
+        removed=removed,
+    )
+
+
+# Temporary tables of a streamed announce, created per transaction
+_staging = table(
+    "announce_staging", column("file_hash"), column("file_name"), column("file_size")
+)
+_changes = table("announce_changes", column("file_hash"), column("added", Boolean))
+
+
+@metrics.timed
+async def stream_file_announcement(
+    db: AsyncSession,
+    header: schemas.AnnounceStreamHeader,
+    files: AsyncIterable[schemas.FileBase],
+    client_ip: str,
+    public_ip: str | None = None,
+    on_change: Callable[[List[schemas.FileBase], List[str]], None] | None = None,
+    chunk_size: int = 5000,
+) -> schemas.AnnounceResult:
+    """Full announce of a library streamed record by record.
+
+    Files are COPYed into a temporary staging table as they arrive and the
+    session is diffed against it in SQL, so memory use does not grow with
+    the library. Once committed, the changes are reported to `on_change` in
+    chunks of `chunk_size`. The temporary tables belong to a connection, so
+    all of this runs on one connection of its own rather than on `db`, which
+    may hand its connection back to the pool when committing.
+    """
+    async with db.bind.connect() as conn:
+        session_id = await _upsert_session(
+            conn,
+            header.user_id,
+            client_ip,
+            header.port,
+            header.public_url,
+            header.version,
+            public_ip,
+        )
+
+        await conn.execute(
+            text(
+                "CREATE TEMP TABLE announce_staging ("
+                "file_hash VARCHAR(64), file_name VARCHAR(255), file_size BIGINT)"
+            )
+        )
+        await conn.execute(
+            text(
+                "CREATE TEMP TABLE announce_changes (file_hash VARCHAR(64), added BOOL)"
+            )
+        )
+        try:
+            raw = await conn.get_raw_connection()
 
-def update_last_heartbeat(db: Session, user_id: int, ip_address: str, port: int) -> int:
-    """Update the last_heartbeat of given peer"""
+            async def records():
+                async for file in files:
+                    yield (file.file_hash, file.file_name, file.file_size)
+
+            await raw.driver_connection.copy_records_to_table(
+                "announce_staging",
+                records=records(),
+                columns=["file_hash", "file_name", "file_size"],
+            )
+
+            # The session row is locked by the upsert, so the diff can't race
+            shared = models.SessionFile.session_id == session_id
+            added = (
+                select(_staging.c.file_hash, true())
+                .where(
+                    ~exists().where(
+                        shared, models.SessionFile.file_hash == _staging.c.file_hash
+                    )
+                )
+                .distinct()
+            )
+            removed = select(models.SessionFile.file_hash, false()).where(
+                shared,
+                ~exists().where(_staging.c.file_hash == models.SessionFile.file_hash),
+            )
+            await conn.execute(
+                insert(_changes).from_select(
+                    ["file_hash", "added"], union_all(added, removed)
+                )
+            )
+
+            await conn.execute(
+                insert(models.File)
+                .from_select(
+                    ["file_hash", "file_name", "file_size"],
+                    select(
+                        _staging.c.file_hash, _staging.c.file_name, _staging.c.file_size
+                    )
+                    .distinct(_staging.c.file_hash)
+                    .order_by(_staging.c.file_hash),
+                )
+                .on_conflict_do_nothing(index_elements=["file_hash"])
+            )
+            await conn.execute(
+                delete(models.SessionFile).where(
+                    shared,
+                    models.SessionFile.file_hash.in_(
+                        select(_changes.c.file_hash).where(~_changes.c.added)
+                    ),
+                )
+            )
+            await conn.execute(
+                insert(models.SessionFile)
+                .from_select(
+                    ["session_id", "file_hash"],
+                    select(literal(session_id), _changes.c.file_hash).where(
+                        _changes.c.added
+                    ),
+                )
+                .on_conflict_do_nothing(index_elements=["session_id", "file_hash"])
+            )
+            count = await conn.scalar(
+                select(func.count())
+                .select_from(models.SessionFile)
+                .where(models.SessionFile.session_id == session_id)
+            )
+            await conn.commit()
+
+            if on_change is not None:
+                result = await conn.stream(
+                    select(
+                        _changes.c.file_hash,
+                        _changes.c.added,
+                        models.File.file_name,
+                        models.File.file_size,
+                    ).join(models.File, models.File.file_hash == _changes.c.file_hash)
+                )
+                async for rows in result.partitions(chunk_size):
+                    on_change(
+                        [
+                            schemas.FileBase.model_construct(
+                                file_hash=row.file_hash,
+                                file_name=row.file_name,
+                                file_size=row.file_size,
+                            )
+                            for row in rows
+                            if row.added
+                        ],
+                        [row.file_hash for row in rows if not row.added],
+                    )
+        finally:
+            # A failed transaction already dropped them, make sure the pooled
+            # connection does not keep them otherwise
+            await conn.rollback()
+            await conn.execute(
+                text("DROP TABLE IF EXISTS announce_staging, announce_changes")
+            )
+            await conn.commit()
+
+    return schemas.AnnounceResult(announced=count or 0, version=header.version)
+
+
+@metrics.timed
+async def apply_file_delta(
+    db: AsyncSession,
+    payload: schemas.FileAnnounceDelta,
+    client_ip: str,
+    public_ip: str | None = None,
+) -> schemas.AnnounceResult | None:
+    """Applies an incremental announce, returns None if the versions diverged"""
+
+    # Lock the session row so concurrent deltas are applied one at a time
+    session = await db.scalar(
+        select(models.PeerSession)
+        .where(
+            models.PeerSession.user_id == payload.user_id,
+            models.PeerSession.ip_address == client_ip,
+            models.PeerSession.port == payload.port,
+        )
+        .with_for_update()
+    )
+    if session is None or session.library_version != payload.base_version:
+        await db.rollback()
+        return None
+
+    added = list({file.file_hash: file for file in payload.added}.values())
+    added_hashes = {file.file_hash for file in added}
+    requested = [h for h in dict.fromkeys(payload.removed) if h not in added_hashes]
+
+    # Only report changes that actually happened to this session
+    existing: set[str] = set()
+    for chunk in _chunks(list(added_hashes | set(requested))):
+        existing.update(
+            await db.scalars(
+                select(models.SessionFile.file_hash).where(
+                    models.SessionFile.session_id == session.session_id,
+                    models.SessionFile.file_hash.in_(chunk),
+                )
+            )
+        )
+    added = [file for file in added if file.file_hash not in existing]
+    removed = [file_hash for file_hash in requested if file_hash in existing]
+
+    await _remove_session_files(db, session.session_id, removed)
+    await _add_session_files(db, session.session_id, added)
+    session.library_version = payload.version
+    session.public_url = payload.public_url
+    session.public_ip = public_ip
+    session.last_heartbeat = datetime.now(timezone.utc)
+    await _touch_lease(db, session.session_id)
+
+    count = await db.scalar(
+        select(func.count())
+        .select_from(models.SessionFile)
+        .where(models.SessionFile.session_id == session.session_id)
+    )
+
+    await db.commit()
+    return schemas.AnnounceResult(
+        announced=count or 0,
+        version=payload.version,
+        added=added,
+        removed=removed,
+    )
+
+
+@metrics.timed
+async def update_last_heartbeat(
+    db: AsyncSession, user_id: int, ip_address: str, port: int, load: int | None = None
+) -> int:
+    """Update the last_heartbeat (and reported load) of given peer session"""
+    if leases.enabled():
+        return await _renew_leases(db, [(user_id, ip_address, port)], load)
+
+    values = {"last_heartbeat": datetime.now(timezone.utc)}
+    if load is not None:
+        values["load"] = load
     stmt = (
-        update(models.ActivePeer)
+        update(models.PeerSession)
         .where(
-            models.ActivePeer.user_id == user_id,
-            models.ActivePeer.ip_address == ip_address,
-            models.ActivePeer.port == port,
+            models.PeerSession.user_id == user_id,
+            models.PeerSession.ip_address == ip_address,
+            models.PeerSession.port == port,
         )
-        .values(last_heartbeat=datetime.now(timezone.utc))
+        .values(values)
     )
-    result = cast(CursorResult, db.execute(stmt))
-    db.commit()
+    result = cast(CursorResult, await db.execute(stmt))
+    await db.commit()
     return result.rowcount
 
 
-def search_files(
-    db: Session, query: str
-) -> list[tuple[models.File, models.ActivePeer, models.User]]:
-    """Searches for files on other active peers"""
+@metrics.timed
+async def update_last_heartbeats(
+    db: AsyncSession, sessions: list[tuple[int, str, int]]
+) -> int:
+    """Update the last_heartbeat of many (user_id, ip_address, port) sessions at once"""
+    if not sessions:
+        return 0
+    if leases.enabled():
+        return await _renew_leases(db, sessions)
+
+    now = datetime.now(timezone.utc)
+    touched = 0
+    for chunk in _chunks(sessions):
+        stmt = (
+            update(models.PeerSession)
+            .where(
+                tuple_(
+                    models.PeerSession.user_id,
+                    models.PeerSession.ip_address,
+                    models.PeerSession.port,
+                ).in_(chunk)
+            )
+            .values(last_heartbeat=now)
+        )
+        result = cast(CursorResult, await db.execute(stmt))
+        touched += result.rowcount
+    await db.commit()
+    return touched
+
+
+async def _renew_leases(
+    db: AsyncSession, sessions: list[tuple[int, str, int]], load: int | None = None
+) -> int:
+    """Heartbeats as inserts into the current lease bucket, peer_sessions rows
+    are only updated when the reported load changed"""
+    bucket = leases.current_bucket()
+    touched = 0
+    for chunk in _chunks(sessions):
+        matched = (
+            select(models.PeerSession.session_id)
+            .where(
+                tuple_(
+                    models.PeerSession.user_id,
+                    models.PeerSession.ip_address,
+                    models.PeerSession.port,
+                ).in_(chunk)
+            )
+            # Expiry skips locked sessions, holds it off until the lease is in
+            .with_for_update(key_share=True)
+            .cte("matched")
+        )
+        lease = (
+            insert(models.SessionLease)
+            .from_select(
+                ["session_id", "bucket"],
+                select(matched.c.session_id, literal(bucket, BigInteger)),
+            )
+            .on_conflict_do_nothing()
+            .cte("lease")
+        )
+        stmt = select(func.count()).select_from(matched).add_cte(lease)
+        if load is not None:
+            stmt = stmt.add_cte(
+                update(models.PeerSession)
+                .where(
+                    models.PeerSession.session_id.in_(select(matched.c.session_id)),
+                    models.PeerSession.load.is_distinct_from(load),
+                )
+                .values(load=load)
+                .cte("reported")
+            )
+        touched += await db.scalar(stmt)
+    await db.commit()
+    return touched
+
+
+def _last_heartbeat(latest_bucket=None):
+    """When a peer session was last heard from, as a column expression.
+
+    With partitioned leases heartbeats only renew the lease, a session was
+    then last heard from during its latest bucket. `latest_bucket` is that
+    bucket when the caller already joins it in, else it is looked up per
+    session.
+    """
+    if not leases.enabled():
+        return models.PeerSession.last_heartbeat
+    if latest_bucket is None:
+        latest_bucket = (
+            select(func.max(models.SessionLease.bucket))
+            .where(models.SessionLease.session_id == models.PeerSession.session_id)
+            .scalar_subquery()
+        )
+    return func.greatest(
+        models.PeerSession.last_heartbeat,
+        func.least(
+            func.now(),
+            func.to_timestamp(latest_bucket + leases.LEASE_BUCKET_SECONDS),
+        ),
+    )
+
+
+@metrics.timed
+async def search_files(
+    db: AsyncSession,
+    query: str,
+    limit: int = 50,
+    cursor: tuple[float, str] | None = None,
+    min_size: int | None = None,
+    max_size: int | None = None,
+    extension: str | None = None,
+    mode: schemas.SearchMode = "fuzzy",
+) -> list[Row]:
+    """Searches for files on other active peers, best matches first.
+
+    `fuzzy` ranks names by trigram similarity to the query. `text` matches
+    names containing every word of the query, in any order, and ranks them
+    by search_index.text_score. Returns one row per file (file_hash,
+    file_name, file_size, score, peers) with the peers holding it aggregated
+    into a JSON array. `cursor` is the (score, file_hash) of the last row of
+    the previous page.
+    """
+    shared = models.SessionFile.file_hash == models.File.file_hash
+    if mode == "text":
+        tokens, prefix = search_index.text_query(query)
+        terms = len(tokens) + (prefix is not None)
+        if not terms:
+            return []
+        # Tokens are letters and digits only, safe to quote as lexemes
+        lexemes = [f"'{token}'" for token in tokens]
+        if prefix is not None:
+            lexemes.append(f"'{prefix}':*")
+        name_match = models.File.search_vector.op("@@")(
+            cast_(literal(" & ".join(lexemes)), TSQUERY)
+        )
+
+        # Counted per matching file from the session_files index, cheaper
+        # than joining and grouping every holder of every match
+        holders = (
+            select(func.count().label("peers"))
+            .select_from(models.SessionFile)
+            .where(shared)
+            .lateral("holders")
+        )
+        relevance = func.least(
+            literal(1.0, DOUBLE_PRECISION),
+            literal(float(terms), DOUBLE_PRECISION)
+            / cast_(func.length(models.File.search_vector), DOUBLE_PRECISION),
+        )
+        score = relevance * (1 + func.ln(cast_(holders.c.peers, DOUBLE_PRECISION)))
+        ranked = (
+            select(models.File.file_hash)
+            .select_from(models.File)
+            .join(holders, true())
+            .where(name_match, holders.c.peers > 0)
+        )
+    else:
+        score = func.similarity(models.File.file_name, query)
+
+        pattern = utils.escape_like(query)
+        # Short queries have no trigram to match on, only match them as a prefix
+        if len(query) < 3:
+            name_match = models.File.file_name.ilike(f"{pattern}%", escape="\\")
+        else:
+            name_match = or_(
+                models.File.file_name.ilike(f"%{pattern}%", escape="\\"),
+                models.File.file_name.op("%")(query),
+            )
+        ranked = select(models.File.file_hash).where(name_match, exists().where(shared))
+
+    if min_size is not None:
+        ranked = ranked.where(models.File.file_size >= min_size)
+    if max_size is not None:
+        ranked = ranked.where(models.File.file_size <= max_size)
+    if extension:
+        ranked = ranked.where(
+            models.File.file_name.ilike(
+                f"%.{utils.escape_like(extension)}", escape="\\"
+            )
+        )
+
+    if cursor is not None:
+        # Keyset pagination, compared in the type the score is computed in,
+        # REAL for similarity()
+        last_score = cast_(
+            literal(cursor[0]), DOUBLE_PRECISION if mode == "text" else REAL
+        )
+        ranked = ranked.where(
+            or_(
+                score < last_score,
+                and_(score == last_score, models.File.file_hash > cursor[1]),
+            )
+        )
+
+    # Only the files of this page get their peers aggregated
+    page = (
+        ranked.add_columns(
+            models.File.file_name, models.File.file_size, score.label("score")
+        )
+        .order_by(score.desc(), models.File.file_hash)
+        .limit(limit)
+        .subquery("page")
+    )
+
+    peers = func.json_agg(
+        func.json_build_object(
+            "user_id",
+            models.PeerSession.user_id,
+            "ip_address",
+            models.PeerSession.ip_address,
+            "port",
+            models.PeerSession.port,
+            "public_url",
+            models.PeerSession.public_url,
+            "username",
+            models.User.username,
+            "last_heartbeat",
+            _last_heartbeat(),
+            "load",
+            models.PeerSession.load,
+        ),
+        type_=JSON,
+    )
+
+    stmt = (
+        select(
+            page.c.file_hash,
+            page.c.file_name,
+            page.c.file_size,
+            page.c.score,
+            peers.label("peers"),
+        )
+        .join(models.SessionFile, page.c.file_hash == models.SessionFile.file_hash)
+        .join(
+            models.PeerSession,
+            models.SessionFile.session_id == models.PeerSession.session_id,
+        )
+        .join(models.User, models.PeerSession.user_id == models.User.user_id)
+        .group_by(page.c.file_hash, page.c.file_name, page.c.file_size, page.c.score)
+        .order_by(page.c.score.desc(), page.c.file_hash)
+    )
+
+    return list((await db.execute(stmt)).all())
+
+
+@metrics.timed
+async def get_file_peers(db: AsyncSession, file_hash: str) -> list[Row]:
+    """Get every peer session sharing the given file"""
+    stmt = (
+        select(
+            models.PeerSession.user_id,
+            models.PeerSession.ip_address,
+            models.PeerSession.port,
+            models.PeerSession.public_url,
+            models.PeerSession.public_ip,
+            models.PeerSession.load,
+            _last_heartbeat().label("last_heartbeat"),
+            models.User.username,
+        )
+        .join(
+            models.SessionFile,
+            models.SessionFile.session_id == models.PeerSession.session_id,
+        )
+        .join(models.User, models.PeerSession.user_id == models.User.user_id)
+        .where(models.SessionFile.file_hash == file_hash)
+    )
+    return list((await db.execute(stmt)).all())
+
+
+@metrics.timed
+async def count_file_peers(db: AsyncSession, file_hashes: List[str]) -> dict[str, int]:
+    """Number of peer sessions sharing each of the given files, when any"""
+    if not file_hashes:
+        return {}
+    stmt = (
+        select(models.SessionFile.file_hash, func.count())
+        .where(models.SessionFile.file_hash.in_(file_hashes))
+        .group_by(models.SessionFile.file_hash)
+    )
+    return {file_hash: count for file_hash, count in await db.execute(stmt)}
+
+
+@metrics.timed
+async def get_files_shared_by(
+    db: AsyncSession, user_id: int, file_hashes: List[str]
+) -> set[str]:
+    """The given files some peer session of the user currently shares"""
+    if not file_hashes:
+        return set()
+    stmt = (
+        select(models.SessionFile.file_hash)
+        .distinct()
+        .join(
+            models.PeerSession,
+            models.SessionFile.session_id == models.PeerSession.session_id,
+        )
+        .where(
+            models.PeerSession.user_id == user_id,
+            models.SessionFile.file_hash.in_(file_hashes),
+        )
+    )
+    return set((await db.scalars(stmt)).all())
+
+
+@metrics.timed
+async def get_file_manifest(
+    db: AsyncSession, file_hash: str
+) -> models.FileManifest | None:
+    return await db.get(models.FileManifest, file_hash)
+
+
+@metrics.timed
+async def add_file_manifests(
+    db: AsyncSession, manifests: List[schemas.FileManifest]
+) -> tuple[int, List[str]]:
+    """Store manifests of files without one yet.
+
+    Returns how many were stored and the hashes already known with another
+    size, piece size or root, the first manifest of a file is kept.
+    """
+    if not manifests:
+        return 0, []
+    by_hash = {manifest.file_hash: manifest for manifest in manifests}
+    result = cast(
+        CursorResult,
+        await db.execute(
+            insert(models.FileManifest)
+            .values(
+                [
+                    {
+                        "file_hash": manifest.file_hash,
+                        "file_size": manifest.file_size,
+                        "piece_size": manifest.piece_size,
+                        "merkle_root": bytes.fromhex(manifest.merkle_root),
+                        "pieces": manifest.pieces,
+                    }
+                    for manifest in by_hash.values()
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=["file_hash"])
+        ),
+    )
+    stored = await db.execute(
+        select(
+            models.FileManifest.file_hash,
+            models.FileManifest.file_size,
+            models.FileManifest.piece_size,
+            models.FileManifest.merkle_root,
+        ).where(models.FileManifest.file_hash.in_(list(by_hash)))
+    )
+    await db.commit()
+    conflicts = [
+        row.file_hash
+        for row in stored
+        if (row.file_size, row.piece_size, row.merkle_root.hex())
+        != (
+            by_hash[row.file_hash].file_size,
+            by_hash[row.file_hash].piece_size,
+            by_hash[row.file_hash].merkle_root,
+        )
+    ]
+    return result.rowcount, conflicts
+
+
+async def get_session_files(db: AsyncSession) -> AsyncIterator[Row]:
+    """Streams every peer session with the files it shares, one row per file"""
+    latest = None
+    if leases.enabled():
+        # Latest bucket of every session at once, cheaper than looking each up
+        latest = (
+            select(
+                models.SessionLease.session_id,
+                func.max(models.SessionLease.bucket).label("bucket"),
+            )
+            .group_by(models.SessionLease.session_id)
+            .subquery()
+        )
+    last_heartbeat = _last_heartbeat(
+        latest.c.bucket if latest is not None else None
+    ).label("last_heartbeat")
+
+    stmt = (
+        select(
+            models.PeerSession.session_id,
+            models.PeerSession.user_id,
+            models.PeerSession.ip_address,
+            models.PeerSession.port,
+            models.PeerSession.public_url,
+            models.PeerSession.public_ip,
+            models.PeerSession.load,
+            models.PeerSession.library_version,
+            last_heartbeat,
+            models.User.username,
+            models.File.file_hash,
+            models.File.file_name,
+            models.File.file_size,
+        )
+        .join(models.User, models.PeerSession.user_id == models.User.user_id)
+        .outerjoin(
+            models.SessionFile,
+            models.PeerSession.session_id == models.SessionFile.session_id,
+        )
+        .outerjoin(models.File, models.SessionFile.file_hash == models.File.file_hash)
+        .execution_options(yield_per=5000)
+    )
+    if latest is not None:
+        stmt = stmt.outerjoin(
+            latest, models.PeerSession.session_id == latest.c.session_id
+        )
+    result = await db.stream(stmt)
+    async for row in result:
+        yield row
+
+
+async def get_file_peer_counts(db: AsyncSession) -> AsyncIterator[Row]:
+    """Streams every shared file with the number of sessions sharing it"""
     stmt = (
-        select(models.File, models.ActivePeer, models.User)
-        .join(models.ActivePeer, models.File.file_hash == models.ActivePeer.file_hash)
-        .join(models.User, models.ActivePeer.user_id == models.User.user_id)
-        .where(models.File.file_name.ilike(f"%{query}%"))
+        select(
+            models.File.file_hash,
+            models.File.file_name,
+            func.count().label("peers"),
+        )
+        .join(models.SessionFile, models.File.file_hash == models.SessionFile.file_hash)
+        .group_by(models.File.file_hash)
+        .execution_options(yield_per=5000)
     )
-    return list(db.execute(stmt).tuples().all())
+    result = await db.stream(stmt)
+    async for row in result:
+        yield row
 
 
-def remove_inactive_peers(db: Session, threshold_seconds: int = 60) -> int:
-    """Delete the ghost entries in table"""
+@metrics.timed
+async def count_sessions(db: AsyncSession) -> int:
+    """Number of peer sessions in the table, expired or not"""
+    return await db.scalar(select(func.count()).select_from(models.PeerSession))
+
+
+@metrics.timed
+async def remove_user_sessions(db: AsyncSession, user_id: int) -> schemas.ExpiryResult:
+    """Delete every session of a user, reporting the files they shared"""
+    removed = (
+        delete(models.PeerSession)
+        .where(models.PeerSession.user_id == user_id)
+        .returning(models.PeerSession.session_id)
+        .cte("removed")
+    )
+    stmt = select(removed.c.session_id, models.SessionFile.file_hash).outerjoin(
+        models.SessionFile, models.SessionFile.session_id == removed.c.session_id
+    )
+
+    rows = (await db.execute(stmt)).all()
+    await db.commit()
+    return schemas.ExpiryResult(
+        expired=len({row.session_id for row in rows}),
+        removed=[row.file_hash for row in rows if row.file_hash is not None],
+    )
+
+
+@metrics.timed
+async def remove_inactive_peers(
+    db: AsyncSession, threshold_seconds: int = 60, batch_size: int | None = None
+) -> schemas.ExpiryResult:
+    """Delete (up to batch_size of) the sessions that stopped sending heartbeats"""
 
     cutoff_time = datetime.now(timezone.utc) - timedelta(seconds=threshold_seconds)
 
-    stmt = delete(models.ActivePeer).where(
-        models.ActivePeer.last_heartbeat < cutoff_time
+    # Oldest leases first, rows locked by an announce/ping in flight are left
+    # for the next batch instead of waiting on them
+    stale = (
+        select(models.PeerSession.session_id)
+        .where(models.PeerSession.last_heartbeat < cutoff_time)
+        .order_by(models.PeerSession.last_heartbeat)
+        .with_for_update(skip_locked=True)
     )
+    if leases.enabled():
+        # Sessions of the buckets about to be dropped that were not heard from
+        # since, their leases are left to the partition drop
+        cutoff_bucket = leases.bucket_of(cutoff_time)
+        renewed = aliased(models.SessionLease)
+        stale = (
+            select(models.PeerSession.session_id)
+            .where(
+                models.PeerSession.session_id.in_(
+                    select(models.SessionLease.session_id).where(
+                        models.SessionLease.bucket < cutoff_bucket
+                    )
+                ),
+                ~exists().where(
+                    renewed.session_id == models.PeerSession.session_id,
+                    renewed.bucket >= cutoff_bucket,
+                ),
+            )
+            .with_for_update(skip_locked=True)
+        )
+    if batch_size is not None:
+        stale = stale.limit(batch_size)
 
-    result = db.execute(stmt)
-    assert isinstance(result, CursorResult)
-    db.commit()
-    return result.rowcount
+    # session_files rows go away with their session (ON DELETE CASCADE),
+    # the select still sees them and reports which files lost a peer
+    expired = (
+        delete(models.PeerSession)
+        .where(models.PeerSession.session_id.in_(stale.scalar_subquery()))
+        .returning(models.PeerSession.session_id)
+        .cte("expired")
+    )
+    stmt = select(expired.c.session_id, models.SessionFile.file_hash).outerjoin(
+        models.SessionFile, models.SessionFile.session_id == expired.c.session_id
+    )
+
+    rows = (await db.execute(stmt)).all()
+    await db.commit()
+    return schemas.ExpiryResult(
+        expired=len({row.session_id for row in rows}),
+        removed=[row.file_hash for row in rows if row.file_hash is not None],
+    )
@@ -1,9 +1,11 @@
 import os
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+
+from .db_metrics import InstrumentedPool, instrument_engine
 
 load_dotenv()
 
@@ -12,17 +14,55 @@ DATABASE_URL = os.getenv("SQLALCHEMY_DATABASE_URL")
 if DATABASE_URL is None:
     raise RuntimeError("SQLALCHEMY_DATABASE_URL is not set")
 
+# Connection pool, sized per tracker process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # seconds
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", -1))  # seconds, -1 disables
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+
+def to_async_url(url: str):
+    """Point a postgresql:// URL at the asyncpg driver.
+
+    asyncpg has no `sslmode` query parameter, it is passed as `ssl` instead.
+    Returns the URL and the connect_args to create the engine with.
+    """
+    parsed = make_url(url)
+    query = dict(parsed.query)
+    connect_args = {}
+    sslmode = query.pop("sslmode", None)
+    if sslmode:
+        connect_args["ssl"] = sslmode
+    return (
+        parsed.set(drivername="postgresql+asyncpg", query=query),
+        connect_args,
+    )
+
+
+ASYNC_DATABASE_URL, CONNECT_ARGS = to_async_url(DATABASE_URL)
 
-engine = create_engine(DATABASE_URL)
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    connect_args=CONNECT_ARGS,
+    poolclass=InstrumentedPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
+instrument_engine(engine.sync_engine)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than this are logged, 0 disables the log
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", 500))
+
+
+class DatabaseMetrics:
+    """Counters of the connection pool and of the statements run through it"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_wait_seconds = 0.0
+        self.checkout_wait_max_seconds = 0.0
+        self.timeouts = 0
+        self.statements = 0
+        self.statement_seconds = 0.0
+        self.statement_max_seconds = 0.0
+        self.slow_statements = 0
+
+    def record_checkout(self, waited: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_wait_seconds += waited
+            self.checkout_wait_max_seconds = max(self.checkout_wait_max_seconds, waited)
+
+    def record_timeout(self) -> None:
+        with self._lock:
+            self.timeouts += 1
+
+    def record_statement(self, elapsed: float, statement: str) -> None:
+        slow = DB_SLOW_QUERY_MS > 0 and elapsed * 1000 >= DB_SLOW_QUERY_MS
+        with self._lock:
+            self.statements += 1
+            self.statement_seconds += elapsed
+            self.statement_max_seconds = max(self.statement_max_seconds, elapsed)
+            if slow:
+                self.slow_statements += 1
+        if slow:
+            logger.warning(
+                f"Slow statement ({elapsed * 1000:.1f} ms): {statement[:200]}"
+            )
+
+    def stats(self, pool) -> dict:
+        with self._lock:
+            return {
+                "pool_size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+                "checkouts": self.checkouts,
+                "checkout_wait_avg_ms": (
+                    self.checkout_wait_seconds / self.checkouts * 1000
+                    if self.checkouts
+                    else 0.0
+                ),
+                "checkout_wait_max_ms": self.checkout_wait_max_seconds * 1000,
+                "timeouts": self.timeouts,
+                "statements": self.statements,
+                "statement_avg_ms": (
+                    self.statement_seconds / self.statements * 1000
+                    if self.statements
+                    else 0.0
+                ),
+                "statement_max_ms": self.statement_max_seconds * 1000,
+                "slow_statements": self.slow_statements,
+            }
+
+
+db_metrics = DatabaseMetrics()
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long checkouts wait and how often they time out"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except exc.TimeoutError:
+            db_metrics.record_timeout()
+            raise
+        db_metrics.record_checkout(time.perf_counter() - start)
+        return record
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Time every statement executed through the (sync) engine"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        start = conn.info["query_start"].pop()
+        db_metrics.record_statement(time.perf_counter() - start, statement)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # Failed statements never reach after_cursor_execute
+        starts = (
+            context.connection.info.get("query_start") if context.connection else None
+        )
+        if starts:
+            starts.pop()
@@ -0,0 +1,324 @@
+import gzip
+import os
+import zlib
+from typing import Any
+
+import anyio
+from fastapi import HTTPException, Request, Response
+from fastapi.routing import APIRoute
+from pydantic import TypeAdapter
+
+try:
+    import msgpack
+except ImportError:  # optional, responses stay JSON without it
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip only without it
+    zstandard = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+# Smaller responses are sent as they are, compressing them doesn't pay off
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", 1024))
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+# Compressed request bodies are refused with 413 once they inflate past this,
+# a small body must not expand into gigabytes (a zip bomb)
+REQUEST_MAX_DECOMPRESSED_BYTES = int(
+    os.getenv("REQUEST_MAX_DECOMPRESSED_BYTES", 64 * 1024 * 1024)
+)
+# Output produced per zlib or zstd call, and compressed input zstd reads at once
+INFLATE_STEP_BYTES = 64 * 1024
+ZSTD_MAX_WINDOW_BYTES = 8 * 1024 * 1024
+ZSTD_MAGIC = 0xFD2FB528
+
+
+def _parse_accept(header: str) -> dict[str, float]:
+    """Values of an Accept(-Encoding) header and their q weights"""
+    accepted = {}
+    for part in header.split(","):
+        value, _, params = part.strip().partition(";")
+        value = value.strip().lower()
+        if not value:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, weight = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(weight)
+                except ValueError:
+                    q = 0.0
+        accepted[value] = q
+    return accepted
+
+
+def negotiate_media_type(accept: str) -> str:
+    """msgpack if the client prefers it and it is installed, JSON otherwise"""
+    if msgpack is None or not accept:
+        return JSON
+    accepted = _parse_accept(accept)
+    msgpack_q = accepted.get(MSGPACK, 0.0)
+    json_q = max(
+        accepted.get(JSON, 0.0),
+        accepted.get("application/*", 0.0),
+        accepted.get("*/*", 0.0),
+    )
+    return MSGPACK if msgpack_q > 0 and msgpack_q >= json_q else JSON
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """Content coding to compress a response with, zstd preferred over gzip"""
+    accepted = _parse_accept(accept_encoding)
+    if zstandard is not None and accepted.get("zstd", 0.0) > 0:
+        return "zstd"
+    if accepted.get("gzip", 0.0) > 0:
+        return "gzip"
+    return None
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header lists the ETag, compared weakly"""
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(",")
+    )
+
+
+def _weak_etag(etag: str, media_type: str) -> str:
+    # Weak, the same content is sent differently compressed
+    suffix = "m" if media_type == MSGPACK else "j"
+    return f'W/"{etag}-{suffix}"'
+
+
+def not_modified(
+    request: Request, etag: str, headers: dict[str, str] | None = None
+) -> Response | None:
+    """304 for a client whose If-None-Match lists `etag`, else None"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+    tag = _weak_etag(etag, negotiate_media_type(request.headers.get("accept", "")))
+    if not etag_matches(if_none_match, tag):
+        return None
+    return Response(
+        status_code=304,
+        headers={"Vary": "Accept, Accept-Encoding", **(headers or {}), "ETag": tag},
+    )
+
+
+def encode_response(
+    request: Request,
+    content: Any,
+    adapter: TypeAdapter,
+    headers: dict[str, str] | None = None,
+    etag: str | None = None,
+) -> Response:
+    """Serialize `content` as negotiated with the client, compressed if large.
+
+    JSON goes through pydantic's serializer, which skips the response_model
+    round trip, msgpack is sent to clients asking for it. With an `etag`
+    (the version of `content`) a client already holding it gets a 304
+    before anything is serialized.
+    """
+    media_type = negotiate_media_type(request.headers.get("accept", ""))
+    if etag is not None:
+        headers = {**(headers or {}), "ETag": _weak_etag(etag, media_type)}
+        response = not_modified(request, etag, headers)
+        if response is not None:
+            return response
+    if media_type == MSGPACK:
+        body = msgpack.packb(adapter.dump_python(content, mode="json"))
+    else:
+        body = adapter.dump_json(content)
+
+    headers = {"Vary": "Accept, Accept-Encoding", **(headers or {})}
+    if len(body) >= RESPONSE_COMPRESS_MIN_BYTES:
+        coding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+        if coding == "zstd":
+            body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+        elif coding == "gzip":
+            body = gzip.compress(body, GZIP_LEVEL)
+        if coding is not None:
+            headers["Content-Encoding"] = coding
+    return Response(body, headers=headers, media_type=media_type)
+
+
+def _decompressor(coding: str):
+    if coding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(wbits=31)
+    if coding == "deflate":
+        return zlib.decompressobj()
+    if coding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor(max_window_size=ZSTD_MAX_WINDOW_BYTES)
+    raise HTTPException(
+        status_code=415, detail=f"Unsupported Content-Encoding: {coding}"
+    )
+
+
+def _inflate(decompressor, chunk: bytes):
+    """Decompress a chunk of the body with zlib, in bounded pieces"""
+    data = chunk
+    while True:
+        out = decompressor.decompress(data, INFLATE_STEP_BYTES)
+        data = decompressor.unconsumed_tail
+        if out:
+            yield out
+        elif not data:
+            # Pending output is drained by the call that returns nothing
+            return
+
+
+class _ZstdFrame:
+    """Follows the block headers of a zstd frame to see where it ends.
+
+    stream_reader returns nothing alike at the end of a frame and when its
+    input was cut short, the headers tell the two apart.
+    """
+
+    def __init__(self):
+        self.eof = False
+        self._header = bytearray()
+        self._need = 4  # header bytes wanted, the magic number first
+        self._skip = 0  # payload bytes to pass over before the next header
+        self._state = "magic"
+        self._checksum = False
+
+    def feed(self, data: bytes) -> None:
+        i = 0
+        while not self.eof and i < len(data):
+            if self._skip:
+                step = min(self._skip, len(data) - i)
+                self._skip -= step
+                i += step
+            else:
+                step = self._need - len(self._header)
+                self._header += data[i : i + step]
+                i += step
+                if len(self._header) == self._need:
+                    self._parse(int.from_bytes(self._header, "little"))
+                    self._header.clear()
+            if self._state == "end" and not self._skip:
+                self.eof = True
+
+    def _parse(self, value: int) -> None:
+        if self._state == "magic":
+            if value != ZSTD_MAGIC:
+                raise zstandard.ZstdError("not a zstd frame")
+            self._state, self._need = "descriptor", 1
+        elif self._state == "descriptor":
+            single_segment = bool(value & 0x20)
+            self._checksum = bool(value & 0x04)
+            self._skip = (
+                (0 if single_segment else 1)  # window descriptor
+                + (0, 1, 2, 4)[value & 0x03]  # dictionary id
+                + ((1 if single_segment else 0), 2, 4, 8)[value >> 6]  # content size
+            )
+            self._state, self._need = "block", 3
+        else:
+            block_type, size = (value >> 1) & 0x03, value >> 3
+            self._skip = 1 if block_type == 1 else size  # RLE blocks repeat a byte
+            if value & 0x01:  # last block
+                self._skip += 4 if self._checksum else 0
+                self._state = "end"
+
+
+class DecodedRequest(Request):
+    """Request whose body is decompressed according to its Content-Encoding"""
+
+    async def stream(self):
+        coding = self.headers.get("content-encoding", "identity").strip().lower()
+        if coding == "identity" or hasattr(self, "_body"):
+            async for chunk in super().stream():
+                yield chunk
+            return
+
+        decompressor = _decompressor(coding)
+        errors = (zlib.error, zstandard.ZstdError) if zstandard else (zlib.error,)
+        if coding == "zstd":
+            inflated = self._inflate_zstd(decompressor)
+        else:
+            inflated = self._inflate_zlib(decompressor)
+        size = 0
+        try:
+            async for data in inflated:
+                size += len(data)
+                if size > REQUEST_MAX_DECOMPRESSED_BYTES:
+                    raise HTTPException(
+                        status_code=413,
+                        detail="Decompressed body larger than "
+                        f"{REQUEST_MAX_DECOMPRESSED_BYTES} bytes",
+                    )
+                yield data
+        except errors:
+            raise HTTPException(status_code=400, detail="Corrupt compressed body")
+        finally:
+            await inflated.aclose()
+        yield b""
+
+    async def _inflate_zlib(self, decompressor):
+        async for chunk in super().stream():
+            for data in _inflate(decompressor, chunk):
+                yield data
+        data = decompressor.flush()
+        if not decompressor.eof:
+            raise HTTPException(status_code=400, detail="Truncated compressed body")
+        if data:
+            yield data
+
+    async def _inflate_zstd(self, decompressor):
+        """zstd output is only bounded per read of a stream_reader.
+
+        The reader pulls the body itself, so it reads in a worker thread and
+        waits for chunks still on their way there. Chunks are fetched ahead
+        on the event loop, most reads don't have to.
+        """
+        body = super().stream()
+        frame = _ZstdFrame()
+        buffer = bytearray()
+        ended = False
+
+        async def receive() -> None:
+            nonlocal ended
+            try:
+                chunk = await anext(body)
+            except StopAsyncIteration:
+                ended = True
+                return
+            frame.feed(chunk)
+            buffer.extend(chunk)
+
+        class Source:
+            def read(self, size: int) -> bytes:
+                while not buffer and not ended:
+                    anyio.from_thread.run(receive)
+                data = bytes(buffer[:size])
+                del buffer[:size]
+                return data
+
+        reader = decompressor.stream_reader(Source(), read_size=INFLATE_STEP_BYTES)
+        while True:
+            if not buffer and not ended:
+                await receive()
+            data = await anyio.to_thread.run_sync(reader.read1, INFLATE_STEP_BYTES)
+            if not data:
+                break
+            yield data
+        if not frame.eof:
+            raise HTTPException(status_code=400, detail="Truncated compressed body")
+
+
+class DecodingRoute(APIRoute):
+    """Route accepting gzip/deflate (and zstd when installed) request bodies"""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            return await handler(DecodedRequest(request.scope, request.receive))
+
+        return route_handler
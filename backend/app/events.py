@@ -0,0 +1,29 @@
+import logging
+from typing import Callable, List
+
+from . import schemas
+
+logger = logging.getLogger(__name__)
+
+# Called with the files that gained a peer and the hashes of files that lost
+# one (a hash appears once per peer that dropped it)
+ChangeListener = Callable[[List[schemas.FileBase], List[str]], None]
+
+_listeners: List[ChangeListener] = []
+
+
+def subscribe(listener: ChangeListener) -> ChangeListener:
+    """Register a listener for changes of the file/peer index"""
+    _listeners.append(listener)
+    return listener
+
+
+def publish(added: List[schemas.FileBase], removed: List[str]) -> None:
+    """Notify every listener about a change of the file/peer index"""
+    if not added and not removed:
+        return
+    for listener in _listeners:
+        try:
+            listener(added, removed)
+        except Exception as e:
+            logger.error(f"Error in index change listener {listener}: {e}")
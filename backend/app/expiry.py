@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from . import database, metrics
+from .leases import lease_partitions
+from .store import TrackerStore
+
+logger = logging.getLogger(__name__)
+
+PEER_TIMEOUT_SECONDS = int(os.getenv("PEER_TIMEOUT_SECONDS", 60))
+# Sessions deleted per transaction, bounds how long expiry holds row locks
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", 500))
+# Pause between two batches while a backlog is drained
+EXPIRY_BATCH_PAUSE_SECONDS = float(os.getenv("EXPIRY_BATCH_PAUSE_SECONDS", 0.05))
+# A cycle stops after this long, the rest of the backlog is picked up soon after
+EXPIRY_MAX_CYCLE_SECONDS = float(os.getenv("EXPIRY_MAX_CYCLE_SECONDS", 5))
+EXPIRY_INTERVAL_SECONDS = 60
+
+
+class ExpiryWorker:
+    """Deletes expired peer sessions in small batches.
+
+    Each batch is its own short transaction and the loop yields to other
+    requests between batches. While batches come back full the backlog is
+    drained at full pace; a cycle that had to stop early is followed by
+    another one right away instead of waiting for the next interval.
+    """
+
+    def __init__(
+        self,
+        store: TrackerStore,
+        threshold_seconds: int = PEER_TIMEOUT_SECONDS,
+        batch_size: int = EXPIRY_BATCH_SIZE,
+    ):
+        self.store = store
+        self.threshold_seconds = threshold_seconds
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self.cycles = 0
+        self.total_expired = 0
+        self.last_cycle: dict = {"expired": 0, "batches": 0, "duration_ms": 0.0}
+        self.backlog = False
+
+    async def run_cycle(self) -> int:
+        """Expire sessions until a batch comes back short or the cycle budget runs out"""
+        start = time.perf_counter()
+        expired = 0
+        batches = 0
+        backlog = False
+
+        while True:
+            async with database.SessionLocal() as db:
+                result = await self.store.remove_inactive_peers(
+                    db, self.threshold_seconds, self.batch_size
+                )
+            batches += 1
+            expired += result.expired
+            metrics.expired_sessions.inc(result.expired)
+            metrics.expired_session_files.inc(len(result.removed))
+            if result.expired < self.batch_size:
+                break
+            if time.perf_counter() - start >= EXPIRY_MAX_CYCLE_SECONDS:
+                backlog = True
+                break
+            await asyncio.sleep(EXPIRY_BATCH_PAUSE_SECONDS)
+
+        # Old lease buckets can go once every expired session is gone
+        if not backlog:
+            await lease_partitions.maintain(self.threshold_seconds)
+
+        duration = time.perf_counter() - start
+        with self._lock:
+            self.cycles += 1
+            self.total_expired += expired
+            self.backlog = backlog
+            self.last_cycle = {
+                "expired": expired,
+                "batches": batches,
+                "duration_ms": duration * 1000,
+            }
+        if expired:
+            logger.info(
+                f"Expired {expired} peer sessions in {batches} batches "
+                f"({duration * 1000:.1f} ms)"
+            )
+        return expired
+
+    def next_delay(self) -> float:
+        """Seconds to sleep before the next cycle"""
+        if self.backlog:
+            return EXPIRY_BATCH_PAUSE_SECONDS
+        # Run every interval, or as soon as the next lease can expire
+        next_expiry = self.store.next_expiry_in(self.threshold_seconds)
+        if next_expiry is None:
+            return EXPIRY_INTERVAL_SECONDS
+        return min(EXPIRY_INTERVAL_SECONDS, max(1, next_expiry))
+
+    async def run(self) -> None:
+        """Background loop expiring sessions until cancelled"""
+        while True:
+            try:
+                await self.run_cycle()
+            except Exception as e:
+                self.backlog = False
+                logger.error(f"Error during cleanup: {e}")
+            await asyncio.sleep(self.next_delay())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "cycles": self.cycles,
+                "total_expired": self.total_expired,
+                "backlog": self.backlog,
+                "batch_size": self.batch_size,
+                "last_cycle": dict(self.last_cycle),
+            }
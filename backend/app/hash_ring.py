@@ -0,0 +1,39 @@
+import bisect
+import hashlib
+from typing import Callable, List, TypeVar
+
+# Points per node on the ring, more of them spread files more evenly
+RING_POINTS_PER_NODE = 128
+
+T = TypeVar("T")
+
+
+class HashRing:
+    """Consistent hashing of file hashes onto tracker nodes.
+
+    Every node gets RING_POINTS_PER_NODE points on a 64 bit ring, a file
+    belongs to the node of the first point after its hash. Adding a node
+    only moves the files falling just before its points.
+    """
+
+    def __init__(self, nodes: List[str], points: int = RING_POINTS_PER_NODE):
+        ring = sorted(
+            (int.from_bytes(hashlib.sha256(f"{node}#{i}".encode()).digest()[:8]), node)
+            for node in nodes
+            for i in range(points)
+        )
+        self._points = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def owner(self, file_hash: str) -> str:
+        # File hashes are SHA-256 already, their first 64 bits are uniform
+        point = int(file_hash[:16], 16)
+        index = bisect.bisect_right(self._points, point) % len(self._points)
+        return self._nodes[index]
+
+    def split(self, items: List[T], key: Callable[[T], str]) -> dict[str, List[T]]:
+        """Items grouped by the node owning their file hash"""
+        parts: dict[str, List[T]] = {}
+        for item in items:
+            parts.setdefault(self.owner(key(item)), []).append(item)
+        return parts
@@ -0,0 +1,93 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException, status
+from pwdlib import PasswordHash
+
+# Worker processes reserved for argon2, the request threadpool never runs it
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+# Hash/verify calls allowed to wait for a worker before answering 503
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 32))
+PASSWORD_HASH_RETRY_AFTER_SECONDS = int(
+    os.getenv("PASSWORD_HASH_RETRY_AFTER_SECONDS", 2)
+)
+
+_password_hash = PasswordHash.recommended()
+
+
+# Run inside the worker processes
+def _hash(password: str) -> str:
+    return _password_hash.hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return _password_hash.verify(password, hashed_password)
+
+
+class PasswordHasher:
+    """Argon2 hashing in a small process pool of its own.
+
+    At most `max_pending` calls are in flight (running or queued); beyond
+    that callers get a 503 right away instead of piling up, so a login storm
+    can't take workers or CPU time away from heartbeats and searches. The
+    counters are only touched on the event loop, so no locking is needed.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: ProcessPoolExecutor | None = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self) -> None:
+        if self._executor is None:
+            # Forking a process that runs an event loop and threads is unsafe
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins in progress, retry shortly",
+                headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER_SECONDS)},
+            )
+        self.start()
+        self.pending += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self._executor, fn, *args
+            )
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(_verify, password, hashed_password)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import struct
+import time
+
+from . import database, schemas
+from .auth import SECRET_KEY
+from .expiry import PEER_TIMEOUT_SECONDS
+from .store import TrackerStore
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_UDP_PORT = int(os.getenv("HEARTBEAT_UDP_PORT", 0))  # 0 disables UDP
+HEARTBEAT_UDP_HOST = os.getenv("HEARTBEAT_UDP_HOST", "0.0.0.0")
+# Heartbeats received in this window are written in one batch
+HEARTBEAT_FLUSH_SECONDS = float(os.getenv("HEARTBEAT_FLUSH_SECONDS", 1))
+
+PROTOCOL_VERSION = 1
+# Datagram: version, channel id, sequence number, then a truncated HMAC-SHA256
+# of those fields keyed with the channel key
+HEADER = struct.Struct("!BQI")
+TAG_SIZE = 16
+# Reply: version, channel id, sequence number, status
+ACK = struct.Struct("!BQIB")
+ACK_OK = 0
+ACK_UNKNOWN_CHANNEL = 1
+
+SessionKey = tuple[int, str, int]  # (user_id, ip_address, port)
+
+
+def channel_key(channel_id: int) -> bytes:
+    """Key a client signs its heartbeats with, derived so it needs no storage"""
+    return hmac.new(
+        (SECRET_KEY or "").encode(),
+        b"peershare-heartbeat" + channel_id.to_bytes(8, "big"),
+        hashlib.sha256,
+    ).digest()[:TAG_SIZE]
+
+
+class _Channel:
+    __slots__ = ("session", "key", "last_seq", "last_seen")
+
+    def __init__(self, session: SessionKey, key: bytes):
+        self.session = session
+        self.key = key
+        self.last_seq = 0
+        self.last_seen = time.monotonic()
+
+
+class HeartbeatRegistry:
+    """Heartbeat channels handed out to peer sessions over HTTP.
+
+    A channel is a random id whose key is derived from SECRET_KEY, a new one
+    is issued on every announce/ping so clients start counting sequence
+    numbers from 1 again. Valid datagrams only mark the session as seen, the
+    leases are refreshed in batches by `flush`. Everything runs on the event
+    loop, so no locking is needed.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.port = HEARTBEAT_UDP_PORT
+        self._channels: dict[int, _Channel] = {}
+        self._by_session: dict[SessionKey, int] = {}
+        self._pending: set[SessionKey] = set()
+
+        self.accepted = 0
+        self.unknown = 0
+        self.rejected = 0  # malformed, bad signature or replayed
+        self.flushes = 0
+        self.sessions_touched = 0
+
+    def register(
+        self, user_id: int, ip_address: str, port: int
+    ) -> schemas.HeartbeatChannel | None:
+        """Issue a new channel for a session, None if UDP heartbeats are off"""
+        if not self.enabled:
+            return None
+        session = (user_id, ip_address, port)
+        previous = self._by_session.pop(session, None)
+        if previous is not None:
+            self._channels.pop(previous, None)
+
+        channel_id = secrets.randbits(63)
+        key = channel_key(channel_id)
+        self._channels[channel_id] = _Channel(session, key)
+        self._by_session[session] = channel_id
+        return schemas.HeartbeatChannel(
+            port=self.port, channel_id=channel_id, key=key.hex()
+        )
+
+    def handle(self, data: bytes) -> bytes | None:
+        """Check one datagram, returns the reply to send back if any"""
+        if len(data) != HEADER.size + TAG_SIZE:
+            self.rejected += 1
+            return None
+        version, channel_id, seq = HEADER.unpack_from(data)
+        if version != PROTOCOL_VERSION:
+            self.rejected += 1
+            return None
+
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            self.unknown += 1
+            return ACK.pack(PROTOCOL_VERSION, channel_id, seq, ACK_UNKNOWN_CHANNEL)
+
+        tag = hmac.new(channel.key, data[: HEADER.size], hashlib.sha256).digest()
+        if not hmac.compare_digest(tag[:TAG_SIZE], data[HEADER.size :]):
+            self.rejected += 1
+            return None
+        if seq <= channel.last_seq:
+            self.rejected += 1  # replayed or reordered
+            return None
+
+        channel.last_seq = seq
+        channel.last_seen = time.monotonic()
+        self._pending.add(channel.session)
+        self.accepted += 1
+        return ACK.pack(PROTOCOL_VERSION, channel_id, seq, ACK_OK)
+
+    async def flush(self, store: TrackerStore) -> int:
+        """Refresh the leases of every session heard from since the last flush"""
+        if not self._pending:
+            return 0
+        sessions, self._pending = list(self._pending), set()
+        try:
+            async with database.SessionLocal() as db:
+                touched = await store.update_last_heartbeats(db, sessions)
+        except Exception:
+            # Keep them for the next flush
+            self._pending.update(sessions)
+            raise
+        self.flushes += 1
+        self.sessions_touched += touched
+        return touched
+
+    def prune(self, max_idle_seconds: float) -> None:
+        """Forget channels that have not been used for a while"""
+        cutoff = time.monotonic() - max_idle_seconds
+        for channel_id, channel in list(self._channels.items()):
+            if channel.last_seen < cutoff:
+                del self._channels[channel_id]
+                if self._by_session.get(channel.session) == channel_id:
+                    del self._by_session[channel.session]
+
+    async def run(self, store: TrackerStore) -> None:
+        """Background loop writing heartbeats to the store until cancelled"""
+        while True:
+            await asyncio.sleep(HEARTBEAT_FLUSH_SECONDS)
+            try:
+                await self.flush(store)
+                self.prune(PEER_TIMEOUT_SECONDS * 2)
+            except Exception as e:
+                logger.error(f"Error while flushing heartbeats: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "channels": len(self._channels),
+            "pending": len(self._pending),
+            "accepted": self.accepted,
+            "unknown": self.unknown,
+            "rejected": self.rejected,
+            "flushes": self.flushes,
+            "sessions_touched": self.sessions_touched,
+        }
+
+
+class HeartbeatProtocol(asyncio.DatagramProtocol):
+    def __init__(self, registry: HeartbeatRegistry):
+        self.registry = registry
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        reply = self.registry.handle(data)
+        if reply is not None and self.transport is not None:
+            self.transport.sendto(reply, addr)
+
+
+async def start_listener(
+    registry: HeartbeatRegistry,
+) -> asyncio.DatagramTransport | None:
+    """Listen for UDP heartbeats if HEARTBEAT_UDP_PORT is set"""
+    if not HEARTBEAT_UDP_PORT:
+        return None
+    if not SECRET_KEY:
+        logger.warning("SECRET_KEY is not set, UDP heartbeats stay disabled")
+        return None
+
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: HeartbeatProtocol(registry),
+        local_addr=(HEARTBEAT_UDP_HOST, HEARTBEAT_UDP_PORT),
+    )
+    registry.enabled = True
+    logger.info(f"Listening for UDP heartbeats on port {HEARTBEAT_UDP_PORT}")
+    return transport
+
+
+heartbeat_registry = HeartbeatRegistry()
@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import Table, text
+from sqlalchemy.exc import DBAPIError
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+# Heartbeats are recorded as rows of `session_leases`, partitioned in buckets
+# of this many seconds, instead of updating peer_sessions. 0 keeps the leases
+# in peer_sessions.last_heartbeat
+LEASE_BUCKET_SECONDS = int(os.getenv("LEASE_BUCKET_SECONDS", 0))
+# Partitions created ahead of the current bucket, raised at startup to span
+# at least the minimum horizon given to LeasePartitions.prepare
+LEASE_PARTITIONS_AHEAD = int(os.getenv("LEASE_PARTITIONS_AHEAD", 10))
+# Times the partitions ahead are topped up while they last
+LEASE_CREATE_ROUNDS = 4
+# Dropping a partition locks the parent table, give up instead of queueing
+# heartbeats behind a long transaction. Retried on the next expiry cycle
+LEASE_DROP_LOCK_TIMEOUT = "1s"
+
+PARENT = "session_leases"
+# Catches the leases of a bucket whose partition is missing
+DEFAULT = f"{PARENT}_default"
+
+
+def enabled() -> bool:
+    return LEASE_BUCKET_SECONDS > 0
+
+
+def tables() -> list[Table]:
+    """Tables to create at startup, session_leases only when leases are enabled"""
+    return [
+        table
+        for table in database.Base.metadata.sorted_tables
+        if enabled() or table.name != PARENT
+    ]
+
+
+def bucket_of(moment: datetime) -> int:
+    """Epoch second the lease bucket of a moment starts at"""
+    # Not a bucket number, so partitions stay ordered when the width changes
+    seconds = int(moment.timestamp())
+    return seconds - seconds % LEASE_BUCKET_SECONDS
+
+
+def current_bucket() -> int:
+    return bucket_of(datetime.now(timezone.utc))
+
+
+def _partition(bucket: int) -> str:
+    return f"{PARENT}_{bucket}"
+
+
+class LeasePartitions:
+    """Creates the `session_leases` partitions ahead of time, drops expired ones.
+
+    A session is alive while it has a lease in a bucket that has not fully
+    passed the peer timeout. Rows of older buckets are never deleted one by
+    one: once the expiry worker removed the sessions without a newer lease,
+    their partitions are dropped, which leaves nothing behind to vacuum.
+
+    Partitions are created by their own loop, independent of the expiry
+    worker. Should it still fall behind, heartbeats land in the DEFAULT
+    partition and are moved out once their bucket's partition is created.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ahead = LEASE_PARTITIONS_AHEAD
+        self.created = 0
+        self.dropped = 0
+        self.defaulted = 0
+        self.last_drop_ms = 0.0
+
+    async def _buckets(self, conn) -> list[int]:
+        names = await conn.scalars(
+            text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = CAST(:parent AS regclass) "
+                "AND c.relname <> :default"
+            ),
+            {"parent": PARENT, "default": DEFAULT},
+        )
+        return sorted(int(name.rsplit("_", 1)[1]) for name in names)
+
+    async def create_ahead(self) -> int:
+        """Create the partitions of the current and the next buckets"""
+        current = current_bucket()
+        async with database.engine.connect() as conn:
+            existing = set(await self._buckets(conn))
+        created = 0
+        defaulted = 0
+        last = current + self.ahead * LEASE_BUCKET_SECONDS
+        for bucket in range(current, last + 1, LEASE_BUCKET_SECONDS):
+            if bucket in existing:
+                continue
+            try:
+                async with database.engine.begin() as conn:
+                    # A partition cannot be created over rows of the DEFAULT
+                    # one, they move to it in the same transaction
+                    moved = (
+                        await conn.execute(
+                            text(
+                                f"DELETE FROM {DEFAULT} "
+                                "WHERE bucket >= :bucket AND bucket < :end "
+                                "RETURNING session_id, bucket"
+                            ),
+                            {"bucket": bucket, "end": bucket + LEASE_BUCKET_SECONDS},
+                        )
+                    ).all()
+                    await conn.execute(
+                        text(
+                            f"CREATE TABLE IF NOT EXISTS {_partition(bucket)} "
+                            f"PARTITION OF {PARENT} "
+                            f"FOR VALUES FROM ({bucket}) "
+                            f"TO ({bucket + LEASE_BUCKET_SECONDS})"
+                        )
+                    )
+                    if moved:
+                        await conn.execute(
+                            text(
+                                f"INSERT INTO {PARENT} (session_id, bucket) "
+                                "VALUES (:session_id, :bucket)"
+                            ),
+                            [row._asdict() for row in moved],
+                        )
+                created += 1
+                defaulted += len(moved)
+            except DBAPIError as e:
+                # Another tracker process created it first, or it overlaps
+                # a partition made with another LEASE_BUCKET_SECONDS
+                logger.debug(f"Lease partition {bucket} not created: {e}")
+        if defaulted:
+            logger.warning(
+                f"Moved {defaulted} leases out of the default partition, "
+                "lease partitions were created late"
+            )
+        with self._lock:
+            self.created += created
+            self.defaulted += defaulted
+        return created
+
+    async def drop_expired(self, threshold_seconds: int) -> int:
+        """Drop the partitions of buckets whose leases all ran out"""
+        cutoff = bucket_of(
+            datetime.now(timezone.utc) - timedelta(seconds=threshold_seconds)
+        )
+        async with database.engine.connect() as conn:
+            expired = [b for b in await self._buckets(conn) if b < cutoff]
+
+        dropped = 0
+        start = time.perf_counter()
+        async with database.engine.begin() as conn:
+            # Leases of expired buckets left in the DEFAULT partition, once
+            # their session is gone or was heard from since
+            await conn.execute(
+                text(
+                    f"DELETE FROM {DEFAULT} l WHERE l.bucket < :cutoff "
+                    "AND (NOT EXISTS (SELECT 1 FROM peer_sessions s "
+                    "WHERE s.session_id = l.session_id) "
+                    f"OR EXISTS (SELECT 1 FROM {PARENT} n "
+                    "WHERE n.session_id = l.session_id AND n.bucket >= :cutoff))"
+                ),
+                {"cutoff": cutoff},
+            )
+        for bucket in expired:
+            try:
+                async with database.engine.begin() as conn:
+                    # Sessions last heard from in this bucket lose their lease
+                    # with it, wait until the expiry worker removed them
+                    if await conn.scalar(
+                        text(
+                            f"SELECT EXISTS (SELECT 1 FROM {_partition(bucket)} l "
+                            "JOIN peer_sessions s ON s.session_id = l.session_id "
+                            f"WHERE NOT EXISTS (SELECT 1 FROM {PARENT} n "
+                            "WHERE n.session_id = l.session_id "
+                            "AND n.bucket > :bucket))"
+                        ),
+                        {"bucket": bucket},
+                    ):
+                        break
+                    await conn.execute(
+                        text(f"SET LOCAL lock_timeout = '{LEASE_DROP_LOCK_TIMEOUT}'")
+                    )
+                    await conn.execute(
+                        text(f"DROP TABLE IF EXISTS {_partition(bucket)}")
+                    )
+                dropped += 1
+            except DBAPIError as e:
+                logger.warning(f"Lease partition {bucket} not dropped: {e}")
+                break
+        with self._lock:
+            self.dropped += dropped
+            if dropped:
+                self.last_drop_ms = (time.perf_counter() - start) * 1000
+        return dropped
+
+    async def prepare(self, min_horizon_seconds: float = 0) -> None:
+        """Create the partitions and give a lease to sessions without one.
+
+        Enough partitions are kept ahead to cover `min_horizon_seconds`,
+        whatever LEASE_PARTITIONS_AHEAD says.
+        """
+        if not enabled():
+            return
+        needed = math.ceil(min_horizon_seconds / LEASE_BUCKET_SECONDS)
+        if needed > LEASE_PARTITIONS_AHEAD:
+            logger.warning(
+                f"LEASE_PARTITIONS_AHEAD={LEASE_PARTITIONS_AHEAD} covers less "
+                f"than {min_horizon_seconds:g}s, creating {needed} partitions ahead"
+            )
+        self.ahead = max(LEASE_PARTITIONS_AHEAD, needed)
+        async with database.engine.begin() as conn:
+            await conn.execute(
+                text(
+                    f"CREATE TABLE IF NOT EXISTS {DEFAULT} PARTITION OF {PARENT} DEFAULT"
+                )
+            )
+        await self.create_ahead()
+        async with database.engine.begin() as conn:
+            result = await conn.execute(
+                text(
+                    f"INSERT INTO {PARENT} (session_id, bucket) "
+                    "SELECT s.session_id, :bucket FROM peer_sessions s "
+                    f"WHERE NOT EXISTS (SELECT 1 FROM {PARENT} l "
+                    "WHERE l.session_id = s.session_id) "
+                    "ON CONFLICT DO NOTHING"
+                ),
+                {"bucket": current_bucket()},
+            )
+        if result.rowcount:
+            logger.info(f"Gave a lease to {result.rowcount} existing peer sessions")
+
+    def create_interval(self) -> float:
+        """Seconds between two rounds of the partition loop"""
+        return max(1, self.ahead * LEASE_BUCKET_SECONDS / LEASE_CREATE_ROUNDS)
+
+    async def run(self) -> None:
+        """Background loop creating the partitions ahead until cancelled"""
+        if not enabled():
+            return
+        while True:
+            await asyncio.sleep(self.create_interval())
+            try:
+                await self.create_ahead()
+            except Exception as e:
+                logger.error(f"Lease partitions not created: {e}")
+
+    async def maintain(self, threshold_seconds: int) -> None:
+        """Run after an expiry cycle that removed all it could"""
+        if not enabled():
+            return
+        await self.drop_expired(threshold_seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": enabled(),
+                "bucket_seconds": LEASE_BUCKET_SECONDS,
+                "created": self.created,
+                "dropped": self.dropped,
+                "defaulted": self.defaulted,
+                "ahead": self.ahead,
+                "last_drop_ms": self.last_drop_ms,
+            }
+
+
+lease_partitions = LeasePartitions()
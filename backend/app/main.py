@@ -1,18 +1,42 @@
 import asyncio
 import logging
+import os
+import random
 import sys
 from contextlib import asynccontextmanager
 from datetime import timedelta
-from typing import Annotated, List, Tuple
+from typing import Annotated, AsyncIterator, List
 
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, HTTPException, Request, status
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    status,
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
+from pydantic import TypeAdapter
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
-
-from . import auth, crud, database, models, schemas, utils
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import auth, crud, database, encoding, metrics, replicas, schemas, utils
+from .db_metrics import db_metrics
+from .expiry import EXPIRY_INTERVAL_SECONDS, ExpiryWorker
+from .hashing import password_hasher
+from .heartbeat import heartbeat_registry, start_listener
+from .leases import lease_partitions, tables
+from .replication import replication_tracker
+from .search_cache import file_versions, search_cache
+from .search_index import text_query
+from .sharding import ShardedTrackerStore, ShardUnavailable, verify_shard_token
+from .store import tracker_store
+from .subscriptions import subscriptions
+from .suggest_index import suggest_index
 
 # Configure logging
 handlers = [
@@ -26,36 +50,103 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-
-async def cleanup_task():
-    """Background task to remove inactive peers periodically"""
-    while True:
-        try:
-            db = database.SessionLocal()
-            crud.remove_inactive_peers(db)
-            db.close()
-        except Exception as e:
-            logger.error(f"Error during cleanup: {e}")
-        await asyncio.sleep(60)  # Run every 60 seconds
+DEFAULT_SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 200
+DEFAULT_PEER_LIMIT = 10
+MAX_NDJSON_LINE_BYTES = 64 * 1024
+MAX_PEER_LIMIT = 100
+DEFAULT_SUGGEST_LIMIT = 10
+DEFAULT_HINT_LIMIT = 10
+MAX_HINT_LIMIT = 50
+MAX_SUGGEST_LIMIT = 20
+MAX_SUBSCRIBE_TERMS = 16  # queries plus hashes per subscription stream
+# Share of announces logged at INFO, 1 logs all of them and 0 none
+ANNOUNCE_LOG_SAMPLE_RATE = float(os.getenv("ANNOUNCE_LOG_SAMPLE_RATE", 1))
+
+expiry_worker = ExpiryWorker(tracker_store)
+# Changes are published on the node owning the file, a sharded entry node
+# never hears of them and would keep serving (and tagging) stale results
+cache_searches = not isinstance(tracker_store, ShardedTrackerStore)
+
+search_results_adapter = TypeAdapter(List[schemas.SearchResult])
+peers_adapter = TypeAdapter(List[schemas.PeerInfo])
+manifest_adapter = TypeAdapter(schemas.FileManifest)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Ensure all tables exist
     try:
-        database.Base.metadata.create_all(bind=database.engine)
+        async with database.engine.begin() as conn:
+            await conn.run_sync(database.Base.metadata.create_all, tables=tables())
         logger.info("Database tables verified/created successfully.")
     except Exception as e:
         logger.error(f"Database initialization failed: {e}")
 
-    # Start background task
-    task = asyncio.create_task(cleanup_task())
+    try:
+        # Partitions must outlast a few expiry cycles, the lease loop aside
+        await lease_partitions.prepare(2 * EXPIRY_INTERVAL_SECONDS)
+    except Exception as e:
+        logger.error(f"Lease partitions initialization failed: {e}")
+
+    try:
+        async with database.SessionLocal() as db:
+            await tracker_store.load(db)
+    except Exception as e:
+        logger.error(f"Tracker store initialization failed: {e}")
+
+    try:
+        async with database.SessionLocal() as db:
+            await suggest_index.load(tracker_store, db)
+    except Exception as e:
+        logger.error(f"Suggest index initialization failed: {e}")
+
+    # Spawn the hashing workers now rather than on the first login
+    password_hasher.start()
+
+    heartbeat_transport = None
+    try:
+        heartbeat_transport = await start_listener(heartbeat_registry)
+    except OSError as e:
+        logger.error(f"UDP heartbeat listener failed to start: {e}")
+
+    # Start background tasks
+    tasks = [
+        asyncio.create_task(expiry_worker.run()),
+        asyncio.create_task(lease_partitions.run()),
+        asyncio.create_task(heartbeat_registry.run(tracker_store)),
+        asyncio.create_task(suggest_index.run(tracker_store)),
+        asyncio.create_task(replicas.replica_set.run()),
+    ]
     yield
-    # Cancel background task on shutdown
-    task.cancel()
+    # Cancel background tasks on shutdown
+    for task in tasks:
+        task.cancel()
+    if heartbeat_transport is not None:
+        heartbeat_transport.close()
+    password_hasher.shutdown()
+    await tracker_store.close()
+    await replicas.replica_set.dispose()
+    await database.engine.dispose()
 
 
 app = FastAPI(lifespan=lifespan)
+# Request bodies may be compressed, set before any route is declared
+app.router.route_class = encoding.DecodingRoute
+
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.exception_handler(ShardUnavailable)
+async def shard_unavailable(request: Request, exc: ShardUnavailable):
+    """Announces and peer lookups needing an unreachable tracker node"""
+    logger.error(str(exc))
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Tracker temporarily unavailable, try again"},
+        headers={"Retry-After": "5"},
+    )
+
 
 app.add_middleware(
     CORSMiddleware,
@@ -67,6 +158,12 @@ app.add_middleware(
 load_dotenv()
 
 
+def log_announce(user_id: int, client_ip: str, port: int) -> None:
+    """Log a client coming online, sampled by ANNOUNCE_LOG_SAMPLE_RATE"""
+    if ANNOUNCE_LOG_SAMPLE_RATE >= 1 or random.random() < ANNOUNCE_LOG_SAMPLE_RATE:
+        logger.info(f"User {user_id} is online at {client_ip}:{port}")
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello! This is root for PeerShare server"}
@@ -75,18 +172,20 @@ async def root():
 @app.post(
     "/signup", response_model=schemas.TokenResponse, status_code=status.HTTP_201_CREATED
 )
-def signup(user_data: schemas.UserSignup, db: Session = Depends(database.get_db)):
+async def signup(
+    user_data: schemas.UserSignup, db: AsyncSession = Depends(database.get_db)
+):
     """Register a new user and return access token"""
 
     # Hash the password
-    password_hash = auth.get_password_hash(user_data.password)
+    password_hash = await auth.get_password_hash(user_data.password)
     user_create = schemas.UserCreate(
         username=user_data.username, password_hash=password_hash, email=user_data.email
     )
     try:
-        user = crud.create_user(db, user_create)
+        user = await crud.create_user(db, user_create)
     except IntegrityError as e:
-        db.rollback()
+        await db.rollback()
         error_msg = str(e.orig)  # Contains "Key (email)=(...) already exists."
         if "email" in error_msg:
             detail = "Email already registered"
@@ -95,20 +194,19 @@ def signup(user_data: schemas.UserSignup, db: Session = Depends(database.get_db)
 
         raise HTTPException(status_code=400, detail=detail)
 
-    access_token = auth.create_access_token(data={"sub": user.username})
-
     return {
-        "access_token": access_token,
-        "token_type": "bearer",
+        **auth.create_token_pair(user.username),
         "user": user,
         "status": "success",
     }
 
 
 @app.post("/login", response_model=schemas.TokenResponse)
-def login(credentials: schemas.UserLogin, db: Session = Depends(database.get_db)):
+async def login(
+    credentials: schemas.UserLogin, db: AsyncSession = Depends(replicas.get_read_db)
+):
     """Login and get access token"""
-    user = crud.get_user_by_username(db, credentials.username)
+    user = await auth.get_user(db, credentials.username)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -116,28 +214,31 @@ def login(credentials: schemas.UserLogin, db: Session = Depends(database.get_db)
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    if not auth.verify_password(credentials.password, user.password_hash):
+    if not await auth.verify_password(credentials.password, user.password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    access_token = auth.create_access_token({"sub": credentials.username})
+    return {**auth.create_token_pair(user.username), "user": user}
 
-    return {
-        "access_token": access_token,
-        "token_type": "bearer",
-        "user": user,
-    }
+
+@app.post("/token/refresh", response_model=schemas.TokenPair)
+async def refresh_token(
+    body: schemas.TokenRefresh, db: AsyncSession = Depends(replicas.get_read_db)
+):
+    """Exchange a refresh token for a new token pair without a password"""
+    user = await auth.refresh_user(body.refresh_token, db)
+    return auth.create_token_pair(user.username)
 
 
 @app.post("/announce")
-def announce_files(
+async def announce_files(
     payload: schemas.FileAnnounce,  # handles JSON body
     request: Request,  # gets IP address of the client
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(database.get_db),
+    current_user: schemas.CurrentUser = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(database.get_db),
 ):
     """Clients announces the files they have to the server"""
     # Authorization Check
@@ -151,20 +252,135 @@ def announce_files(
     client_ip = (
         payload.ip_address if payload.ip_address else utils.get_client_ip(request)
     )
-    logger.info(f"User {payload.user_id} is online at {client_ip}:{payload.port}")
+    log_announce(payload.user_id, client_ip, payload.port)
 
     # announce the files to the server and update db
-    count = crud.upsert_file_announcement(db, payload, client_ip)
+    result = await tracker_store.upsert_file_announcement(
+        db, payload, client_ip, public_ip=utils.get_client_ip(request)
+    )
+    metrics.announce_files.observe(result.announced, ("full",))
+
+    return {
+        "status": "success",
+        "announced": result.announced,
+        "version": result.version,
+        "heartbeat": heartbeat_registry.register(
+            payload.user_id, client_ip, payload.port
+        ),
+    }
 
-    return {"status": "success", "announced": count}
+
+async def ndjson_files(lines: AsyncIterator[tuple[int, bytes]]):
+    """File records of a streamed announce, a bad one fails it with 422"""
+    try:
+        async for line_no, line in lines:
+            try:
+                yield schemas.FileBase.model_validate_json(line)
+            except ValueError as e:
+                raise HTTPException(
+                    status_code=422,
+                    detail=f"Invalid file record on line {line_no}: {e}",
+                )
+    except ValueError as e:  # line too long
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.post("/announce/stream")
+async def announce_file_stream(
+    request: Request,
+    current_user: schemas.CurrentUser = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(database.get_db),
+):
+    """Full announce of a large library, streamed as NDJSON.
+
+    The first line is the announce header (user_id, port, ...), every
+    following line one file. Records are validated and stored as they
+    arrive, so the body is never held in memory at once.
+    """
+    lines = utils.iter_ndjson(request.stream(), MAX_NDJSON_LINE_BYTES)
+    try:
+        _, first_line = await anext(lines)
+        header = schemas.AnnounceStreamHeader.model_validate_json(first_line)
+    except StopAsyncIteration:
+        raise HTTPException(status_code=400, detail="Empty announce")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid announce header: {e}")
+
+    if header.user_id != current_user.user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to announce for this user",
+        )
+
+    client_ip = header.ip_address if header.ip_address else utils.get_client_ip(request)
+    log_announce(header.user_id, client_ip, header.port)
+
+    result = await tracker_store.stream_file_announcement(
+        db,
+        header,
+        ndjson_files(lines),
+        client_ip,
+        public_ip=utils.get_client_ip(request),
+    )
+    metrics.announce_files.observe(result.announced, ("stream",))
+
+    return {
+        "status": "success",
+        "announced": result.announced,
+        "version": result.version,
+        "heartbeat": heartbeat_registry.register(
+            header.user_id, client_ip, header.port
+        ),
+    }
+
+
+@app.post("/announce/delta")
+async def announce_file_delta(
+    payload: schemas.FileAnnounceDelta,
+    request: Request,
+    current_user: schemas.CurrentUser = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(database.get_db),
+):
+    """Clients announce only the files added/removed since their last announce"""
+    if payload.user_id != current_user.user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to announce for this user",
+        )
+
+    client_ip = (
+        payload.ip_address if payload.ip_address else utils.get_client_ip(request)
+    )
+
+    result = await tracker_store.apply_file_delta(
+        db, payload, client_ip, public_ip=utils.get_client_ip(request)
+    )
+    if result is None:
+        # The client has to fall back to a full announce to resync
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Library version mismatch, full announce required",
+        )
+    metrics.announce_files.observe(
+        len(payload.added) + len(payload.removed), ("delta",)
+    )
+
+    return {
+        "status": "success",
+        "announced": result.announced,
+        "version": result.version,
+        "heartbeat": heartbeat_registry.register(
+            payload.user_id, client_ip, payload.port
+        ),
+    }
 
 
 @app.post("/ping")
-def peer_ping(
+async def peer_ping(
     payload: schemas.PeerPing,
     request: Request,
-    current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(database.get_db),
+    current_user: schemas.CurrentUser = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(database.get_db),
 ):
     """used to know if the peer is active or not"""
 
@@ -172,7 +388,9 @@ def peer_ping(
         payload.ip_address if payload.ip_address else utils.get_client_ip(request)
     )
     # Update the last hartbeat of the user if still active
-    rows = crud.update_last_heartbeat(db, current_user.user_id, client_ip, payload.port)
+    rows = await tracker_store.update_last_heartbeat(
+        db, current_user.user_id, client_ip, payload.port, load=payload.load
+    )
 
     if rows == 0:
         return {
@@ -180,49 +398,279 @@ def peer_ping(
             "message": "No active sessions found for this user",
         }
 
-    return {"status": "success"}
+    # Clients falling back to HTTP get a fresh UDP channel to try again with
+    return {
+        "status": "success",
+        "heartbeat": heartbeat_registry.register(
+            current_user.user_id, client_ip, payload.port
+        ),
+    }
 
 
 @app.get("/search", response_model=List[schemas.SearchResult])
-def search_files(q: str, db: Session = Depends(database.get_db)):
-    """search for the files"""
-
-    # Search database for the required files
-    results: List[Tuple[models.File, models.ActivePeer, models.User]] = (
-        crud.search_files(db, q)
-    )
-
-    grouped_files = {}
-
-    for file_obj, peer_obj, user_obj in results:
-        if file_obj.file_hash not in grouped_files:
-            grouped_files[file_obj.file_hash] = {
-                "file_name": file_obj.file_name,
-                "file_hash": file_obj.file_hash,
-                "file_size": file_obj.file_size,
-                "peers": [],
-            }
-
-        grouped_files[file_obj.file_hash]["peers"].append(
-            {
-                "user_id": peer_obj.user_id,
-                "ip_address": peer_obj.ip_address,
-                "port": peer_obj.port,
-                "public_url": peer_obj.public_url,
-                "username": user_obj.username,
-                "last_heartbeat": peer_obj.last_heartbeat,
-            }
+async def search_files(
+    q: str,
+    request: Request,
+    limit: Annotated[int, Query(ge=1, le=MAX_SEARCH_LIMIT)] = DEFAULT_SEARCH_LIMIT,
+    cursor: str | None = None,
+    min_size: Annotated[int | None, Query(ge=0)] = None,
+    max_size: Annotated[int | None, Query(ge=0)] = None,
+    ext: Annotated[str | None, Query(max_length=16)] = None,
+    mode: schemas.SearchMode = "fuzzy",
+    db: AsyncSession = Depends(replicas.get_read_db),
+):
+    """search for the files, best matches first.
+
+    `fuzzy` ranks names by trigram similarity to the query, `text` finds
+    names containing every word of the query in any order (the last one
+    as a prefix) and ranks them by relevance and number of peers.
+
+    When more results are available the `X-Next-Cursor` response header
+    holds the cursor to pass for the next page. Sent as msgpack to clients
+    accepting it, and compressed when large.
+
+    Results carry an `ETag` that changes with the files listed and their
+    peers, clients sending it back in `If-None-Match` get `304 Not
+    Modified` while it is current. Sharded trackers neither cache nor tag
+    results.
+    """
+    try:
+        after = utils.decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    extension = ext.lstrip(".").lower() if ext else None
+    cache_key = search_cache.make_key(
+        q, limit, after, min_size, max_size, extension, mode
+    )
+
+    # Stored by clients, but revalidated with If-None-Match every time
+    headers = {"Cache-Control": "no-cache"}
+
+    # Search the index for the required files, grouped per file
+    cached = search_cache.get(cache_key) if cache_searches else None
+    if cached is not None:
+        results, etag = cached
+    else:
+        etag = None
+        since = file_versions.seq
+        results = await tracker_store.search_files(
+            db,
+            q,
+            limit=limit,
+            cursor=after,
+            min_size=min_size,
+            max_size=max_size,
+            extension=extension,
+            mode=mode,
         )
+        if cache_searches:
+            etag = file_versions.etag(cache_key, results, since)
+        # A replica may not have replayed the changes `since` covers yet,
+        # its results would be kept (and their tag) long after it catches up
+        if etag is not None and not replicas.is_replica(db):
+            search_cache.put(cache_key, results, etag)
+    metrics.search_results.observe(len(results))
+    replication_tracker.record_search(results)
+
+    if len(results) == limit:
+        last = results[-1]
+        headers["X-Next-Cursor"] = utils.encode_cursor(
+            last.score or 0.0, last.file_hash
+        )
+
+    return encoding.encode_response(
+        request, results, search_results_adapter, headers, etag
+    )
+
+
+@app.get("/suggest", response_model=List[schemas.Suggestion])
+async def suggest(
+    prefix: Annotated[str, Query(max_length=255)],
+    limit: Annotated[int, Query(ge=1, le=MAX_SUGGEST_LIMIT)] = DEFAULT_SUGGEST_LIMIT,
+):
+    """Completions of the last word being typed, for search-as-you-type.
+
+    Served from an in-memory token index weighted by peer count, the
+    database is not queried.
+    """
+    return suggest_index.suggest(prefix, limit)
+
 
-    return list(grouped_files.values())
+@app.get("/subscribe")
+async def subscribe(
+    q: Annotated[List[Annotated[str, Query(max_length=255)]], Query()] = [],
+    hash: Annotated[
+        List[Annotated[str, Query(pattern=r"^[0-9a-fA-F]{64}$")]], Query()
+    ] = [],
+):
+    """Server-Sent Events stream of files announced for queries or hashes.
+
+    A `file` event is sent whenever a file gains a peer and either its hash
+    is one of `hash` or its name matches one of `q` the way `mode=text`
+    searches do. Events carry the file and the subscriptions it matched,
+    peers are fetched from `/files/{hash}/peers`. Nothing is replayed, so
+    clients search once when (re)connecting, and again after an `overflow`
+    event.
+    """
+    queries = [query for query in q if text_query(query) != ([], None)]
+    if len(queries) < len(q):
+        raise HTTPException(status_code=400, detail="Query without any word")
+    if not q and not hash:
+        raise HTTPException(status_code=400, detail="Nothing to subscribe to")
+    if len(q) + len(hash) > MAX_SUBSCRIBE_TERMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_SUBSCRIBE_TERMS} queries and hashes per stream",
+        )
+
+    stream = subscriptions.open(queries, list({h.lower(): None for h in hash}))
+    if stream is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many subscriptions, try again later",
+        )
+    return StreamingResponse(
+        subscriptions.sse(stream),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/files/{file_hash}/peers", response_model=List[schemas.PeerInfo])
+async def get_file_peers(
+    file_hash: Annotated[str, Path(pattern=r"^[0-9a-fA-F]{64}$")],
+    request: Request,
+    limit: Annotated[int, Query(ge=1, le=MAX_PEER_LIMIT)] = DEFAULT_PEER_LIMIT,
+    db: AsyncSession = Depends(database.get_db),
+):
+    """Peers sharing a file, the ones closest to the requester first.
+
+    Peers behind the same public address come first, then the ones in the
+    same subnet, each ordered by reported load and heartbeat freshness.
+    """
+    peers = await tracker_store.get_file_peers(db, file_hash.lower())
+    replication_tracker.record_lookup(file_hash.lower(), len(peers))
+    if not peers:
+        raise HTTPException(status_code=404, detail="No peers found for this file")
+    ranked = utils.rank_peers(peers, utils.get_client_ip(request), limit)
+    return encoding.encode_response(request, ranked, peers_adapter)
+
+
+@app.get("/replication/hints", response_model=List[schemas.ReplicationHint])
+async def replication_hints(
+    current_user: schemas.CurrentUser = Depends(auth.get_current_active_user),
+    limit: Annotated[int, Query(ge=1, le=MAX_HINT_LIMIT)] = DEFAULT_HINT_LIMIT,
+    max_size: Annotated[int | None, Query(ge=0)] = None,
+    db: AsyncSession = Depends(database.get_db),
+):
+    """Files in demand with few online peers, for clients volunteering disk.
+
+    Most wanted per online peer first, without the files the user already
+    shares. `max_size` leaves out files larger than the space the client
+    has left to seed with.
+    """
+    return await replication_tracker.hints(
+        tracker_store, db, current_user.user_id, limit, max_size
+    )
+
+
+@app.post("/manifests")
+async def publish_manifests(
+    body: schemas.ManifestBatch,
+    current_user: schemas.CurrentUser = Depends(auth.get_current_active_user),
+    db: AsyncSession = Depends(database.get_db),
+) -> schemas.ManifestResult:
+    """Register the piece manifests of files the client announced.
+
+    Only manifests of files the user currently shares are accepted. The
+    first manifest registered for a file is kept, others are rejected.
+    """
+    shared_hashes = await tracker_store.files_shared_by(
+        db,
+        current_user.user_id,
+        [manifest.file_hash for manifest in body.manifests],
+    )
+    shared, rejected = [], []
+    for manifest in body.manifests:
+        if manifest.file_hash in shared_hashes:
+            shared.append(manifest)
+        else:
+            rejected.append(manifest.file_hash)
+    stored, conflicts = await crud.add_file_manifests(db, shared)
+    return schemas.ManifestResult(stored=stored, rejected=rejected + conflicts)
+
+
+@app.get("/files/{file_hash}/manifest", response_model=schemas.FileManifest)
+async def get_file_manifest(
+    file_hash: Annotated[str, Path(pattern=r"^[0-9a-fA-F]{64}$")],
+    request: Request,
+    db: AsyncSession = Depends(replicas.get_read_db),
+):
+    """Piece size, piece hashes and Merkle root of a file, to verify it by piece"""
+    manifest = await crud.get_file_manifest(db, file_hash.lower())
+    if manifest is None and replicas.is_replica(db):
+        # Published moments ago and not replicated yet
+        async with database.SessionLocal() as primary:
+            manifest = await crud.get_file_manifest(primary, file_hash.lower())
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="No manifest for this file")
+    return encoding.encode_response(
+        request,
+        # Checked when it was published
+        schemas.FileManifest.model_construct(
+            file_hash=manifest.file_hash,
+            file_size=manifest.file_size,
+            piece_size=manifest.piece_size,
+            merkle_root=manifest.merkle_root.hex(),
+            pieces=manifest.pieces,
+        ),
+        manifest_adapter,
+    )
+
+
+@app.get("/stats", dependencies=[Depends(auth.verify_monitoring_access)])
+async def tracker_stats():
+    """Counters of the tracker's in-process caches, database pool and expiry"""
+    return {
+        "search_cache": search_cache.stats(),
+        "file_versions": file_versions.stats(),
+        "database": db_metrics.stats(database.engine.pool),
+        "expiry": expiry_worker.stats(),
+        "leases": lease_partitions.stats(),
+        "replicas": replicas.replica_set.stats(),
+        "replication": replication_tracker.stats(),
+        "heartbeat": heartbeat_registry.stats(),
+        "password_hashing": password_hasher.stats(),
+        "suggest": suggest_index.stats(),
+        "subscriptions": subscriptions.stats(),
+        "shards": (
+            tracker_store.stats()
+            if isinstance(tracker_store, ShardedTrackerStore)
+            else None
+        ),
+    }
+
+
+@app.get(
+    "/metrics",
+    response_class=PlainTextResponse,
+    dependencies=[Depends(auth.verify_monitoring_access)],
+)
+async def tracker_metrics(db: AsyncSession = Depends(database.get_db)):
+    """Request, database and index metrics in the Prometheus text format"""
+    metrics.active_sessions.set(await tracker_store.count_sessions(db))
+    return PlainTextResponse(
+        metrics.registry.render(), media_type="text/plain; version=0.0.4"
+    )
 
 
 @app.get("/token")
-def login_for_access_token(
+async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(replicas.get_read_db),
 ) -> schemas.Token:
-    user = auth.authenticate_user(form_data.username, form_data.password, db)
+    user = await auth.authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -237,7 +685,135 @@ def login_for_access_token(
 
 
 @app.get("/users/me", response_model=schemas.User)
-def read_users_me(
+async def read_users_me(
     current_user: Annotated[schemas.User, Depends(auth.get_current_active_user)],
 ):
     return current_user
+
+
+@app.delete("/users/me", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_users_me(
+    current_user: Annotated[schemas.CurrentUser, Depends(auth.get_current_active_user)],
+    db: AsyncSession = Depends(database.get_db),
+):
+    """Delete the current user along with their sessions.
+
+    Other tracker processes may still accept the user's tokens for up to
+    AUTH_CACHE_TTL_SECONDS, until their token cache entries expire.
+    """
+    # Sessions first, through the store so their files are published as gone
+    await tracker_store.remove_user_sessions(db, current_user.user_id)
+    await crud.delete_user(db, current_user.user_id)
+    # Tokens of the user must stop resolving right away, in this process
+    auth.token_cache.invalidate_user(current_user.user_id)
+
+
+# --- Routes only other tracker nodes call, see sharding.ShardedTrackerStore ---
+# They apply to this node's own part of the index, never forwarded again
+
+
+@app.post("/shard/announce", dependencies=[Depends(verify_shard_token)])
+async def shard_announce(
+    body: schemas.ShardAnnounce, db: AsyncSession = Depends(database.get_db)
+) -> schemas.AnnounceResult:
+    result = await tracker_store.local.upsert_file_announcement(
+        db, body.announce, body.client_ip, body.public_ip
+    )
+    return schemas.AnnounceResult(announced=result.announced, version=result.version)
+
+
+@app.post("/shard/announce/stream", dependencies=[Depends(verify_shard_token)])
+async def shard_announce_stream(
+    request: Request, db: AsyncSession = Depends(database.get_db)
+) -> schemas.AnnounceResult:
+    lines = utils.iter_ndjson(request.stream(), MAX_NDJSON_LINE_BYTES)
+    try:
+        _, first_line = await anext(lines)
+        body = schemas.ShardAnnounceStream.model_validate_json(first_line)
+    except (StopAsyncIteration, ValueError):
+        raise HTTPException(status_code=422, detail="Invalid announce header")
+    result = await tracker_store.local.stream_file_announcement(
+        db, body.header, ndjson_files(lines), body.client_ip, body.public_ip
+    )
+    return schemas.AnnounceResult(announced=result.announced, version=result.version)
+
+
+@app.post("/shard/announce/delta", dependencies=[Depends(verify_shard_token)])
+async def shard_announce_delta(
+    body: schemas.ShardAnnounceDelta, db: AsyncSession = Depends(database.get_db)
+) -> schemas.AnnounceResult:
+    result = await tracker_store.local.apply_file_delta(
+        db, body.delta, body.client_ip, body.public_ip
+    )
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Library version mismatch, full announce required",
+        )
+    return schemas.AnnounceResult(announced=result.announced, version=result.version)
+
+
+@app.post("/shard/heartbeats", dependencies=[Depends(verify_shard_token)])
+async def shard_heartbeats(
+    body: schemas.ShardHeartbeats, db: AsyncSession = Depends(database.get_db)
+):
+    if body.load is not None:
+        user_id, ip_address, port = body.sessions[0]
+        updated = await tracker_store.local.update_last_heartbeat(
+            db, user_id, ip_address, port, body.load
+        )
+    else:
+        updated = await tracker_store.local.update_last_heartbeats(db, body.sessions)
+    return {"updated": updated}
+
+
+@app.post("/shard/users/sessions", dependencies=[Depends(verify_shard_token)])
+async def shard_remove_user_sessions(
+    body: schemas.ShardUserSessions, db: AsyncSession = Depends(database.get_db)
+):
+    result = await tracker_store.local.remove_user_sessions(db, body.user_id)
+    return {"removed": result.expired}
+
+
+@app.post(
+    "/shard/search",
+    response_model=List[schemas.SearchResult],
+    dependencies=[Depends(verify_shard_token)],
+)
+async def shard_search(
+    body: schemas.ShardSearch, db: AsyncSession = Depends(database.get_db)
+):
+    return await tracker_store.local.search_files(db, **body.model_dump())
+
+
+@app.post("/shard/files/peer-counts", dependencies=[Depends(verify_shard_token)])
+async def shard_file_peer_counts(
+    body: schemas.ShardFiles, db: AsyncSession = Depends(database.get_db)
+):
+    return {"peers": await tracker_store.local.count_file_peers(db, body.file_hashes)}
+
+
+@app.post("/shard/files/shared", dependencies=[Depends(verify_shard_token)])
+async def shard_files_shared(
+    body: schemas.ShardSharedFiles, db: AsyncSession = Depends(database.get_db)
+):
+    shared = await tracker_store.local.files_shared_by(
+        db, body.user_id, body.file_hashes
+    )
+    return {"shared": sorted(shared)}
+
+
+@app.get(
+    "/shard/files/{file_hash}/peers",
+    response_model=List[schemas.ShardPeerInfo],
+    dependencies=[Depends(verify_shard_token)],
+)
+async def shard_file_peers(
+    file_hash: Annotated[str, Path(pattern=r"^[0-9a-fA-F]{64}$")],
+    db: AsyncSession = Depends(database.get_db),
+):
+    peers = await tracker_store.local.get_file_peers(db, file_hash.lower())
+    return [
+        schemas.ShardPeerInfo(**peer.model_dump(), public_ip=peer.public_ip)
+        for peer in peers
+    ]
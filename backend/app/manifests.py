@@ -0,0 +1,53 @@
+import hashlib
+
+# Piece sizes are powers of two within these bounds, the client picks the
+# smallest one (1 MiB at least) keeping a file within MAX_MANIFEST_PIECES
+MIN_PIECE_SIZE = 16 * 1024
+MAX_PIECE_SIZE = 1024**3
+MAX_MANIFEST_PIECES = 8192
+DIGEST_SIZE = 32  # SHA-256
+
+
+def piece_count(file_size: int, piece_size: int) -> int:
+    """Pieces of a file, the last one may be short. An empty file has none"""
+    return -(-file_size // piece_size)
+
+
+def merkle_root(digests: list[bytes]) -> bytes:
+    """Root of the binary SHA-256 tree over the piece digests.
+
+    Each parent is the hash of its two children concatenated, a node left
+    without a sibling moves up a level as it is. The root of a single piece
+    is its digest, the one of an empty file the hash of nothing.
+    """
+    if not digests:
+        return hashlib.sha256().digest()
+    level = digests
+    while len(level) > 1:
+        parents = [
+            hashlib.sha256(level[i] + level[i + 1]).digest()
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+def check_manifest(file_size: int, piece_size: int, root: str, pieces: bytes) -> None:
+    """Raise ValueError unless the pieces fit the file and hash to the root"""
+    if not MIN_PIECE_SIZE <= piece_size <= MAX_PIECE_SIZE or (
+        piece_size & (piece_size - 1)
+    ):
+        raise ValueError(
+            f"Piece size must be a power of two from {MIN_PIECE_SIZE} "
+            f"to {MAX_PIECE_SIZE} bytes"
+        )
+    count = piece_count(file_size, piece_size)
+    if count > MAX_MANIFEST_PIECES:
+        raise ValueError(f"More than {MAX_MANIFEST_PIECES} pieces, use larger ones")
+    if len(pieces) != count * DIGEST_SIZE:
+        raise ValueError(f"Expected {count} piece hashes for the file size")
+    digests = [pieces[i : i + DIGEST_SIZE] for i in range(0, len(pieces), DIGEST_SIZE)]
+    if merkle_root(digests).hex() != root.lower():
+        raise ValueError("Merkle root does not match the piece hashes")
@@ -0,0 +1,606 @@
+import heapq
+import itertools
+import logging
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, schemas
+from .search_index import (
+    SIMILARITY_THRESHOLD,
+    TokenIndex,
+    TrigramIndex,
+    similarity,
+    text_query,
+    text_score,
+    trigrams,
+)
+from .store import TrackerStore
+
+logger = logging.getLogger(__name__)
+
+SessionKey = tuple[int, str, int]  # (user_id, ip_address, port)
+# Files of a streamed announce applied, and changes published, at once
+STREAM_CHUNK_SIZE = 5000
+
+
+def _as_real(value: float) -> float:
+    """Round a score to single precision, like Postgres REAL"""
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+
+class _FileEntry:
+    __slots__ = ("file_hash", "file_name", "file_size", "holders")
+
+    def __init__(self, file_hash: str, file_name: str, file_size: int):
+        self.file_hash = file_hash
+        self.file_name = file_name
+        self.file_size = file_size
+        self.holders: set[SessionKey] = set()
+
+
+class _Session:
+    __slots__ = (
+        "session_id",
+        "user_id",
+        "username",
+        "ip_address",
+        "port",
+        "public_url",
+        "public_ip",
+        "load",
+        "library_version",
+        "last_seen",
+        "files",
+    )
+
+    def __init__(
+        self, session_id: int, user_id: int, username: str, ip_address: str, port: int
+    ):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.username = username
+        self.ip_address = ip_address
+        self.port = port
+        self.public_url: str | None = None
+        self.public_ip: str | None = None
+        self.load: int | None = None
+        self.library_version = 0
+        self.last_seen = time.time()
+        self.files: set[str] = set()
+
+    @property
+    def key(self) -> SessionKey:
+        return (self.user_id, self.ip_address, self.port)
+
+    def peer_info(self) -> schemas.PeerInfo:
+        return schemas.PeerInfo(
+            user_id=self.user_id,
+            ip_address=self.ip_address,
+            port=self.port,
+            public_url=self.public_url,
+            username=self.username,
+            last_heartbeat=datetime.fromtimestamp(self.last_seen, timezone.utc),
+            load=self.load,
+            public_ip=self.public_ip,
+        )
+
+
+class MemoryTrackerStore(TrackerStore):
+    """Keeps the file/peer index in process memory.
+
+    Files and sessions live in hash maps, file names in trigram and token
+    inverted indexes and session leases in a heap ordered by last heartbeat. With
+    `write_through` every change is applied to Postgres first, memory only
+    follows once it succeeded, and the index is rebuilt from it on startup.
+    """
+
+    def __init__(self, write_through: bool = False):
+        self.write_through = write_through
+        self._lock = threading.RLock()
+        self._files: dict[str, _FileEntry] = {}
+        self._sessions: dict[SessionKey, _Session] = {}
+        self._names = TrigramIndex()
+        self._tokens = TokenIndex()
+        # (last_seen when pushed, session_id, key), one entry per session
+        self._leases: list[tuple[float, int, SessionKey]] = []
+        self._session_ids = itertools.count(1)
+        self._usernames: dict[int, str] = {}
+
+    async def load(self, db: AsyncSession) -> None:
+        """Rebuild the index from Postgres when writing through"""
+        if not self.write_through:
+            return
+
+        max_session_id = 0
+        # The lock is only held per row, never across an await
+        async for row in crud.get_session_files(db):
+            with self._lock:
+                key = (row.user_id, row.ip_address, row.port)
+                session = self._sessions.get(key)
+                if session is None:
+                    session = _Session(
+                        row.session_id,
+                        row.user_id,
+                        row.username,
+                        row.ip_address,
+                        row.port,
+                    )
+                    session.public_url = row.public_url
+                    session.public_ip = row.public_ip
+                    session.load = row.load
+                    session.library_version = row.library_version
+                    session.last_seen = row.last_heartbeat.timestamp()
+                    self._sessions[key] = session
+                    self._usernames[row.user_id] = row.username
+                    heapq.heappush(
+                        self._leases, (session.last_seen, session.session_id, key)
+                    )
+                    max_session_id = max(max_session_id, row.session_id)
+                if row.file_hash is not None:
+                    self._map(
+                        session,
+                        [
+                            schemas.FileBase.model_construct(
+                                file_hash=row.file_hash,
+                                file_name=row.file_name,
+                                file_size=row.file_size,
+                            )
+                        ],
+                    )
+        with self._lock:
+            self._session_ids = itertools.count(max_session_id + 1)
+
+        logger.info(
+            f"Loaded {len(self._sessions)} sessions and "
+            f"{len(self._files)} files into the memory store"
+        )
+
+    async def _username(self, db: AsyncSession, user_id: int) -> str:
+        username = self._usernames.get(user_id)
+        if username is None:
+            user = await crud.get_user(db, user_id)
+            username = user.username if user else ""
+            self._usernames[user_id] = username
+        return username
+
+    def _get_or_create_session(
+        self, user_id: int, username: str, client_ip: str, port: int
+    ) -> _Session:
+        key = (user_id, client_ip, port)
+        session = self._sessions.get(key)
+        if session is None:
+            session = _Session(
+                next(self._session_ids), user_id, username, client_ip, port
+            )
+            self._sessions[key] = session
+            heapq.heappush(self._leases, (session.last_seen, session.session_id, key))
+        return session
+
+    def _map(self, session: _Session, files: list[schemas.FileBase]) -> None:
+        for file in files:
+            entry = self._files.get(file.file_hash)
+            if entry is None:
+                entry = _FileEntry(file.file_hash, file.file_name, file.file_size)
+                self._files[file.file_hash] = entry
+                self._names.add(file.file_hash, file.file_name)
+                self._tokens.add(file.file_hash, file.file_name)
+            entry.holders.add(session.key)
+            session.files.add(file.file_hash)
+
+    def _unmap(self, session: _Session, file_hashes: list[str]) -> None:
+        for file_hash in file_hashes:
+            session.files.discard(file_hash)
+            entry = self._files.get(file_hash)
+            if entry is None:
+                continue
+            entry.holders.discard(session.key)
+            # Files nobody shares can't show up in searches, forget them
+            if not entry.holders:
+                del self._files[file_hash]
+                self._names.remove(file_hash, entry.file_name)
+                self._tokens.remove(file_hash)
+
+    async def _resync(
+        self,
+        db,
+        payload: schemas.FileAnnounce | schemas.AnnounceStreamHeader,
+        announced: dict[str, schemas.FileBase],
+        client_ip: str,
+        public_ip: str | None,
+    ) -> tuple[list[schemas.FileBase], list[str]]:
+        """Replace the library of a session, returns the added and removed files"""
+        username = await self._username(db, payload.user_id)
+
+        with self._lock:
+            session = self._get_or_create_session(
+                payload.user_id, username, client_ip, payload.port
+            )
+            session.public_url = payload.public_url
+            session.public_ip = public_ip
+            session.library_version = payload.version
+            session.last_seen = time.time()
+
+            removed = [h for h in session.files if h not in announced]
+            added = [f for h, f in announced.items() if h not in session.files]
+
+            self._unmap(session, removed)
+            self._map(session, added)
+        return added, removed
+
+    async def _upsert_file_announcement(self, db, payload, client_ip, public_ip):
+        if self.write_through:
+            await crud.upsert_file_announcement(db, payload, client_ip, public_ip)
+
+        announced = {file.file_hash: file for file in payload.files}
+        added, removed = await self._resync(
+            db, payload, announced, client_ip, public_ip
+        )
+        return schemas.AnnounceResult(
+            announced=len(announced),
+            version=payload.version,
+            added=added,
+            removed=removed,
+        )
+
+    async def _stream_file_announcement(
+        self, db, header, files, client_ip, public_ip, on_change
+    ):
+        username = await self._username(db, header.user_id)
+        if self.write_through:
+            # Postgres diffs the library, memory follows the changes it
+            # reports once committed
+            def apply(added, removed):
+                with self._lock:
+                    session = self._get_or_create_session(
+                        header.user_id, username, client_ip, header.port
+                    )
+                    added = [f for f in added if f.file_hash not in session.files]
+                    removed = [h for h in removed if h in session.files]
+                    self._unmap(session, removed)
+                    self._map(session, added)
+                on_change(added, removed)
+
+            result = await crud.stream_file_announcement(
+                db, header, files, client_ip, public_ip, on_change=apply
+            )
+            announced = result.announced
+        else:
+            announced = await self._stream_library(
+                header, username, files, client_ip, on_change
+            )
+
+        with self._lock:
+            session = self._get_or_create_session(
+                header.user_id, username, client_ip, header.port
+            )
+            session.public_url = header.public_url
+            session.public_ip = public_ip
+            session.library_version = header.version
+            session.last_seen = time.time()
+        return schemas.AnnounceResult(announced=announced, version=header.version)
+
+    async def _stream_library(
+        self,
+        header: schemas.AnnounceStreamHeader,
+        username: str,
+        files,
+        client_ip: str,
+        on_change,
+    ) -> int:
+        """Replace the library of a session with a stream, in chunks.
+
+        Only the hashes seen are kept, not the records. Files are mapped as
+        their chunk arrives but published once the stream ended, a bad
+        record unmaps them again and leaves the session as it was.
+        """
+        key = (header.user_id, client_ip, header.port)
+        with self._lock:
+            existed = key in self._sessions
+        seen: set[str] = set()
+        added: list[str] = []
+
+        def apply(chunk: list[schemas.FileBase]) -> None:
+            with self._lock:
+                session = self._get_or_create_session(
+                    header.user_id, username, client_ip, header.port
+                )
+                # Renewed so the session can't expire while it streams
+                session.last_seen = time.time()
+                new = {
+                    f.file_hash: f
+                    for f in chunk
+                    if f.file_hash not in seen and f.file_hash not in session.files
+                }
+                self._map(session, list(new.values()))
+                added.extend(new)
+                # Hashes the index holds anyway, not the copies just parsed
+                seen.update(self._files[f.file_hash].file_hash for f in chunk)
+
+        chunk: list[schemas.FileBase] = []
+        try:
+            async for file in files:
+                chunk.append(file)
+                if len(chunk) == STREAM_CHUNK_SIZE:
+                    apply(chunk)
+                    chunk = []
+            apply(chunk)
+        except BaseException:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is not None:
+                    self._unmap(session, added)
+                    # Its lease heap entry is skipped once the session is gone
+                    if not existed and not session.files:
+                        del self._sessions[key]
+            raise
+
+        with self._lock:
+            session = self._sessions[key]
+            removed = [h for h in session.files if h not in seen]
+            self._unmap(session, removed)
+        on_change([], removed)
+        for start in range(0, len(added), STREAM_CHUNK_SIZE):
+            with self._lock:
+                entries = [
+                    self._files.get(h) for h in added[start : start + STREAM_CHUNK_SIZE]
+                ]
+            on_change(
+                [
+                    schemas.FileBase.model_construct(
+                        file_hash=entry.file_hash,
+                        file_name=entry.file_name,
+                        file_size=entry.file_size,
+                    )
+                    for entry in entries
+                    if entry is not None
+                ],
+                [],
+            )
+        return len(seen)
+
+    def _delta_applies(self, payload, client_ip) -> bool:
+        session = self._sessions.get((payload.user_id, client_ip, payload.port))
+        return session is not None and session.library_version == payload.base_version
+
+    async def _apply_file_delta(self, db, payload, client_ip, public_ip):
+        with self._lock:
+            if not self._delta_applies(payload, client_ip):
+                return None
+
+        if (
+            self.write_through
+            and await crud.apply_file_delta(db, payload, client_ip, public_ip) is None
+        ):
+            logger.warning(
+                f"Postgres diverged from memory for user {payload.user_id}, "
+                "it will be fixed by the next full announce"
+            )
+
+        with self._lock:
+            # Checked again, another announce may have come in meanwhile
+            if not self._delta_applies(payload, client_ip):
+                return None
+            session = self._sessions[(payload.user_id, client_ip, payload.port)]
+
+            added = list({file.file_hash: file for file in payload.added}.values())
+            added_hashes = {file.file_hash for file in added}
+            removed = [
+                h
+                for h in dict.fromkeys(payload.removed)
+                if h not in added_hashes and h in session.files
+            ]
+            added = [file for file in added if file.file_hash not in session.files]
+
+            self._unmap(session, removed)
+            self._map(session, added)
+            session.library_version = payload.version
+            session.public_url = payload.public_url
+            session.public_ip = public_ip
+            session.last_seen = time.time()
+            count = len(session.files)
+
+        return schemas.AnnounceResult(
+            announced=count,
+            version=payload.version,
+            added=added,
+            removed=removed,
+        )
+
+    async def update_last_heartbeat(self, db, user_id, ip_address, port, load=None):
+        if self.write_through:
+            await crud.update_last_heartbeat(db, user_id, ip_address, port, load)
+
+        with self._lock:
+            session = self._sessions.get((user_id, ip_address, port))
+            if session is None:
+                return 0
+            # The lease heap is fixed up lazily when the old entry is popped
+            session.last_seen = time.time()
+            if load is not None:
+                session.load = load
+        return 1
+
+    async def update_last_heartbeats(self, db, sessions):
+        if self.write_through:
+            await crud.update_last_heartbeats(db, sessions)
+
+        now = time.time()
+        touched = 0
+        with self._lock:
+            for key in sessions:
+                session = self._sessions.get(key)
+                if session is not None:
+                    session.last_seen = now
+                    touched += 1
+        return touched
+
+    def _fuzzy_matches(self, query: str):
+        """(file_hash, score) of the names similar to the query, like pg_trgm"""
+        lowered = query.lower()
+        query_trigrams = trigrams(query)
+        for file_hash in self._names.candidates(query):
+            name = self._files[file_hash].file_name.lower()
+            score = _as_real(
+                similarity(self._names.trigrams_of(file_hash), query_trigrams)
+            )
+            if len(query) < 3:
+                if not name.startswith(lowered):
+                    continue
+            elif lowered not in name and score < SIMILARITY_THRESHOLD:
+                continue
+            yield file_hash, score
+
+    def _text_matches(self, query: str):
+        """(file_hash, score) of the names containing every word of the query"""
+        tokens, prefix = text_query(query)
+        terms = len(tokens) + (prefix is not None)
+        for file_hash in self._tokens.matches(tokens, prefix):
+            yield file_hash, text_score(
+                terms,
+                len(self._tokens.tokens_of(file_hash)),
+                len(self._files[file_hash].holders),
+            )
+
+    async def search_files(
+        self,
+        db,
+        query,
+        limit=50,
+        cursor=None,
+        min_size=None,
+        max_size=None,
+        extension=None,
+        mode="fuzzy",
+    ):
+        suffix = f".{extension.lower()}" if extension else None
+
+        with self._lock:
+            scored = (
+                self._text_matches(query)
+                if mode == "text"
+                else self._fuzzy_matches(query)
+            )
+            matches = []
+            for file_hash, score in scored:
+                entry = self._files[file_hash]
+                if min_size is not None and entry.file_size < min_size:
+                    continue
+                if max_size is not None and entry.file_size > max_size:
+                    continue
+                if suffix and not entry.file_name.lower().endswith(suffix):
+                    continue
+                if cursor is not None and not (
+                    score < cursor[0] or (score == cursor[0] and file_hash > cursor[1])
+                ):
+                    continue
+
+                matches.append((-score, file_hash))
+
+            results = []
+            for neg_score, file_hash in heapq.nsmallest(limit, matches):
+                entry = self._files[file_hash]
+                peers = [self._sessions[key].peer_info() for key in entry.holders]
+                results.append(
+                    schemas.SearchResult(
+                        file_hash=file_hash,
+                        file_name=entry.file_name,
+                        file_size=entry.file_size,
+                        score=-neg_score,
+                        peers=peers,
+                    )
+                )
+        return results
+
+    async def get_file_peers(self, db, file_hash):
+        with self._lock:
+            entry = self._files.get(file_hash)
+            if entry is None:
+                return []
+            return [self._sessions[key].peer_info() for key in entry.holders]
+
+    async def count_file_peers(self, db, file_hashes):
+        counts = {}
+        with self._lock:
+            for file_hash in file_hashes:
+                entry = self._files.get(file_hash)
+                if entry is not None:
+                    counts[file_hash] = len(entry.holders)
+        return counts
+
+    async def files_shared_by(self, db, user_id, file_hashes):
+        shared = set()
+        with self._lock:
+            for file_hash in file_hashes:
+                entry = self._files.get(file_hash)
+                # Holders are keyed by (user_id, ip_address, port)
+                if entry is not None and any(
+                    key[0] == user_id for key in entry.holders
+                ):
+                    shared.add(file_hash)
+        return shared
+
+    async def count_sessions(self, db):
+        return len(self._sessions)
+
+    async def file_peer_counts(self, db):
+        with self._lock:
+            counts = [
+                (entry.file_hash, entry.file_name, len(entry.holders))
+                for entry in self._files.values()
+            ]
+        for count in counts:
+            yield count
+
+    async def _remove_inactive_peers(self, db, threshold_seconds, batch_size):
+        if self.write_through:
+            await crud.remove_inactive_peers(db, threshold_seconds, batch_size)
+
+        cutoff = time.time() - threshold_seconds
+        expired = 0
+        removed: list[str] = []
+
+        with self._lock:
+            while (
+                self._leases
+                and self._leases[0][0] < cutoff
+                and (batch_size is None or expired < batch_size)
+            ):
+                _, session_id, key = heapq.heappop(self._leases)
+                session = self._sessions.get(key)
+                if session is None or session.session_id != session_id:
+                    continue  # stale entry of a session that already expired
+                if session.last_seen >= cutoff:
+                    # Renewed since the entry was pushed, requeue it
+                    heapq.heappush(self._leases, (session.last_seen, session_id, key))
+                    continue
+
+                removed.extend(session.files)
+                self._unmap(session, list(session.files))
+                del self._sessions[key]
+                expired += 1
+        return schemas.ExpiryResult(expired=expired, removed=removed)
+
+    async def _remove_user_sessions(self, db, user_id):
+        if self.write_through:
+            await crud.remove_user_sessions(db, user_id)
+
+        removed: list[str] = []
+        with self._lock:
+            # Their lease heap entries are skipped once the session is gone
+            sessions = [s for s in self._sessions.values() if s.user_id == user_id]
+            for session in sessions:
+                removed.extend(session.files)
+                self._unmap(session, list(session.files))
+                del self._sessions[session.key]
+            self._usernames.pop(user_id, None)
+        return schemas.ExpiryResult(expired=len(sessions), removed=removed)
+
+    def next_expiry_in(self, threshold_seconds=60):
+        with self._lock:
+            if not self._leases:
+                return None
+            return max(0.0, self._leases[0][0] + threshold_seconds - time.time())
@@ -0,0 +1,261 @@
+import abc
+import bisect
+import functools
+import math
+import threading
+import time
+from typing import Callable, TypeVar
+
+# Prometheus client defaults, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ANNOUNCE_SIZE_BUCKETS = (0, 10, 100, 1000, 10000, 100000, 1000000)
+SEARCH_SIZE_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 200)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+            *self._samples(),
+        ]
+
+    @abc.abstractmethod
+    def _samples(self) -> list[str]:
+        """Exposition lines of the metric, after its HELP and TYPE"""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, labels: tuple = ()) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple[float, ...],
+        labels: tuple[str, ...] = (),
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (count per bucket with +Inf last, [sum of values])
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        # Buckets are upper bounds, a value equal to one falls into it
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = ([0] * (len(self.buckets) + 1), [0.0])
+                self._values[labels] = entry
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total[0]))
+                for key, (counts, total) in self._values.items()
+            )
+        names = self.labels + ("le",)
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = _format_value(bound)
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(names, key + (le,))} "
+                    f"{cumulative}"
+                )
+            suffix = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{suffix} {_format_value(total)}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+M = TypeVar("M", bound=_Metric)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: M) -> M:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(
+    Counter(
+        "tracker_http_requests_total",
+        "HTTP requests handled, by route template and status code",
+        ("method", "route", "status"),
+    )
+)
+http_request_duration = registry.register(
+    Histogram(
+        "tracker_http_request_duration_seconds",
+        "Time to produce the response, by route template",
+        LATENCY_BUCKETS,
+        ("method", "route"),
+    )
+)
+db_query_duration = registry.register(
+    Histogram(
+        "tracker_db_query_duration_seconds",
+        "Time spent in each crud function, including its commit",
+        LATENCY_BUCKETS,
+        ("function",),
+    )
+)
+announce_files = registry.register(
+    Histogram(
+        "tracker_announce_files",
+        "Files per announce: the library for full/stream, the changes for delta",
+        ANNOUNCE_SIZE_BUCKETS,
+        ("kind",),
+    )
+)
+expired_sessions = registry.register(
+    Counter("tracker_expired_sessions_total", "Peer sessions removed by expiry")
+)
+expired_session_files = registry.register(
+    Counter(
+        "tracker_expired_session_files_total",
+        "Shared file rows removed together with expired sessions",
+    )
+)
+active_sessions = registry.register(
+    Gauge(
+        "tracker_active_sessions",
+        "Peer sessions the tracker holds, expired ones until they are reaped",
+    )
+)
+search_results = registry.register(
+    Histogram(
+        "tracker_search_results",
+        "Results returned per search request",
+        SEARCH_SIZE_BUCKETS,
+    )
+)
+
+
+def timed(fn: Callable) -> Callable:
+    """Record the duration of an async crud function"""
+    labels = (fn.__name__,)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            db_query_duration.observe(time.perf_counter() - start, labels)
+
+    return wrapper
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting and timing requests per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The template, not the raw path, keeps the number of series bounded
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            http_requests.inc(labels=(method, path, status_code))
+            http_request_duration.observe(time.perf_counter() - start, (method, path))
@@ -2,19 +2,43 @@ from datetime import datetime
 from typing import List
 
 from sqlalchemy import (
+    DDL,
     BigInteger,
     CheckConstraint,
+    Computed,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
+    LargeBinary,
     String,
     UniqueConstraint,
+    event,
 )
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 
 from .database import Base
 
+# The trigram index on file names needs pg_trgm before the tables are created
+event.listen(
+    Base.metadata, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+)
+
+# Name tokens for text search, split like search_index.name_tokens: camelCase,
+# acronyms, letter/digit boundaries, then anything that is not a letter or digit.
+# array_to_tsvector keeps them as they are, without the text search parser
+SEARCH_VECTOR_SQL = (
+    "array_to_tsvector(string_to_array(trim(regexp_replace(lower("
+    "regexp_replace(regexp_replace(regexp_replace(regexp_replace(file_name, "
+    "'([a-z])([A-Z])', '\\1 \\2', 'g'), "
+    "'([A-Z])([A-Z][a-z])', '\\1 \\2', 'g'), "
+    "'([[:alpha:]])([0-9])', '\\1 \\2', 'g'), "
+    "'([0-9])([[:alpha:]])', '\\1 \\2', 'g')), "
+    "'[^[:alnum:]]+', ' ', 'g')), ' '))"
+)
+
 
 class User(Base):
     __tablename__ = "users"
@@ -29,9 +53,9 @@ class User(Base):
         DateTime(timezone=True), server_default=func.now()
     )
 
-    # Relationship to peers (One user can be active on multiple devices/files)
-    active_peers: Mapped[List["ActivePeer"]] = relationship(
-        back_populates="user", cascade="all, delete-orphan"
+    # Relationship to sessions (One user can be online on multiple devices)
+    sessions: Mapped[List["PeerSession"]] = relationship(
+        back_populates="user", cascade="all, delete-orphan", passive_deletes=True
     )
 
 
@@ -46,26 +70,59 @@ class File(Base):
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now()
     )
+    # Maintained by Postgres from file_name, only read by text searches
+    search_vector: Mapped[str] = mapped_column(
+        TSVECTOR, Computed(SEARCH_VECTOR_SQL, persisted=True), deferred=True
+    )
 
     # Relationship
-    peer_holding: Mapped[List["ActivePeer"]] = relationship(
-        back_populates="file", cascade="all, delete-orphan"
+    holders: Mapped[List["SessionFile"]] = relationship(
+        back_populates="file", cascade="all, delete-orphan", passive_deletes=True
     )
 
     __table_args__ = (
         CheckConstraint("file_size >= 0", name="ck_file_size_non_negative"),
+        # Trigram index for partial / fuzzy matching of file names
+        Index(
+            "idx_file_name_trgm",
+            "file_name",
+            postgresql_using="gin",
+            postgresql_ops={"file_name": "gin_trgm_ops"},
+        ),
+        # Inverted index of name tokens for text searches
+        Index("idx_file_search_vector", "search_vector", postgresql_using="gin"),
     )
 
 
-class ActivePeer(Base):
-    __tablename__ = "active_peers"
+class FileManifest(Base):
+    """Piece hashes of a file, published by a client sharing it.
 
-    peer_id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
-    user_id: Mapped[int] = mapped_column(
-        Integer, ForeignKey("users.user_id"), nullable=False
+    Keyed by the file hash alone, without a foreign key to `files`: the
+    manifest describes the content and outlives the peers sharing it (and
+    with the in-memory store the file may never be written to `files`).
+    """
+
+    __tablename__ = "file_manifests"
+
+    file_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    file_size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    piece_size: Mapped[int] = mapped_column(Integer, nullable=False)
+    merkle_root: Mapped[bytes] = mapped_column(LargeBinary(32), nullable=False)
+    # SHA-256 digests of the pieces, 32 bytes each, concatenated in order
+    pieces: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
     )
-    file_hash: Mapped[str] = mapped_column(
-        String(64), ForeignKey("files.file_hash"), nullable=False
+
+
+class PeerSession(Base):
+    """One row per running client instance, holds its address and lease"""
+
+    __tablename__ = "peer_sessions"
+
+    session_id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    user_id: Mapped[int] = mapped_column(
+        Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False
     )
 
     ip_address: Mapped[str] = mapped_column(
@@ -73,20 +130,69 @@ class ActivePeer(Base):
     )  # Stores IPv4 or IPv6
     port: Mapped[int] = mapped_column(Integer, nullable=False)
     public_url: Mapped[str] = mapped_column(String, nullable=True)
+    # Address the client reached the tracker from, used to rank nearby peers
+    public_ip: Mapped[str | None] = mapped_column(String(45), nullable=True)
+    # Load last reported by the client (uploads in progress)
+    load: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # Version of the file list last applied for this client instance,
+    # deltas are only accepted on top of this version
+    library_version: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
     last_heartbeat: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
         server_default=func.now(),
-        onupdate=func.now(),
         index=True,
     )
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
 
     # Relationships
-    user: Mapped[List["User"]] = relationship(back_populates="active_peers")
-    file: Mapped[List["File"]] = relationship(back_populates="peer_holding")
+    user: Mapped["User"] = relationship(back_populates="sessions")
+    files: Mapped[List["SessionFile"]] = relationship(
+        back_populates="session", cascade="all, delete-orphan", passive_deletes=True
+    )
 
-    # Constraint: A user can't be listed twice for the same file
+    # Constraint: One session per client instance
     __table_args__ = (
         UniqueConstraint(
-            "user_id", "file_hash", name="active_peers_user_id_file_hash_key"
+            "user_id", "ip_address", "port", name="peer_sessions_client_key"
         ),
     )
+
+
+class SessionFile(Base):
+    """Which session shares which file"""
+
+    __tablename__ = "session_files"
+
+    session_id: Mapped[int] = mapped_column(
+        Integer,
+        ForeignKey("peer_sessions.session_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    file_hash: Mapped[str] = mapped_column(
+        String(64),
+        ForeignKey("files.file_hash", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,  # Find who has a specific file
+    )
+
+    # Relationships
+    session: Mapped["PeerSession"] = relationship(back_populates="files")
+    file: Mapped["File"] = relationship(back_populates="holders")
+
+
+class SessionLease(Base):
+    """A session heard from during a lease bucket, see leases.LEASE_BUCKET_SECONDS.
+
+    Partitioned by bucket so expired leases are dropped a partition at a time.
+    There is no foreign key to peer_sessions, which would make every drop lock
+    it; lease rows of deleted sessions go away with their partition.
+    """
+
+    __tablename__ = "session_leases"
+
+    session_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    bucket: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+
+    __table_args__ = {"postgresql_partition_by": "RANGE (bucket)"}
@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+
+from . import database
+from .db_metrics import InstrumentedPool, instrument_engine
+
+logger = logging.getLogger(__name__)
+
+# Comma separated postgresql:// URLs of read replicas. Searches and user
+# lookups are spread over the healthy ones, everything else uses the primary
+DATABASE_REPLICA_URLS = [
+    url.strip()
+    for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",")
+    if url.strip()
+]
+# Replicas further behind the primary than this serve no reads
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", 5))
+# How often the health and lag of the replicas are checked
+DB_REPLICA_CHECK_SECONDS = float(os.getenv("DB_REPLICA_CHECK_SECONDS", 5))
+# A check taking longer than this marks the replica down
+REPLICA_CHECK_TIMEOUT_SECONDS = 2
+
+# WAL positions, in bytes. NULL on a replica that is not a standby (e.g. a
+# logical replica), which counts as current
+PRIMARY_POSITION_QUERY = text(
+    "SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() "
+    "ELSE pg_current_wal_lsn() END - '0/0'::pg_lsn"
+)
+REPLICA_POSITION_QUERY = text(
+    "SELECT CASE WHEN pg_is_in_recovery() "
+    "THEN pg_last_wal_replay_lsn() - '0/0'::pg_lsn END"
+)
+
+
+class _Replica:
+    def __init__(self, url: str):
+        self.name = make_url(url).render_as_string(hide_password=True)
+        async_url, connect_args = database.to_async_url(url)
+        self.engine = create_async_engine(
+            async_url,
+            connect_args=connect_args,
+            poolclass=InstrumentedPool,
+            pool_size=database.DB_POOL_SIZE,
+            max_overflow=database.DB_MAX_OVERFLOW,
+            pool_timeout=database.DB_POOL_TIMEOUT,
+            pool_recycle=database.DB_POOL_RECYCLE,
+            # Replicas come and go more than the primary, a connection to one
+            # that restarted must not fail the request checking it out
+            pool_pre_ping=True,
+        )
+        instrument_engine(self.engine.sync_engine)
+        self.sessionmaker = async_sessionmaker(
+            bind=self.engine, autoflush=False, expire_on_commit=False
+        )
+        self.healthy = False
+        self.lag: float | None = None
+        self.last_error: str | None = None
+        self.checked_at = 0.0
+        self.reads = 0
+
+        @event.listens_for(self.engine.sync_engine, "handle_error")
+        def handle_error(context):
+            # Stop routing to it right away, the next check brings it back
+            if context.is_disconnect:
+                self.mark_down(context.original_exception)
+
+    def mark_down(self, error: BaseException) -> None:
+        self.healthy = False
+        self.last_error = str(error) or type(error).__name__
+
+    def eligible(self) -> bool:
+        return (
+            self.healthy
+            and self.lag is not None
+            and self.lag <= DB_REPLICA_MAX_LAG_SECONDS
+        )
+
+
+class ReplicaSet:
+    """Read replicas of the database, with the health and lag of each.
+
+    Every check records the WAL position of the primary, a replica is as
+    far behind as the time since the primary was at the position it has
+    replayed. Unlike the time of the last replayed commit this stays right
+    while the primary is idle. Read-only requests take a session from
+    `session`, which rotates over the replicas that answered the last
+    check and are at most DB_REPLICA_MAX_LAG_SECONDS behind. Without any,
+    reads fall back to the primary. Everything runs on the event loop, so
+    no locking is needed.
+    """
+
+    def __init__(self, urls: list[str]):
+        self.replicas = [_Replica(url) for url in urls]
+        self._next = 0
+        # (monotonic time, WAL position) of the primary, enough of them to
+        # tell whether a replica is more than the maximum lag behind
+        self._positions: deque[tuple[float, int]] = deque(
+            maxlen=int(DB_REPLICA_MAX_LAG_SECONDS / DB_REPLICA_CHECK_SECONDS) + 2
+        )
+        self.primary_reads = 0
+        self.fallbacks = 0  # reads on the primary although replicas exist
+
+    async def _primary_position(self) -> None:
+        try:
+            async with database.engine.connect() as conn:
+                position = await asyncio.wait_for(
+                    conn.scalar(PRIMARY_POSITION_QUERY), REPLICA_CHECK_TIMEOUT_SECONDS
+                )
+        except Exception as e:
+            # Replicas are judged by the positions recorded before
+            logger.warning(f"WAL position of the primary unknown: {e}")
+            return
+        self._positions.append((time.monotonic(), int(position)))
+
+    def _lag(self, position) -> float:
+        """Seconds since the primary was at a WAL position"""
+        if position is None:
+            return 0.0
+        now = time.monotonic()
+        for taken_at, primary in reversed(self._positions):
+            if position >= primary:
+                return now - taken_at
+        if len(self._positions) == self._positions.maxlen:
+            return now - self._positions[0][0]
+        return math.inf  # no history yet to tell
+
+    async def _check(self, replica: _Replica) -> None:
+        try:
+            async with replica.engine.connect() as conn:
+                lag = self._lag(
+                    await asyncio.wait_for(
+                        conn.scalar(REPLICA_POSITION_QUERY),
+                        REPLICA_CHECK_TIMEOUT_SECONDS,
+                    )
+                )
+        except Exception as e:
+            if replica.healthy:
+                logger.warning(f"Read replica {replica.name} is down: {e}")
+            replica.mark_down(e)
+        else:
+            if not replica.healthy:
+                logger.info(f"Read replica {replica.name} is up, lag {lag:.1f} s")
+            replica.healthy = True
+            replica.lag = lag
+            replica.last_error = None
+        replica.checked_at = time.time()
+
+    async def check(self) -> None:
+        """Refresh the health and lag of every replica"""
+        if not self.replicas:
+            return
+        await self._primary_position()
+        await asyncio.gather(*(self._check(replica) for replica in self.replicas))
+
+    async def run(self) -> None:
+        """Background loop checking the replicas until cancelled"""
+        if not self.replicas:
+            return
+        while True:
+            await self.check()
+            await asyncio.sleep(DB_REPLICA_CHECK_SECONDS)
+
+    def pick(self) -> _Replica | None:
+        """Next eligible replica, None to read from the primary"""
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self._next % len(self.replicas)]
+            self._next += 1
+            if replica.eligible():
+                replica.reads += 1
+                return replica
+        self.primary_reads += 1
+        if self.replicas:
+            self.fallbacks += 1
+        return None
+
+    async def session(self) -> AsyncSession:
+        """Session for a read, on a replica that accepts a connection"""
+        replica = self.pick()
+        if replica is not None:
+            db = replica.sessionmaker()
+            try:
+                # Connect before the request runs, it falls back to the
+                # primary instead of failing when the replica went away
+                await db.connection()
+                return db
+            except (DBAPIError, OSError) as e:
+                await db.close()
+                logger.warning(f"Read replica {replica.name} is down: {e}")
+                replica.mark_down(e)
+                self.primary_reads += 1
+                self.fallbacks += 1
+        return database.SessionLocal()
+
+    async def dispose(self) -> None:
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def stats(self) -> dict:
+        return {
+            "primary_reads": self.primary_reads,
+            "fallbacks": self.fallbacks,
+            "max_lag_seconds": DB_REPLICA_MAX_LAG_SECONDS,
+            "replicas": [
+                {
+                    "url": replica.name,
+                    "healthy": replica.healthy,
+                    "lag_seconds": replica.lag if replica.lag != math.inf else None,
+                    "eligible": replica.eligible(),
+                    "reads": replica.reads,
+                    "last_error": replica.last_error,
+                    "checked_at": replica.checked_at,
+                }
+                for replica in self.replicas
+            ],
+        }
+
+
+replica_set = ReplicaSet(DATABASE_REPLICA_URLS)
+
+
+async def get_read_db():
+    """Session for read-only requests, on a replica when one is usable"""
+    async with await replica_set.session() as db:
+        yield db
+
+
+def is_replica(db) -> bool:
+    return db.bind is not database.engine
@@ -0,0 +1,191 @@
+import heapq
+import logging
+import os
+import threading
+import time
+from typing import List
+
+from . import events, schemas
+from .store import TrackerStore
+
+logger = logging.getLogger(__name__)
+
+# Demand of a file halves after this long without searches or lookups
+DEMAND_HALF_LIFE_SECONDS = float(os.getenv("DEMAND_HALF_LIFE_SECONDS", 3600))
+# Files wanted at least this much are hinted to volunteers...
+REPLICATION_MIN_DEMAND = float(os.getenv("REPLICATION_MIN_DEMAND", 5))
+# ...while at most this many peers are online with them
+REPLICATION_TARGET_PEERS = int(os.getenv("REPLICATION_TARGET_PEERS", 3))
+# Files whose demand is tracked, the least wanted are dropped beyond that
+DEMAND_MAX_FILES = int(os.getenv("DEMAND_MAX_FILES", 50000))
+# Share of the tracked files dropped when DEMAND_MAX_FILES is reached
+DEMAND_EVICT_SHARE = 0.1
+# Hint candidates checked against the store per returned hint
+HINT_CANDIDATES_PER_HINT = 4
+
+
+class _Demand:
+    __slots__ = ("file_name", "file_size", "peers", "demand", "updated_at")
+
+    def __init__(self, now: float):
+        self.file_name: str | None = None
+        self.file_size: int | None = None
+        self.peers = 0
+        self.demand = 0.0  # as of updated_at
+        self.updated_at = now
+
+    def current(self, now: float) -> float:
+        return self.demand * 0.5 ** ((now - self.updated_at) / DEMAND_HALF_LIFE_SECONDS)
+
+
+class ReplicationTracker:
+    """Recent demand and online peers of files, to find under-replicated ones.
+
+    Every file a search returns and every file whose peers are looked up
+    counts one hit, decaying with DEMAND_HALF_LIFE_SECONDS. The number of
+    peers is taken from the same requests and follows the `events` of the
+    file/peer index in between. Only files that were asked for are tracked,
+    at most DEMAND_MAX_FILES of them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files: dict[str, _Demand] = {}
+        self.hits = 0
+        self.evicted = 0
+        self.hint_requests = 0
+        self.hints_served = 0
+
+    def _entry(self, file_hash: str, now: float) -> _Demand:
+        entry = self._files.get(file_hash)
+        if entry is None:
+            if len(self._files) >= DEMAND_MAX_FILES:
+                self._evict(now)
+            entry = self._files[file_hash] = _Demand(now)
+        return entry
+
+    def _evict(self, now: float) -> None:
+        drop = heapq.nsmallest(
+            max(1, int(len(self._files) * DEMAND_EVICT_SHARE)),
+            self._files,
+            key=lambda file_hash: self._files[file_hash].current(now),
+        )
+        for file_hash in drop:
+            del self._files[file_hash]
+        self.evicted += len(drop)
+
+    def _hit(self, entry: _Demand, now: float) -> None:
+        entry.demand = entry.current(now) + 1
+        entry.updated_at = now
+        self.hits += 1
+
+    def record_search(self, results: List[schemas.SearchResult]) -> None:
+        """Count a hit for every file a search returned"""
+        now = time.monotonic()
+        with self._lock:
+            for result in results:
+                entry = self._entry(result.file_hash, now)
+                entry.file_name = result.file_name
+                entry.file_size = result.file_size
+                entry.peers = len(result.peers)
+                self._hit(entry, now)
+
+    def record_lookup(self, file_hash: str, peers: int) -> None:
+        """Count a hit for a file whose peers were looked up"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry(file_hash, now)
+            entry.peers = peers
+            self._hit(entry, now)
+
+    def apply(self, added: List[schemas.FileBase], removed: List[str]) -> None:
+        """Follow a change of the file/peer index"""
+        with self._lock:
+            for file in added:
+                entry = self._files.get(file.file_hash)
+                if entry is not None:
+                    entry.file_name = file.file_name
+                    entry.file_size = file.file_size
+                    entry.peers += 1
+            for file_hash in removed:
+                entry = self._files.get(file_hash)
+                if entry is not None:
+                    entry.peers = max(0, entry.peers - 1)
+
+    def _candidates(self, count: int, max_size: int | None) -> list[tuple[str, float]]:
+        """Files most wanted per online peer, with their current demand"""
+        now = time.monotonic()
+        with self._lock:
+            ranked = []
+            for file_hash, entry in self._files.items():
+                demand = entry.current(now)
+                if (
+                    demand >= REPLICATION_MIN_DEMAND
+                    and 0 < entry.peers <= REPLICATION_TARGET_PEERS
+                    and entry.file_name is not None
+                    and entry.file_size is not None
+                    and (max_size is None or entry.file_size <= max_size)
+                ):
+                    ranked.append((demand / entry.peers, file_hash, demand))
+        return [
+            (file_hash, demand)
+            for _, file_hash, demand in heapq.nlargest(count, ranked)
+        ]
+
+    async def hints(
+        self,
+        store: TrackerStore,
+        db,
+        user_id: int,
+        limit: int,
+        max_size: int | None = None,
+    ) -> List[schemas.ReplicationHint]:
+        """High-demand files with few online peers, for a volunteer to seed.
+
+        Candidates are checked against the store, all at once: files the
+        user already shares and files whose peers went offline or caught up
+        are skipped.
+        """
+        self.hint_requests += 1
+        candidates = self._candidates(limit * HINT_CANDIDATES_PER_HINT, max_size)
+        file_hashes = [file_hash for file_hash, _ in candidates]
+        counts = await store.count_file_peers(db, file_hashes)
+        shared = await store.files_shared_by(db, user_id, file_hashes)
+        hints = []
+        for file_hash, demand in candidates:
+            peers = counts.get(file_hash, 0)
+            with self._lock:
+                entry = self._files.get(file_hash)
+                if entry is not None:
+                    entry.peers = peers
+            if entry is None or not 0 < peers <= REPLICATION_TARGET_PEERS:
+                continue
+            if file_hash in shared:
+                continue
+            hints.append(
+                schemas.ReplicationHint(
+                    file_hash=file_hash,
+                    file_name=entry.file_name,
+                    file_size=entry.file_size,
+                    peers=peers,
+                    demand=round(demand, 2),
+                )
+            )
+            if len(hints) == limit:
+                break
+        self.hints_served += len(hints)
+        return hints
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "hits": self.hits,
+                "evicted": self.evicted,
+                "hint_requests": self.hint_requests,
+                "hints_served": self.hints_served,
+            }
+
+
+replication_tracker = ReplicationTracker()
+events.subscribe(replication_tracker.apply)
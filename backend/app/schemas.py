@@ -1,8 +1,10 @@
 import re
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Literal, Optional
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import Base64Bytes, BaseModel, Field, field_validator, model_validator
+
+from . import manifests
 
 
 # --- Token / Auth Schemas ---
@@ -13,14 +15,33 @@ class Token(BaseModel):
 
 class TokenResponse(BaseModel):
     access_token: str
+    refresh_token: str
     token_type: str = "bearer"
     user: "UserResponse"
 
 
+class TokenRefresh(BaseModel):
+    refresh_token: str
+
+
+class TokenPair(BaseModel):
+    access_token: str
+    refresh_token: str
+    token_type: str = "bearer"
+
+
 class TokenData(BaseModel):
     username: str | None = None
 
 
+class CurrentUser(BaseModel):
+    """The authenticated user resolved from a token"""
+
+    user_id: int
+    username: str
+    email: str | None = None
+
+
 class User(BaseModel):
     username: str
     email: str | None = None
@@ -91,6 +112,83 @@ class FileAnnounce(BaseModel):
     ip_address: str | None = None
     public_url: str | None = None  # Ngrok url
     files: List[FileBase]
+    version: int = 0  # client-held library version after this announce
+
+
+class AnnounceStreamHeader(BaseModel):
+    """First line of a streamed (NDJSON) announce, one FileBase per line follows"""
+
+    user_id: int
+    port: int
+    ip_address: str | None = None
+    public_url: str | None = None
+    version: int = 0
+
+
+class FileAnnounceDelta(BaseModel):
+    """What the client sends when only part of its library changed"""
+
+    user_id: int
+    port: int
+    ip_address: str | None = None
+    public_url: str | None = None
+    base_version: int  # library version the delta was computed against
+    version: int  # library version after applying the delta
+    added: List[FileBase] = []
+    removed: List[str] = []  # file hashes no longer shared
+
+    @field_validator("removed")
+    def validate_removed(cls, v: List[str]):
+        for file_hash in v:
+            if not re.match(r"^[0-9a-fA-F]{64}$", file_hash):
+                raise ValueError("Invalid SHA-256 hash")
+        return [file_hash.lower() for file_hash in v]
+
+
+class AnnounceResult(BaseModel):
+    """Outcome of applying an announce to the tracker"""
+
+    announced: int  # files shared by the client after the announce
+    version: int
+    added: List[FileBase] = []  # files newly shared by the client
+    removed: List[str] = []  # file hashes the client stopped sharing
+
+
+class ExpiryResult(BaseModel):
+    """Outcome of expiring inactive peer sessions"""
+
+    expired: int  # sessions removed
+    removed: List[str] = []  # file hashes, once per expired session sharing it
+
+
+class FileManifest(BaseModel):
+    """Piece hashes of a file and their Merkle root, see app/manifests.py"""
+
+    file_hash: str = Field(..., pattern=r"^[0-9a-fA-F]{64}$")
+    file_size: int = Field(..., ge=0, le=10**12)
+    piece_size: int  # bytes per piece, the last one may be shorter
+    merkle_root: str = Field(..., pattern=r"^[0-9a-fA-F]{64}$")
+    pieces: Base64Bytes  # SHA-256 digests of the pieces, concatenated
+
+    @model_validator(mode="after")
+    def validate_pieces(self):
+        manifests.check_manifest(
+            self.file_size, self.piece_size, self.merkle_root, self.pieces
+        )
+        self.file_hash = self.file_hash.lower()
+        self.merkle_root = self.merkle_root.lower()
+        return self
+
+
+class ManifestBatch(BaseModel):
+    """Manifests of files the client shares, published after an announce"""
+
+    manifests: List[FileManifest] = Field(..., max_length=256)
+
+
+class ManifestResult(BaseModel):
+    stored: int  # manifests the tracker did not have yet
+    rejected: List[str] = []  # hashes of files not shared or known differently
 
 
 # --- Search Result Schemas ---
@@ -103,6 +201,16 @@ class PeerInfo(BaseModel):
     public_url: str | None = None
     username: str
     last_heartbeat: datetime
+    load: int | None = None  # uploads in progress, as reported by the peer
+    # Only used for ranking, never sent to other users
+    public_ip: str | None = Field(None, exclude=True)
+    # Peer is behind the same public address as the requester, its LAN
+    # ip_address is likely reachable. Only set by /files/{hash}/peers
+    same_network: bool | None = None
+
+
+# fuzzy: trigram similarity of the whole name, text: every word in any order
+SearchMode = Literal["fuzzy", "text"]
 
 
 class SearchResult(BaseModel):
@@ -110,6 +218,23 @@ class SearchResult(BaseModel):
     file_name: str
     file_size: int
     peers: List[PeerInfo]  # list on peers who have the file
+    score: float | None = None  # relevance of the file name to the query
+
+
+class ReplicationHint(FileBase):
+    """A file wanted more than its online peers can serve"""
+
+    peers: int  # online peers sharing it
+    demand: float  # recent searches and peer lookups, decayed
+
+
+class Suggestion(BaseModel):
+    text: str  # the prefix with its last word completed
+    peers: int  # peers sharing files whose name contains the completed word
+
+
+class SubscriptionEvent(FileBase):
+    matches: List[str]  # the subscribed queries and hashes the file matched
 
 
 class PeerPing(BaseModel):
@@ -117,3 +242,87 @@ class PeerPing(BaseModel):
 
     ip_address: str | None = None
     port: int
+    load: int | None = Field(None, ge=0)  # uploads in progress
+
+
+class HeartbeatChannel(BaseModel):
+    """Where and how a session can send its heartbeats over UDP"""
+
+    port: int  # UDP port of the tracker
+    channel_id: int
+    key: str  # hex HMAC key the heartbeats are signed with
+
+
+# --- Requests between tracker nodes (TRACKER_SHARDS) ---
+class ShardAnnounce(BaseModel):
+    """Part of a full announce forwarded to the node owning its files"""
+
+    announce: FileAnnounce
+    client_ip: str
+    public_ip: str | None = None
+
+
+class ShardAnnounceStream(BaseModel):
+    """First line of a streamed announce forwarded to a node, its files follow"""
+
+    header: AnnounceStreamHeader
+    client_ip: str
+    public_ip: str | None = None
+
+
+class ShardAnnounceDelta(BaseModel):
+    """Part of a delta announce forwarded to the node owning its files"""
+
+    delta: FileAnnounceDelta
+    client_ip: str
+    public_ip: str | None = None
+
+
+class ShardHeartbeats(BaseModel):
+    """Heartbeats received by one node, applied to the sessions on every node"""
+
+    sessions: List[tuple[int, str, int]]  # (user_id, ip_address, port)
+    load: int | None = None  # only sent along a single session's ping
+
+    @model_validator(mode="after")
+    def validate_load(self):
+        if self.load is not None and len(self.sessions) != 1:
+            raise ValueError("A load is only sent with a single session")
+        return self
+
+
+class ShardUserSessions(BaseModel):
+    """A deleted user, whose sessions every node drops"""
+
+    user_id: int
+
+
+class ShardFiles(BaseModel):
+    """Files whose peers are counted by the node owning them"""
+
+    file_hashes: List[str]
+
+
+class ShardSharedFiles(BaseModel):
+    """Files some session of a user may share, checked by the node owning them"""
+
+    user_id: int
+    file_hashes: List[str]
+
+
+class ShardSearch(BaseModel):
+    """A search fanned out to every node, same parameters as /search"""
+
+    query: str
+    limit: int
+    cursor: tuple[float, str] | None = None
+    min_size: int | None = None
+    max_size: int | None = None
+    extension: str | None = None
+    mode: SearchMode = "fuzzy"
+
+
+class ShardPeerInfo(PeerInfo):
+    """PeerInfo between tracker nodes, keeps the address peers are ranked by"""
+
+    public_ip: str | None = None
@@ -0,0 +1,357 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from typing import List, NamedTuple
+
+from . import events, schemas
+from .search_index import (
+    SIMILARITY_THRESHOLD,
+    name_tokens,
+    similarity,
+    text_query,
+    trigrams,
+)
+
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 1024))
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", 30))
+# Files whose change counter is kept, all of them are reset beyond that
+FILE_VERSIONS_MAX_ENTRIES = 100000
+# Names of the last files shared, checked against searches they overlapped
+FILE_VERSIONS_RECENT_ADDS = 4096
+
+
+class SearchKey(NamedTuple):
+    query: str  # lowercased for fuzzy, its tokens for text searches
+    limit: int
+    cursor: tuple[float, str] | None
+    min_size: int | None
+    max_size: int | None
+    extension: str | None
+    mode: str
+
+
+class _Name(NamedTuple):
+    """A file name, split the ways queries are matched against it"""
+
+    lower: str
+    trigrams: set[str]
+    tokens: set[str]
+
+    @classmethod
+    def of(cls, file_name: str) -> "_Name":
+        name = file_name.lower()
+        return cls(name, trigrams(name), set(name_tokens(file_name)))
+
+
+def _may_match(
+    key: SearchKey,
+    query_tokens: tuple[list[str], str | None],
+    query_trigrams: set[str],
+    name: _Name,
+) -> bool:
+    """Whether a file name could appear in the results of a query"""
+    if key.mode == "text":
+        words, prefix = query_tokens
+        return name.tokens.issuperset(words) and (
+            prefix is None or any(t.startswith(prefix) for t in name.tokens)
+        )
+    if len(key.query) < 3:
+        return name.lower.startswith(key.query)
+    return (
+        key.query in name.lower
+        or similarity(name.trigrams, query_trigrams) >= SIMILARITY_THRESHOLD
+    )
+
+
+class FileVersions:
+    """Change counters of files, to tag search results with a cheap version.
+
+    A file's counter moves up whenever it gains or loses a peer, following
+    the `events` of the file/peer index. Counters come from one sequence, a
+    file without its own (never changed, or forgotten when the table got
+    too large) is at the `floor`, so a counter never goes back. Counters
+    only tell whether results may be stale; tags are a digest of the query
+    and of the peers listed, the same in every tracker process. The names
+    of the last `recent_adds` files shared are kept too, for files a search
+    could have missed.
+    """
+
+    def __init__(self, max_entries: int, recent_adds: int):
+        self.max_entries = max_entries
+        self.recent_adds = recent_adds
+        self._lock = threading.Lock()
+        self._versions: dict[str, int] = {}
+        self._added: deque[tuple[int, str]] = deque()
+        self._added_floor = 0  # counter of the last name forgotten
+        self.seq = 0  # last counter handed out
+        self._floor = 0
+        self.resets = 0
+
+    def apply(self, added: List[schemas.FileBase], removed: List[str]) -> None:
+        with self._lock:
+            if len(self._versions) >= self.max_entries:
+                self._versions.clear()
+                self._floor = self.seq
+                self.resets += 1
+            for file in added:
+                self.seq += 1
+                self._versions[file.file_hash] = self.seq
+                self._added.append((self.seq, file.file_name))
+            for file_hash in removed:
+                self.seq += 1
+                self._versions[file_hash] = self.seq
+            while len(self._added) > self.recent_adds:
+                self._added_floor = self._added.popleft()[0]
+
+    def etag(
+        self, key: SearchKey, results: List[schemas.SearchResult], since: int
+    ) -> str | None:
+        """Version of a result set, None when it may have changed since.
+
+        `since` is the `seq` read before searching, results of a search that
+        overlapped a change of one of their files, or the sharing of a file
+        the query could match, may already be stale and get no version.
+        """
+        with self._lock:
+            for result in results:
+                if self._versions.get(result.file_hash, self._floor) > since:
+                    return None
+            if self._added_floor > since:
+                return None
+            names = []
+            for seq, name in reversed(self._added):
+                if seq <= since:
+                    break
+                names.append(name)
+        if names:
+            query_tokens = text_query(key.query) if key.mode == "text" else ([], None)
+            query_trigrams = trigrams(key.query) if key.mode != "text" else set()
+            for name in names:
+                if _may_match(key, query_tokens, query_trigrams, _Name.of(name)):
+                    return None
+        digest = hashlib.sha256(repr(key).encode())
+        for result in results:
+            peers = sorted(
+                f"{peer.user_id}@{peer.ip_address}:{peer.port}" for peer in result.peers
+            )
+            digest.update(f"|{result.file_hash}:{','.join(peers)}".encode())
+        return digest.hexdigest()[:32]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "files": len(self._versions),
+                "seq": self.seq,
+                "resets": self.resets,
+            }
+
+
+class _Entry:
+    __slots__ = (
+        "results",
+        "etag",
+        "expires_at",
+        "file_hashes",
+        "query_trigrams",
+        "query_tokens",
+    )
+
+    def __init__(
+        self, results: List[schemas.SearchResult], etag: str, expires_at: float
+    ):
+        self.results = results
+        self.etag = etag
+        self.expires_at = expires_at
+        self.file_hashes = {result.file_hash for result in results}
+        self.query_trigrams: set[str] = set()
+        self.query_tokens: tuple[list[str], str | None] = ([], None)
+
+
+class SearchCache:
+    """Bounded LRU/TTL cache of grouped search results.
+
+    Entries are dropped as soon as one of their files gains or loses a peer,
+    or when a newly shared file matches their query, so results never list
+    peers the tracker already forgot about. The TTL bounds staleness from
+    changes made by other tracker processes, ETags are only answered with
+    a 304 while their results are cached, so the TTL bounds them too.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[SearchKey, _Entry] = OrderedDict()
+        # Reverse indexes used for invalidation
+        self._by_hash: defaultdict[str, set[SearchKey]] = defaultdict(set)
+        self._by_trigram: defaultdict[str, set[SearchKey]] = defaultdict(set)
+        self._by_prefix: defaultdict[str, set[SearchKey]] = defaultdict(set)
+        # Text searches, by the first letter of their first word
+        self._by_initial: defaultdict[str, set[SearchKey]] = defaultdict(set)
+        self._unindexed: set[SearchKey] = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(
+        query: str,
+        limit: int,
+        cursor: tuple[float, str] | None = None,
+        min_size: int | None = None,
+        max_size: int | None = None,
+        extension: str | None = None,
+        mode: str = "fuzzy",
+    ) -> SearchKey:
+        if mode == "text":
+            # Queries with the same words share an entry, the case matters
+            # to how they are split so it is normalized after that
+            tokens, prefix = text_query(query)
+            query = " ".join(tokens + [prefix]) if prefix else " ".join(tokens) + " "
+        else:
+            query = query.lower()
+        return SearchKey(query, limit, cursor, min_size, max_size, extension, mode)
+
+    def get(self, key: SearchKey) -> tuple[List[schemas.SearchResult], str] | None:
+        """Cached results and their ETag"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires_at <= time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.results, entry.etag
+
+    def put(
+        self, key: SearchKey, results: List[schemas.SearchResult], etag: str
+    ) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            entry = _Entry(results, etag, time.monotonic() + self.ttl_seconds)
+            self._entries[key] = entry
+
+            for file_hash in entry.file_hashes:
+                self._by_hash[file_hash].add(key)
+            if key.mode == "text":
+                entry.query_tokens = text_query(key.query)
+                initial = self._initial(entry)
+                if initial:
+                    self._by_initial[initial].add(key)
+            elif len(key.query) < 3:
+                self._by_prefix[key.query].add(key)
+            else:
+                entry.query_trigrams = trigrams(key.query)
+                if not entry.query_trigrams:
+                    self._unindexed.add(key)
+                for gram in entry.query_trigrams:
+                    self._by_trigram[gram].add(key)
+
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate(self, added: List[schemas.FileBase], removed: List[str]) -> None:
+        """Drop the entries affected by a change of the file/peer index"""
+        with self._lock:
+            if not self._entries:
+                return
+
+            stale: set[SearchKey] = set()
+            for file_hash in removed:
+                stale.update(self._by_hash.get(file_hash, ()))
+
+            for file in added:
+                stale.update(self._by_hash.get(file.file_hash, ()))
+                stale.update(self._matching_keys(file.file_name))
+
+            for key in stale:
+                if key in self._entries:
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def _matching_keys(self, file_name: str) -> set[SearchKey]:
+        """Cached queries whose results the given file name could appear in"""
+        name = _Name.of(file_name)
+
+        candidates = set(self._unindexed)
+        for size in (1, 2):
+            candidates.update(self._by_prefix.get(name.lower[:size], ()))
+        for gram in name.trigrams:
+            candidates.update(self._by_trigram.get(gram, ()))
+        for initial in {token[0] for token in name.tokens}:
+            candidates.update(self._by_initial.get(initial, ()))
+
+        matching = set()
+        for key in candidates:
+            entry = self._entries.get(key)
+            if entry is not None and _may_match(
+                key, entry.query_tokens, entry.query_trigrams, name
+            ):
+                matching.add(key)
+        return matching
+
+    @staticmethod
+    def _initial(entry: _Entry) -> str:
+        words, prefix = entry.query_tokens
+        first = words[0] if words else prefix
+        return first[0] if first else ""
+
+    def _drop(self, key: SearchKey) -> None:
+        entry = self._entries.pop(key)
+        for file_hash in entry.file_hashes:
+            keys = self._by_hash.get(file_hash)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_hash[file_hash]
+        if key.mode == "text":
+            initial = self._initial(entry)
+            keys = self._by_initial.get(initial)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_initial[initial]
+        elif len(key.query) < 3:
+            keys = self._by_prefix.get(key.query)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_prefix[key.query]
+        self._unindexed.discard(key)
+        for gram in entry.query_trigrams:
+            keys = self._by_trigram.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_trigram[gram]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+
+search_cache = SearchCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_SECONDS)
+events.subscribe(search_cache.invalidate)
+file_versions = FileVersions(FILE_VERSIONS_MAX_ENTRIES, FILE_VERSIONS_RECENT_ADDS)
+events.subscribe(file_versions.apply)
@@ -0,0 +1,202 @@
+import math
+import re
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+# Same word splitting as pg_trgm: runs of letters/digits, lowercased
+WORD_RE = re.compile(r"[^\W_]+")
+
+# Threshold of the pg_trgm % operator (pg_trgm.similarity_threshold)
+SIMILARITY_THRESHOLD = 0.3
+
+# Token boundaries of file names for text search, applied in this order. The
+# generated `files.search_vector` column applies the same rules in SQL
+# (models.SEARCH_VECTOR_SQL), keep both in sync
+_CAMEL_RE = re.compile(r"([a-z])([A-Z])")  # physicsNotes
+_ACRONYM_RE = re.compile(r"([A-Z])([A-Z][a-z])")  # PDFNotes
+_LETTER_DIGIT_RE = re.compile(r"([^\W\d_])([0-9])")  # ch3
+_DIGIT_LETTER_RE = re.compile(r"([0-9])([^\W\d_])")  # 3rd
+_SEPARATOR_RE = re.compile(r"[\W_]+")
+
+
+def trigrams(text: str) -> set[str]:
+    """Trigrams of a string, compatible with pg_trgm's show_trgm()"""
+    result = set()
+    for word in WORD_RE.findall(text.lower()):
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            result.add(padded[i : i + 3])
+    return result
+
+
+def name_tokens(text: str) -> list[str]:
+    """Lowercased words of a file name, split on separators, camelCase and digits"""
+    for pattern in (_CAMEL_RE, _ACRONYM_RE, _LETTER_DIGIT_RE, _DIGIT_LETTER_RE):
+        text = pattern.sub(r"\1 \2", text)
+    return [token for token in _SEPARATOR_RE.split(text.lower()) if token]
+
+
+def text_query(query: str) -> tuple[list[str], str | None]:
+    """Tokens all names must contain, and the prefix of the word being typed.
+
+    The last word counts as a prefix unless the query ends with a separator.
+    """
+    tokens = name_tokens(query)
+    if not tokens or not query[-1:].isalnum():
+        return list(dict.fromkeys(tokens)), None
+    prefix = tokens.pop()
+    return list(dict.fromkeys(tokens)), prefix
+
+
+def text_score(terms: int, name_token_count: int, peers: int) -> float:
+    """Relevance of a name matching all terms, boosted by its availability.
+
+    Names made only of the query terms score 1, each extra word dilutes it,
+    and the score grows with the log of the number of peers sharing the
+    file. Same arithmetic as the text search in crud.search_files.
+    """
+    relevance = min(1.0, terms / name_token_count)
+    return relevance * (1 + math.log(peers))
+
+
+def similarity(a: set[str], b: set[str]) -> float:
+    """Trigram similarity of two trigram sets, like pg_trgm's similarity()"""
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+class TrigramIndex:
+    """Inverted index from trigrams (and short prefixes) to keys"""
+
+    def __init__(self):
+        self._postings: defaultdict[str, set[str]] = defaultdict(set)
+        self._prefixes: defaultdict[str, set[str]] = defaultdict(set)
+        self._trigrams: dict[str, set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._trigrams)
+
+    def add(self, key: str, text: str) -> None:
+        if key in self._trigrams:
+            return
+        grams = trigrams(text)
+        self._trigrams[key] = grams
+        for gram in grams:
+            self._postings[gram].add(key)
+        lowered = text.lower()
+        for size in (1, 2):
+            if len(lowered) >= size:
+                self._prefixes[lowered[:size]].add(key)
+
+    def remove(self, key: str, text: str) -> None:
+        grams = self._trigrams.pop(key, None)
+        if grams is None:
+            return
+        for gram in grams:
+            keys = self._postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[gram]
+        lowered = text.lower()
+        for size in (1, 2):
+            keys = self._prefixes.get(lowered[:size])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._prefixes[lowered[:size]]
+
+    def trigrams_of(self, key: str) -> set[str]:
+        return self._trigrams.get(key, set())
+
+    def candidates(self, query: str) -> set[str]:
+        """Keys that may match the query, to be verified by the caller.
+
+        Any name containing the query, or with a trigram similarity above
+        zero, shares at least one trigram with it. Queries shorter than a
+        trigram are looked up by prefix instead.
+        """
+        if len(query) < 3:
+            return set(self._prefixes.get(query.lower(), ()))
+
+        grams = trigrams(query)
+        if not grams:
+            # Only punctuation, nothing to look up
+            return set(self._trigrams)
+
+        result: set[str] = set()
+        for gram in grams:
+            result.update(self._postings.get(gram, ()))
+        return result
+
+
+class TokenIndex:
+    """Inverted index from the name tokens of files to their keys"""
+
+    def __init__(self):
+        self._postings: dict[str, set[str]] = {}
+        self._tokens: dict[str, frozenset[str]] = {}
+        self._sorted: list[str] = []  # every token with postings
+
+    def add(self, key: str, text: str) -> None:
+        if key in self._tokens:
+            return
+        tokens = frozenset(name_tokens(text))
+        self._tokens[key] = tokens
+        for token in tokens:
+            keys = self._postings.get(token)
+            if keys is None:
+                keys = self._postings[token] = set()
+                insort(self._sorted, token)
+            keys.add(key)
+
+    def remove(self, key: str) -> None:
+        tokens = self._tokens.pop(key, None)
+        if tokens is None:
+            return
+        for token in tokens:
+            keys = self._postings.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[token]
+                    del self._sorted[bisect_left(self._sorted, token)]
+
+    def tokens_of(self, key: str) -> frozenset[str]:
+        return self._tokens.get(key, frozenset())
+
+    def _with_prefix(self, prefix: str):
+        i = bisect_left(self._sorted, prefix)
+        while i < len(self._sorted) and self._sorted[i].startswith(prefix):
+            yield self._sorted[i]
+            i += 1
+
+    def matches(self, tokens: list[str], prefix: str | None) -> set[str]:
+        """Keys whose names contain every token and a word starting with prefix"""
+        if not tokens and prefix is None:
+            return set()
+
+        result: set[str] | None = None
+        # Rarest tokens first keeps the intersections small
+        for token in sorted(tokens, key=lambda t: len(self._postings.get(t, ()))):
+            keys = self._postings.get(token)
+            if not keys:
+                return set()
+            result = set(keys) if result is None else result & keys
+            if not result:
+                return result
+
+        if prefix is None:
+            return result
+        if result is not None:
+            return {
+                key
+                for key in result
+                if any(token.startswith(prefix) for token in self._tokens[key])
+            }
+        matched: set[str] = set()
+        for token in self._with_prefix(prefix):
+            matched.update(self._postings[token])
+        return matched
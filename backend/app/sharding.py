@@ -0,0 +1,469 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import time
+from typing import Annotated, AsyncIterator, Awaitable, Callable, List, TypeVar
+
+import httpx
+from fastapi import Header, HTTPException, status
+from pydantic import BaseModel, TypeAdapter
+
+from . import schemas
+from .auth import SECRET_KEY
+from .hash_ring import HashRing
+from .store import TrackerStore
+
+logger = logging.getLogger(__name__)
+# httpx logs every request at INFO, that is every forwarded announce
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Base URLs of every tracker node, listed the same way on all of them. Files
+# are spread over the nodes by hash, empty runs a single tracker
+TRACKER_SHARDS = [
+    url.strip().rstrip("/")
+    for url in os.getenv("TRACKER_SHARDS", "").split(",")
+    if url.strip()
+]
+# This node's URL as listed in TRACKER_SHARDS
+TRACKER_SHARD_SELF = os.getenv("TRACKER_SHARD_SELF", "").strip().rstrip("/")
+# Requests to another node fail after this long
+TRACKER_SHARD_TIMEOUT_SECONDS = float(os.getenv("TRACKER_SHARD_TIMEOUT_SECONDS", 5))
+SHARD_TOKEN_HEADER = "X-Shard-Token"
+# Files of a streamed announce waiting for each node, the stream is read no
+# faster than the slowest node takes its part
+SHARD_STREAM_QUEUE_FILES = 1000
+# Bytes of NDJSON sent to a node at once
+SHARD_STREAM_WRITE_BYTES = 64 * 1024
+
+peers_adapter = TypeAdapter(List[schemas.ShardPeerInfo])
+search_results_adapter = TypeAdapter(List[schemas.SearchResult])
+
+T = TypeVar("T")
+
+
+def shard_token() -> str:
+    """Token the nodes authenticate each other with, derived from SECRET_KEY"""
+    return hmac.new(
+        (SECRET_KEY or "").encode(), b"peershare-shard", hashlib.sha256
+    ).hexdigest()
+
+
+def verify_shard_token(
+    x_shard_token: Annotated[str | None, Header()] = None,
+) -> None:
+    """Dependency of the routes only other tracker nodes may call"""
+    if not TRACKER_SHARDS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    if x_shard_token is None or not hmac.compare_digest(x_shard_token, shard_token()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+
+
+class ShardUnavailable(Exception):
+    """Another tracker node did not answer, the request can't be completed"""
+
+    def __init__(self, node: str, reason: str):
+        super().__init__(f"Tracker node {node} unavailable: {reason}")
+        self.node = node
+
+
+class ShardedTrackerStore(TrackerStore):
+    """Spreads the file/peer index over several tracker nodes by file hash.
+
+    Each node keeps the files it owns on the `HashRing`, with the sessions
+    sharing them, in its local store. Announces are split and the parts
+    forwarded to their owners, every node gets one (maybe empty) so files
+    that moved or were dropped go away everywhere. Heartbeats are sent to
+    all nodes, searches fan out to all of them and the ranked pages are
+    merged. Peer lookups go to the owner of the file. Changes are published
+    to the `events` listeners of the node owning the file.
+    """
+
+    def __init__(self, local: TrackerStore, nodes: List[str], self_url: str):
+        if self_url not in nodes:
+            raise RuntimeError(
+                f"TRACKER_SHARD_SELF {self_url!r} is not one of TRACKER_SHARDS"
+            )
+        self.local = local
+        self.nodes = nodes
+        self.self_url = self_url
+        self.ring = HashRing(nodes)
+        self._client: httpx.AsyncClient | None = None
+
+        self.forwarded = 0
+        self.failures = 0
+        self.partial_searches = 0
+        self.last_search_ms = 0.0
+
+    def _http(self) -> httpx.AsyncClient:
+        # Created on first use, it belongs to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=TRACKER_SHARD_TIMEOUT_SECONDS,
+                headers={SHARD_TOKEN_HEADER: shard_token()},
+            )
+        return self._client
+
+    async def _post(self, node: str, path: str, body: BaseModel) -> httpx.Response:
+        """POST to another node, 409 is returned, other errors raised"""
+        return await self._send(node, path, body.model_dump_json(), "application/json")
+
+    async def _post_lines(
+        self, node: str, path: str, first: BaseModel, rest: AsyncIterator[BaseModel]
+    ) -> httpx.Response:
+        """POST models to another node as NDJSON, sent as they come"""
+
+        async def lines():
+            buffer = bytearray(first.model_dump_json().encode() + b"\n")
+            async for item in rest:
+                buffer += item.model_dump_json().encode() + b"\n"
+                if len(buffer) >= SHARD_STREAM_WRITE_BYTES:
+                    yield bytes(buffer)
+                    buffer.clear()
+            yield bytes(buffer)
+
+        return await self._send(node, path, lines(), "application/x-ndjson")
+
+    async def _send(
+        self, node: str, path: str, content, content_type: str
+    ) -> httpx.Response:
+        self.forwarded += 1
+        try:
+            response = await self._http().post(
+                f"{node}{path}",
+                content=content,
+                headers={"Content-Type": content_type},
+            )
+        except httpx.HTTPError as e:
+            self.failures += 1
+            raise ShardUnavailable(node, str(e) or type(e).__name__) from e
+        if response.is_error and response.status_code != status.HTTP_409_CONFLICT:
+            self.failures += 1
+            raise ShardUnavailable(node, f"HTTP {response.status_code}")
+        return response
+
+    async def _on_every_node(
+        self, apply: Callable[[str], Awaitable[T]]
+    ) -> List[T | BaseException]:
+        return await asyncio.gather(
+            *(apply(node) for node in self.nodes), return_exceptions=True
+        )
+
+    @staticmethod
+    def _raise_first(results: List) -> None:
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def load(self, db):
+        await self.local.load(db)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # Every node publishes the changes of its own part, the results returned
+    # here carry none so they are not published twice
+
+    async def _upsert_file_announcement(self, db, payload, client_ip, public_ip):
+        parts = self.ring.split(payload.files, key=lambda file: file.file_hash)
+
+        async def apply(node: str) -> schemas.AnnounceResult:
+            part = payload.model_copy(update={"files": parts.get(node, [])})
+            if node == self.self_url:
+                return await self.local.upsert_file_announcement(
+                    db, part, client_ip, public_ip
+                )
+            response = await self._post(
+                node,
+                "/shard/announce",
+                schemas.ShardAnnounce(
+                    announce=part, client_ip=client_ip, public_ip=public_ip
+                ),
+            )
+            return schemas.AnnounceResult.model_validate_json(response.content)
+
+        results = await self._on_every_node(apply)
+        self._raise_first(results)
+        return schemas.AnnounceResult(
+            announced=sum(result.announced for result in results),
+            version=payload.version,
+        )
+
+    async def _stream_file_announcement(
+        self, db, header, files, client_ip, public_ip, on_change
+    ):
+        # Every node streams its part in, fed through a bounded queue. A bad
+        # record or a failed node cancels them all, each leaves the session
+        # as it was
+        queues: dict[str, asyncio.Queue] = {
+            node: asyncio.Queue(SHARD_STREAM_QUEUE_FILES) for node in self.nodes
+        }
+
+        async def part(node: str) -> AsyncIterator[schemas.FileBase]:
+            while (file := await queues[node].get()) is not None:
+                yield file
+
+        async def apply(node: str) -> schemas.AnnounceResult:
+            if node == self.self_url:
+                return await self.local.stream_file_announcement(
+                    db, header, part(node), client_ip, public_ip
+                )
+            response = await self._post_lines(
+                node,
+                "/shard/announce/stream",
+                schemas.ShardAnnounceStream(
+                    header=header, client_ip=client_ip, public_ip=public_ip
+                ),
+                part(node),
+            )
+            return schemas.AnnounceResult.model_validate_json(response.content)
+
+        async def split() -> None:
+            async for file in files:
+                await queues[self.ring.owner(file.file_hash)].put(file)
+            for queue in queues.values():
+                await queue.put(None)
+
+        splitter = asyncio.ensure_future(split())
+        nodes = [asyncio.ensure_future(apply(node)) for node in self.nodes]
+        try:
+            await asyncio.wait([splitter, *nodes], return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            pending = [task for task in [splitter, *nodes] if not task.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        # A bad record first, cancelled tasks only follow another failure
+        for task in [splitter, *nodes]:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+        results = [task.result() for task in nodes]
+        return schemas.AnnounceResult(
+            announced=sum(result.announced for result in results),
+            version=header.version,
+        )
+
+    async def _apply_file_delta(self, db, payload, client_ip, public_ip):
+        added = self.ring.split(payload.added, key=lambda file: file.file_hash)
+        removed = self.ring.split(payload.removed, key=lambda file_hash: file_hash)
+
+        async def apply(node: str) -> schemas.AnnounceResult | None:
+            # Nodes without changes still move to the new library version
+            part = payload.model_copy(
+                update={"added": added.get(node, []), "removed": removed.get(node, [])}
+            )
+            if node == self.self_url:
+                return await self.local.apply_file_delta(db, part, client_ip, public_ip)
+            response = await self._post(
+                node,
+                "/shard/announce/delta",
+                schemas.ShardAnnounceDelta(
+                    delta=part, client_ip=client_ip, public_ip=public_ip
+                ),
+            )
+            if response.status_code == status.HTTP_409_CONFLICT:
+                return None
+            return schemas.AnnounceResult.model_validate_json(response.content)
+
+        results = await self._on_every_node(apply)
+        self._raise_first(results)
+        # One node out of sync is enough, the full announce fixes them all
+        if any(result is None for result in results):
+            return None
+        return schemas.AnnounceResult(
+            announced=sum(result.announced for result in results),
+            version=payload.version,
+        )
+
+    async def _heartbeats(self, db, body: schemas.ShardHeartbeats) -> int:
+        async def apply(node: str) -> int:
+            if node != self.self_url:
+                response = await self._post(node, "/shard/heartbeats", body)
+                return response.json()["updated"]
+            if body.load is not None:
+                user_id, ip_address, port = body.sessions[0]
+                return await self.local.update_last_heartbeat(
+                    db, user_id, ip_address, port, body.load
+                )
+            return await self.local.update_last_heartbeats(db, body.sessions)
+
+        updated = 0
+        for result in await self._on_every_node(apply):
+            if isinstance(result, ShardUnavailable):
+                # Its sessions expire if the node stays unreachable
+                logger.warning(f"Heartbeats not forwarded: {result}")
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                # A session lives on every node holding some of its files
+                updated = max(updated, result)
+        return updated
+
+    async def update_last_heartbeat(self, db, user_id, ip_address, port, load=None):
+        return await self._heartbeats(
+            db,
+            schemas.ShardHeartbeats(sessions=[(user_id, ip_address, port)], load=load),
+        )
+
+    async def update_last_heartbeats(self, db, sessions):
+        if not sessions:
+            return 0
+        return await self._heartbeats(db, schemas.ShardHeartbeats(sessions=sessions))
+
+    async def search_files(
+        self,
+        db,
+        query,
+        limit=50,
+        cursor=None,
+        min_size=None,
+        max_size=None,
+        extension=None,
+        mode="fuzzy",
+    ):
+        search = schemas.ShardSearch(
+            query=query,
+            limit=limit,
+            cursor=cursor,
+            min_size=min_size,
+            max_size=max_size,
+            extension=extension,
+            mode=mode,
+        )
+
+        async def apply(node: str) -> List[schemas.SearchResult]:
+            if node == self.self_url:
+                return await self.local.search_files(db, **search.model_dump())
+            response = await self._post(node, "/shard/search", search)
+            return search_results_adapter.validate_json(response.content)
+
+        start = time.perf_counter()
+        pages = await self._on_every_node(apply)
+        merged = []
+        partial = False
+        for page in pages:
+            if isinstance(page, ShardUnavailable):
+                logger.warning(f"Search without a node: {page}")
+                partial = True
+            elif isinstance(page, BaseException):
+                raise page
+            else:
+                merged.extend(page)
+        if partial:
+            self.partial_searches += 1
+        self.last_search_ms = (time.perf_counter() - start) * 1000
+        # Every node ranked its own files, a file lives on one node only
+        merged.sort(key=lambda result: (-(result.score or 0.0), result.file_hash))
+        return merged[:limit]
+
+    async def get_file_peers(self, db, file_hash):
+        node = self.ring.owner(file_hash)
+        if node == self.self_url:
+            return await self.local.get_file_peers(db, file_hash)
+        self.forwarded += 1
+        try:
+            response = await self._http().get(f"{node}/shard/files/{file_hash}/peers")
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            self.failures += 1
+            raise ShardUnavailable(node, str(e) or type(e).__name__) from e
+        return [
+            schemas.PeerInfo(**peer.model_dump())
+            for peer in peers_adapter.validate_json(response.content)
+        ]
+
+    async def count_file_peers(self, db, file_hashes):
+        parts = self.ring.split(file_hashes, key=lambda file_hash: file_hash)
+
+        async def apply(node: str) -> dict[str, int]:
+            if node not in parts:
+                return {}
+            if node == self.self_url:
+                return await self.local.count_file_peers(db, parts[node])
+            response = await self._post(
+                node,
+                "/shard/files/peer-counts",
+                schemas.ShardFiles(file_hashes=parts[node]),
+            )
+            return response.json()["peers"]
+
+        counts = {}
+        for result in await self._on_every_node(apply):
+            if isinstance(result, ShardUnavailable):
+                # Its files look like they have no peer left, as with search
+                logger.warning(f"Peer counts without a node: {result}")
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                counts.update(result)
+        return counts
+
+    async def files_shared_by(self, db, user_id, file_hashes):
+        parts = self.ring.split(file_hashes, key=lambda file_hash: file_hash)
+
+        async def apply(node: str) -> set[str]:
+            if node not in parts:
+                return set()
+            if node == self.self_url:
+                return await self.local.files_shared_by(db, user_id, parts[node])
+            response = await self._post(
+                node,
+                "/shard/files/shared",
+                schemas.ShardSharedFiles(user_id=user_id, file_hashes=parts[node]),
+            )
+            return set(response.json()["shared"])
+
+        results = await self._on_every_node(apply)
+        self._raise_first(results)
+        return set().union(*results)
+
+    async def count_sessions(self, db):
+        return await self.local.count_sessions(db)
+
+    def file_peer_counts(self, db):
+        return self.local.file_peer_counts(db)
+
+    async def _remove_inactive_peers(self, db, threshold_seconds, batch_size):
+        # Every node expires the sessions it holds on its own
+        return await self.local._remove_inactive_peers(
+            db, threshold_seconds, batch_size
+        )
+
+    async def _remove_user_sessions(self, db, user_id):
+        async def apply(node: str) -> int:
+            if node == self.self_url:
+                result = await self.local.remove_user_sessions(db, user_id)
+                return result.expired
+            response = await self._post(
+                node,
+                "/shard/users/sessions",
+                schemas.ShardUserSessions(user_id=user_id),
+            )
+            return response.json()["removed"]
+
+        removed = 0
+        for result in await self._on_every_node(apply):
+            if isinstance(result, ShardUnavailable):
+                # The sessions it holds expire once their heartbeats fail
+                logger.warning(f"User sessions not removed: {result}")
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                removed = max(removed, result)
+        return schemas.ExpiryResult(expired=removed)
+
+    def next_expiry_in(self, threshold_seconds=60):
+        return self.local.next_expiry_in(threshold_seconds)
+
+    def stats(self) -> dict:
+        return {
+            "nodes": self.nodes,
+            "self": self.self_url,
+            "forwarded": self.forwarded,
+            "failures": self.failures,
+            "partial_searches": self.partial_searches,
+            "last_search_ms": self.last_search_ms,
+        }
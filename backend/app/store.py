@@ -0,0 +1,292 @@
+import abc
+import os
+from typing import AsyncIterable, AsyncIterator
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, events, schemas
+
+TRACKER_STORE = os.getenv("TRACKER_STORE", "sql").lower()  # sql | memory
+TRACKER_STORE_WRITE_THROUGH = os.getenv(
+    "TRACKER_STORE_WRITE_THROUGH", "false"
+).lower() in ("1", "true", "yes")
+
+
+class TrackerStore(abc.ABC):
+    """Index of shared files and the peer sessions holding them.
+
+    Endpoints go through the store instead of calling crud directly, so the
+    file/peer state can live in Postgres or in process memory. Subclasses
+    implement the underscore methods, changes they report are published to
+    the `events` listeners.
+    """
+
+    async def load(self, db: AsyncSession) -> None:
+        """Prepare the store when the tracker starts"""
+
+    async def close(self) -> None:
+        """Release what the store holds when the tracker stops"""
+
+    async def upsert_file_announcement(
+        self,
+        db: AsyncSession,
+        payload: schemas.FileAnnounce,
+        client_ip: str,
+        public_ip: str | None = None,
+    ) -> schemas.AnnounceResult:
+        result = await self._upsert_file_announcement(db, payload, client_ip, public_ip)
+        events.publish(result.added, result.removed)
+        return result
+
+    async def stream_file_announcement(
+        self,
+        db: AsyncSession,
+        header: schemas.AnnounceStreamHeader,
+        files: AsyncIterable[schemas.FileBase],
+        client_ip: str,
+        public_ip: str | None = None,
+    ) -> schemas.AnnounceResult:
+        """Full announce of a streamed library, changes are published in chunks"""
+        return await self._stream_file_announcement(
+            db, header, files, client_ip, public_ip, events.publish
+        )
+
+    async def apply_file_delta(
+        self,
+        db: AsyncSession,
+        payload: schemas.FileAnnounceDelta,
+        client_ip: str,
+        public_ip: str | None = None,
+    ) -> schemas.AnnounceResult | None:
+        result = await self._apply_file_delta(db, payload, client_ip, public_ip)
+        if result is not None:
+            events.publish(result.added, result.removed)
+        return result
+
+    @abc.abstractmethod
+    async def update_last_heartbeat(
+        self,
+        db: AsyncSession,
+        user_id: int,
+        ip_address: str,
+        port: int,
+        load: int | None = None,
+    ) -> int:
+        """Refresh a session and the load it reported, the number updated"""
+
+    @abc.abstractmethod
+    async def update_last_heartbeats(
+        self, db: AsyncSession, sessions: list[tuple[int, str, int]]
+    ) -> int:
+        """Refresh many (user_id, ip_address, port) sessions at once"""
+
+    @abc.abstractmethod
+    async def search_files(
+        self,
+        db: AsyncSession,
+        query: str,
+        limit: int = 50,
+        cursor: tuple[float, str] | None = None,
+        min_size: int | None = None,
+        max_size: int | None = None,
+        extension: str | None = None,
+        mode: schemas.SearchMode = "fuzzy",
+    ) -> list[schemas.SearchResult]:
+        """Files matching the query and the peers sharing them, best first"""
+
+    @abc.abstractmethod
+    async def get_file_peers(
+        self, db: AsyncSession, file_hash: str
+    ) -> list[schemas.PeerInfo]:
+        """Every peer sharing the given file, in no particular order"""
+
+    @abc.abstractmethod
+    async def count_file_peers(
+        self, db: AsyncSession, file_hashes: list[str]
+    ) -> dict[str, int]:
+        """Peers sharing each of the given files, files without any left out"""
+
+    @abc.abstractmethod
+    async def files_shared_by(
+        self, db: AsyncSession, user_id: int, file_hashes: list[str]
+    ) -> set[str]:
+        """The given files some session of the user shares"""
+
+    @abc.abstractmethod
+    async def count_sessions(self, db: AsyncSession) -> int:
+        """Number of peer sessions the store currently holds"""
+
+    @abc.abstractmethod
+    def file_peer_counts(self, db: AsyncSession) -> AsyncIterator[tuple[str, str, int]]:
+        """Every shared file as (file_hash, file_name, number of peers)"""
+
+    async def remove_inactive_peers(
+        self,
+        db: AsyncSession,
+        threshold_seconds: int = 60,
+        batch_size: int | None = None,
+    ) -> schemas.ExpiryResult:
+        result = await self._remove_inactive_peers(db, threshold_seconds, batch_size)
+        events.publish([], result.removed)
+        return result
+
+    async def remove_user_sessions(
+        self, db: AsyncSession, user_id: int
+    ) -> schemas.ExpiryResult:
+        """Drop every session of a user, e.g. before the user is deleted"""
+        result = await self._remove_user_sessions(db, user_id)
+        events.publish([], result.removed)
+        return result
+
+    def next_expiry_in(self, threshold_seconds: int = 60) -> float | None:
+        """Seconds until the next session lease may expire, None if unknown"""
+        return None
+
+    @abc.abstractmethod
+    async def _upsert_file_announcement(
+        self,
+        db: AsyncSession,
+        payload: schemas.FileAnnounce,
+        client_ip: str,
+        public_ip: str | None,
+    ) -> schemas.AnnounceResult:
+        """Replace the library of a session, reporting what changed"""
+
+    @abc.abstractmethod
+    async def _stream_file_announcement(
+        self,
+        db: AsyncSession,
+        header: schemas.AnnounceStreamHeader,
+        files: AsyncIterable[schemas.FileBase],
+        client_ip: str,
+        public_ip: str | None,
+        on_change: events.ChangeListener,
+    ) -> schemas.AnnounceResult:
+        """Replace the library of a session, passing changes to `on_change`"""
+
+    @abc.abstractmethod
+    async def _apply_file_delta(
+        self,
+        db: AsyncSession,
+        payload: schemas.FileAnnounceDelta,
+        client_ip: str,
+        public_ip: str | None,
+    ) -> schemas.AnnounceResult | None:
+        """Apply a delta, None when it does not follow the session's version"""
+
+    @abc.abstractmethod
+    async def _remove_inactive_peers(
+        self, db: AsyncSession, threshold_seconds: int, batch_size: int | None
+    ) -> schemas.ExpiryResult:
+        """Delete the sessions that stopped sending heartbeats"""
+
+    @abc.abstractmethod
+    async def _remove_user_sessions(
+        self, db: AsyncSession, user_id: int
+    ) -> schemas.ExpiryResult:
+        """Delete the sessions of a user"""
+
+
+class SqlTrackerStore(TrackerStore):
+    """Keeps all tracker state in Postgres"""
+
+    async def _upsert_file_announcement(self, db, payload, client_ip, public_ip):
+        return await crud.upsert_file_announcement(db, payload, client_ip, public_ip)
+
+    async def _stream_file_announcement(
+        self, db, header, files, client_ip, public_ip, on_change
+    ):
+        return await crud.stream_file_announcement(
+            db, header, files, client_ip, public_ip, on_change=on_change
+        )
+
+    async def _apply_file_delta(self, db, payload, client_ip, public_ip):
+        return await crud.apply_file_delta(db, payload, client_ip, public_ip)
+
+    async def update_last_heartbeat(self, db, user_id, ip_address, port, load=None):
+        return await crud.update_last_heartbeat(db, user_id, ip_address, port, load)
+
+    async def update_last_heartbeats(self, db, sessions):
+        return await crud.update_last_heartbeats(db, sessions)
+
+    async def search_files(
+        self,
+        db,
+        query,
+        limit=50,
+        cursor=None,
+        min_size=None,
+        max_size=None,
+        extension=None,
+        mode="fuzzy",
+    ):
+        rows = await crud.search_files(
+            db,
+            query,
+            limit=limit,
+            cursor=cursor,
+            min_size=min_size,
+            max_size=max_size,
+            extension=extension,
+            mode=mode,
+        )
+        return [
+            schemas.SearchResult(
+                file_name=row.file_name,
+                file_hash=row.file_hash,
+                file_size=row.file_size,
+                score=row.score,
+                peers=row.peers,
+            )
+            for row in rows
+        ]
+
+    async def get_file_peers(self, db, file_hash):
+        rows = await crud.get_file_peers(db, file_hash)
+        return [schemas.PeerInfo.model_validate(row._mapping) for row in rows]
+
+    async def count_file_peers(self, db, file_hashes):
+        return await crud.count_file_peers(db, file_hashes)
+
+    async def files_shared_by(self, db, user_id, file_hashes):
+        return await crud.get_files_shared_by(db, user_id, file_hashes)
+
+    async def count_sessions(self, db):
+        return await crud.count_sessions(db)
+
+    async def file_peer_counts(self, db):
+        async for row in crud.get_file_peer_counts(db):
+            yield row.file_hash, row.file_name, row.peers
+
+    async def _remove_inactive_peers(self, db, threshold_seconds, batch_size):
+        return await crud.remove_inactive_peers(db, threshold_seconds, batch_size)
+
+    async def _remove_user_sessions(self, db, user_id):
+        return await crud.remove_user_sessions(db, user_id)
+
+
+def create_store() -> TrackerStore:
+    """Create the store selected by TRACKER_STORE, sharded with TRACKER_SHARDS"""
+    if TRACKER_STORE == "memory":
+        from .memory_store import MemoryTrackerStore
+
+        store = MemoryTrackerStore(write_through=TRACKER_STORE_WRITE_THROUGH)
+    elif TRACKER_STORE == "sql":
+        store = SqlTrackerStore()
+    else:
+        raise RuntimeError(f"Unknown TRACKER_STORE: {TRACKER_STORE}")
+
+    from .sharding import TRACKER_SHARD_SELF, TRACKER_SHARDS, ShardedTrackerStore
+
+    if not TRACKER_SHARDS:
+        return store
+    # Each node keeps its share of the index in memory, Postgres only holds
+    # the accounts all nodes share (peer_sessions rows need their user)
+    if TRACKER_STORE != "memory" or TRACKER_STORE_WRITE_THROUGH:
+        raise RuntimeError(
+            "TRACKER_SHARDS needs TRACKER_STORE=memory without write-through"
+        )
+    return ShardedTrackerStore(store, TRACKER_SHARDS, TRACKER_SHARD_SELF)
+
+
+tracker_store = create_store()
@@ -0,0 +1,194 @@
+import asyncio
+import os
+from collections import defaultdict
+from typing import AsyncIterator, List
+
+from . import events, schemas
+from .search_index import name_tokens, text_query
+
+# Open subscription streams across all clients, more are refused
+SUBSCRIPTION_MAX_STREAMS = int(os.getenv("SUBSCRIPTION_MAX_STREAMS", 10000))
+# A comment is sent on idle streams this often, keeps proxies from closing them
+SUBSCRIPTION_KEEPALIVE_SECONDS = float(os.getenv("SUBSCRIPTION_KEEPALIVE_SECONDS", 15))
+# Events waiting to be sent per stream. A client falling further behind gets
+# an `overflow` event and should search again
+SUBSCRIPTION_QUEUE_SIZE = 256
+
+
+class _Query:
+    """Text query of a stream, matches names like a `mode=text` search"""
+
+    __slots__ = ("stream", "query", "words", "prefix")
+
+    def __init__(self, stream: "Stream", query: str):
+        self.stream = stream
+        self.query = query
+        words, self.prefix = text_query(query)
+        self.words = frozenset(words)
+
+    def anchor(self) -> str:
+        # The longest word is the most selective one to index the query by
+        return max(self.words, key=len) if self.words else self.prefix
+
+    def matches(self, tokens: set[str]) -> bool:
+        return self.words <= tokens and (
+            self.prefix is None or any(t.startswith(self.prefix) for t in tokens)
+        )
+
+
+class Stream:
+    """Queries and hashes a client subscribed to, with its pending events"""
+
+    def __init__(self, queries: List[str], hashes: List[str]):
+        self.queries = [_Query(self, query) for query in queries]
+        self.hashes = hashes
+        self.queue: asyncio.Queue[schemas.SubscriptionEvent] = asyncio.Queue(
+            SUBSCRIPTION_QUEUE_SIZE
+        )
+        self.overflowed = False
+        self.sent = 0
+
+    def push(self, event: schemas.SubscriptionEvent) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class SubscriptionRegistry:
+    """Search queries and file hashes clients wait for, matched on announces.
+
+    Follows the `events` of the file/peer index: a file gaining a peer is
+    pushed to every stream subscribed to its hash or to a query its name
+    matches. Queries are indexed by their longest word (by their prefix
+    when they have no whole word), so a file is only checked against the
+    queries sharing one of its tokens. Everything runs on the event loop,
+    so no locking is needed. Announces made to other tracker processes are
+    not seen.
+    """
+
+    def __init__(self):
+        self._streams: set[Stream] = set()
+        self._by_hash: defaultdict[str, set[Stream]] = defaultdict(set)
+        self._by_word: defaultdict[str, set[_Query]] = defaultdict(set)
+        self._by_prefix: defaultdict[str, set[_Query]] = defaultdict(set)
+        self.opened = 0
+        self.refused = 0
+        self.events = 0
+        self.overflows = 0
+
+    def open(self, queries: List[str], hashes: List[str]) -> Stream | None:
+        """Register a stream, None when SUBSCRIPTION_MAX_STREAMS are open"""
+        if len(self._streams) >= SUBSCRIPTION_MAX_STREAMS:
+            self.refused += 1
+            return None
+        stream = Stream(queries, hashes)
+        self._streams.add(stream)
+        for file_hash in hashes:
+            self._by_hash[file_hash].add(stream)
+        for query in stream.queries:
+            self._query_index(query)[query.anchor()].add(query)
+        self.opened += 1
+        return stream
+
+    def close(self, stream: Stream) -> None:
+        self._streams.discard(stream)
+        for file_hash in stream.hashes:
+            self._discard(self._by_hash, file_hash, stream)
+        for query in stream.queries:
+            self._discard(self._query_index(query), query.anchor(), query)
+
+    def _query_index(self, query: _Query) -> defaultdict[str, set[_Query]]:
+        return self._by_word if query.words else self._by_prefix
+
+    @staticmethod
+    def _discard(index: defaultdict[str, set], key: str, value) -> None:
+        members = index.get(key)
+        if members is not None:
+            members.discard(value)
+            if not members:
+                del index[key]
+
+    def _matching_queries(self, tokens: set[str]) -> set[_Query]:
+        candidates = set()
+        for token in tokens:
+            candidates.update(self._by_word.get(token, ()))
+            if self._by_prefix:
+                for size in range(1, len(token) + 1):
+                    candidates.update(self._by_prefix.get(token[:size], ()))
+        return {query for query in candidates if query.matches(tokens)}
+
+    def apply(self, added: List[schemas.FileBase], removed: List[str]) -> None:
+        """Push the files that gained a peer to the streams waiting for them"""
+        if not self._streams:
+            return
+        # A file announced by several peers at once is sent once per stream
+        matches: dict[tuple[Stream, str], schemas.SubscriptionEvent] = {}
+
+        def match(stream: Stream, file: schemas.FileBase, subscription: str):
+            event = matches.get((stream, file.file_hash))
+            if event is None:
+                event = schemas.SubscriptionEvent(**file.model_dump(), matches=[])
+                matches[stream, file.file_hash] = event
+            if subscription not in event.matches:
+                event.matches.append(subscription)
+
+        seen: set[str] = set()
+        for file in added:
+            if file.file_hash in seen:
+                continue
+            seen.add(file.file_hash)
+            for stream in self._by_hash.get(file.file_hash, ()):
+                match(stream, file, file.file_hash)
+            if self._by_word or self._by_prefix:
+                tokens = set(name_tokens(file.file_name))
+                for query in self._matching_queries(tokens):
+                    match(query.stream, file, query.query)
+
+        for (stream, _), event in matches.items():
+            stream.push(event)
+            self.events += 1
+
+    async def sse(self, stream: Stream) -> AsyncIterator[bytes]:
+        """Server-Sent Events frames of a stream, closed when iteration stops.
+
+        Matches are `file` events, a comment is sent on idle streams and an
+        `overflow` event when events were dropped for a slow client.
+        """
+        try:
+            while True:
+                if stream.overflowed and stream.queue.empty():
+                    stream.overflowed = False
+                    self.overflows += 1
+                    yield b"event: overflow\ndata: {}\n\n"
+                    continue
+                try:
+                    event = await asyncio.wait_for(
+                        stream.queue.get(), SUBSCRIPTION_KEEPALIVE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                stream.sent += 1
+                yield (
+                    f"id: {stream.sent}\nevent: file\n"
+                    f"data: {event.model_dump_json()}\n\n"
+                ).encode()
+        finally:
+            self.close(stream)
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self._streams),
+            "hashes": len(self._by_hash),
+            "queries": sum(len(queries) for queries in self._by_word.values())
+            + sum(len(queries) for queries in self._by_prefix.values()),
+            "opened": self.opened,
+            "refused": self.refused,
+            "events": self.events,
+            "overflows": self.overflows,
+        }
+
+
+subscriptions = SubscriptionRegistry()
+events.subscribe(subscriptions.apply)
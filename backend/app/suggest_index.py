@@ -0,0 +1,210 @@
+import asyncio
+import heapq
+import logging
+import os
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import Iterator, List
+
+from . import database, events, schemas
+from .search_index import name_tokens, text_query
+from .store import TrackerStore
+
+logger = logging.getLogger(__name__)
+
+# Rebuild from the store this often, picks up changes made by other tracker
+# processes, 0 disables it
+SUGGEST_REFRESH_SECONDS = float(os.getenv("SUGGEST_REFRESH_SECONDS", 300))
+# Prefixes up to this long keep their best tokens precomputed, longer ones
+# cover few enough tokens to be ranked on every lookup
+CACHED_PREFIX_LENGTH = 3
+# Candidates kept per precomputed prefix. More than any limit, so a few of
+# them losing peers doesn't force a recomputation
+CACHED_CANDIDATES = 64
+
+
+def _rank(item: tuple[str, int]) -> tuple[int, int]:
+    # Most peers first, shorter tokens first among equals
+    return item[1], -len(item[0])
+
+
+class _File:
+    __slots__ = ("tokens", "peers")
+
+    def __init__(self, tokens: tuple[str, ...], peers: int = 0):
+        self.tokens = tokens
+        self.peers = peers
+
+
+class _TopTokens:
+    """Best tokens of a prefix. No token left out has more than `floor` peers"""
+
+    __slots__ = ("weights", "floor")
+
+    def __init__(self, weights: dict[str, int], floor: int):
+        self.weights = weights
+        self.floor = floor
+
+
+class SuggestIndex:
+    """Prefix index of the tokens of shared file names, for autocompletion.
+
+    A token weighs the number of peers sharing files whose name contains it.
+    Weights follow the `events` of the file/peer index, and short prefixes
+    keep their best tokens precomputed, so a lookup never ranks more than a
+    few dozen candidates.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files: dict[str, _File] = {}
+        self._weights: dict[str, int] = {}
+        self._tokens: list[str] = []  # sorted, the ones with a weight
+        self._top: dict[str, _TopTokens] = {}
+        self.lookups = 0
+        self.recomputations = 0
+        self.refreshes = 0
+
+    async def load(self, store: TrackerStore, db) -> None:
+        """Replace the index with the files the store currently holds"""
+        files: dict[str, _File] = {}
+        weights: defaultdict[str, int] = defaultdict(int)
+        async for file_hash, file_name, peers in store.file_peer_counts(db):
+            tokens = tuple(dict.fromkeys(name_tokens(file_name)))
+            files[file_hash] = _File(tokens, peers)
+            for token in tokens:
+                weights[token] += peers
+
+        with self._lock:
+            self._files = files
+            self._weights = dict(weights)
+            self._tokens = sorted(weights)
+            self._top = {}
+            self.refreshes += 1
+        logger.info(
+            f"Loaded {len(self._tokens)} tokens of {len(self._files)} files "
+            "into the suggest index"
+        )
+
+    def apply(self, added: List[schemas.FileBase], removed: List[str]) -> None:
+        """Follow a change of the file/peer index"""
+        changes: defaultdict[str, int] = defaultdict(int)
+        with self._lock:
+            for file in added:
+                entry = self._files.get(file.file_hash)
+                if entry is None:
+                    entry = _File(tuple(dict.fromkeys(name_tokens(file.file_name))))
+                    self._files[file.file_hash] = entry
+                entry.peers += 1
+                for token in entry.tokens:
+                    changes[token] += 1
+
+            for file_hash in removed:
+                entry = self._files.get(file_hash)
+                if entry is None:
+                    continue
+                entry.peers -= 1
+                if entry.peers <= 0:
+                    del self._files[file_hash]
+                for token in entry.tokens:
+                    changes[token] -= 1
+
+            for token, change in changes.items():
+                if change:
+                    self._reweight(token, self._weights.get(token, 0) + change)
+
+    def _reweight(self, token: str, weight: int) -> None:
+        old = self._weights.get(token, 0)
+        if weight <= 0:
+            weight = 0
+            if old:
+                del self._weights[token]
+                del self._tokens[bisect_left(self._tokens, token)]
+        else:
+            if not old:
+                insort(self._tokens, token)
+            self._weights[token] = weight
+
+        for size in range(1, min(len(token), CACHED_PREFIX_LENGTH) + 1):
+            top = self._top.get(token[:size])
+            if top is None:
+                continue
+            if token in top.weights:
+                if weight:
+                    top.weights[token] = weight
+                else:
+                    del top.weights[token]
+            elif weight > top.floor:
+                top.weights[token] = weight
+                if len(top.weights) > CACHED_CANDIDATES:
+                    lowest = min(top.weights.items(), key=_rank)
+                    del top.weights[lowest[0]]
+                    top.floor = max(top.floor, lowest[1])
+
+    def _scan(self, prefix: str) -> Iterator[tuple[str, int]]:
+        tokens = self._tokens
+        i = bisect_left(tokens, prefix)
+        while i < len(tokens) and tokens[i].startswith(prefix):
+            yield tokens[i], self._weights[tokens[i]]
+            i += 1
+
+    def _best_tokens(self, prefix: str, limit: int) -> list[tuple[str, int]]:
+        if len(prefix) > CACHED_PREFIX_LENGTH:
+            return heapq.nlargest(limit, self._scan(prefix), key=_rank)
+
+        top = self._top.get(prefix)
+        if top is not None:
+            best = heapq.nlargest(limit, top.weights.items(), key=_rank)
+            # Valid unless tokens left out may outweigh the last one
+            if top.floor == 0 or (len(best) == limit and best[-1][1] >= top.floor):
+                return best
+
+        self.recomputations += 1
+        ranked = heapq.nlargest(CACHED_CANDIDATES + 1, self._scan(prefix), key=_rank)
+        floor = ranked.pop()[1] if len(ranked) > CACHED_CANDIDATES else 0
+        self._top[prefix] = _TopTokens(dict(ranked), floor)
+        return ranked[:limit]
+
+    def suggest(self, prefix: str, limit: int = 10) -> list[schemas.Suggestion]:
+        """Completions of the last word of `prefix`, most shared first"""
+        # The words text searches would see, completions can be searched for
+        words, partial = text_query(prefix)
+        if partial is None:
+            return []  # nothing to complete once the last word is finished
+        lead = " ".join(words)
+
+        with self._lock:
+            self.lookups += 1
+            best = self._best_tokens(partial, limit)
+        return [
+            schemas.Suggestion(text=f"{lead} {token}" if lead else token, peers=peers)
+            for token, peers in best
+        ]
+
+    async def run(self, store: TrackerStore) -> None:
+        """Background loop rebuilding the index from the store until cancelled"""
+        if SUGGEST_REFRESH_SECONDS <= 0:
+            return
+        while True:
+            await asyncio.sleep(SUGGEST_REFRESH_SECONDS)
+            try:
+                async with database.SessionLocal() as db:
+                    await self.load(store, db)
+            except Exception as e:
+                logger.error(f"Error while refreshing the suggest index: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "tokens": len(self._tokens),
+                "cached_prefixes": len(self._top),
+                "lookups": self.lookups,
+                "recomputations": self.recomputations,
+                "refreshes": self.refreshes,
+            }
+
+
+suggest_index = SuggestIndex()
+events.subscribe(suggest_index.apply)
@@ -1,5 +1,13 @@
+import base64
+import binascii
+import ipaddress
+import json
+from typing import AsyncIterable, AsyncIterator, List
+
 from fastapi import Request
 
+from . import schemas
+
 
 def get_client_ip(request: Request) -> str:
     """Get the client IP address from the request"""
@@ -9,3 +17,84 @@ def get_client_ip(request: Request) -> str:
     if request.client:
         return request.client.host
     return "unknown"
+
+
+async def iter_ndjson(
+    chunks: AsyncIterable[bytes], max_line_bytes: int
+) -> AsyncIterator[tuple[int, bytes]]:
+    """Split a byte stream into (line number, line), skipping blank lines.
+
+    Raises ValueError when a line grows beyond max_line_bytes, so a client
+    can't make the tracker buffer an unbounded line.
+    """
+    buffer = b""
+    line_no = 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_no += 1
+            if line.strip():
+                yield line_no, line
+        if len(buffer) > max_line_bytes:
+            raise ValueError(
+                f"Line {line_no + 1} is longer than {max_line_bytes} bytes"
+            )
+    if buffer.strip():
+        yield line_no + 1, buffer
+
+
+def escape_like(value: str) -> str:
+    """Escape LIKE wildcards so user input is matched literally"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def encode_cursor(score: float, file_hash: str) -> str:
+    """Encode the position of the last search result as an opaque cursor"""
+    raw = json.dumps([repr(score), file_hash]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    """Decode a cursor created by encode_cursor, raises ValueError if invalid"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        score, file_hash = json.loads(base64.urlsafe_b64decode(padded))
+        return float(score), str(file_hash)
+    except (binascii.Error, TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _network_distance(peer_ip: str | None, requester_ip: str) -> int:
+    """0 = same public address, 1 = same /24 (IPv4) or /64 (IPv6), 2 = elsewhere"""
+    if peer_ip is None:
+        return 2
+    if peer_ip == requester_ip:
+        return 0
+    try:
+        peer = ipaddress.ip_address(peer_ip)
+        requester = ipaddress.ip_address(requester_ip)
+    except ValueError:
+        return 2
+    if peer.version != requester.version:
+        return 2
+    prefix = 24 if peer.version == 4 else 64
+    network = ipaddress.ip_network(f"{requester}/{prefix}", strict=False)
+    return 1 if peer in network else 2
+
+
+def rank_peers(
+    peers: List[schemas.PeerInfo], requester_ip: str, limit: int
+) -> List[schemas.PeerInfo]:
+    """Order peers by closeness to the requester, then load, then freshness"""
+    ranked = sorted(
+        peers,
+        key=lambda peer: (
+            _network_distance(peer.public_ip, requester_ip),
+            peer.load or 0,
+            -peer.last_heartbeat.timestamp(),
+        ),
+    )[:limit]
+    for peer in ranked:
+        peer.same_network = peer.public_ip == requester_ip
+    return ranked
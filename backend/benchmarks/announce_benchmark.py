@@ -0,0 +1,155 @@
+"""Compare the JSON /announce with the streamed NDJSON /announce/stream.
+
+Each library size is announced once per endpoint by a fresh client
+session, through the app in-process. Reports rows/sec and the peak Python
+memory the tracker allocated while handling the request.
+
+Run from the backend directory against a local Postgres:
+
+    python -m benchmarks.announce_benchmark --files 10000 50000 200000
+"""
+
+import argparse
+import hashlib
+import json
+import time
+import tracemalloc
+
+from fastapi.testclient import TestClient
+
+from app import main as tracker
+
+USERNAME = "bench_announce"
+PASSWORD = "bench_password"
+
+
+def make_files(count: int, salt: str):
+    for i in range(count):
+        name = f"{salt}_lecture_notes_{i}.pdf"
+        yield {
+            "file_hash": hashlib.sha256(name.encode()).hexdigest(),
+            "file_name": name,
+            "file_size": i * 1024,
+        }
+
+
+def login(client: TestClient) -> tuple[int, dict]:
+    resp = client.post(
+        "/signup",
+        json={
+            "username": USERNAME,
+            "password": PASSWORD,
+            "email": f"{USERNAME}@bench.local",
+        },
+    )
+    if resp.status_code != 201:
+        resp = client.post("/login", json={"username": USERNAME, "password": PASSWORD})
+    resp.raise_for_status()
+    data = resp.json()
+    return data["user"]["user_id"], {"Authorization": f"Bearer {data['access_token']}"}
+
+
+def json_request(user_id: int, port: int, count: int) -> dict:
+    payload = {
+        "user_id": user_id,
+        "port": port,
+        "ip_address": "10.9.0.1",
+        "files": list(make_files(count, f"json{port}")),
+        "version": 1,
+    }
+    # Serialized up front, so only the tracker's allocations are measured
+    return {
+        "url": "/announce",
+        "content": json.dumps(payload).encode(),
+        "headers": {"Content-Type": "application/json"},
+    }
+
+
+def stream_request(user_id: int, port: int, count: int) -> dict:
+    def body():
+        header = {
+            "user_id": user_id,
+            "port": port,
+            "ip_address": "10.9.0.1",
+            "version": 1,
+        }
+        yield json.dumps(header).encode() + b"\n"
+        for file in make_files(count, f"stream{port}"):
+            yield json.dumps(file).encode() + b"\n"
+
+    return {
+        "url": "/announce/stream",
+        "content": body(),
+        "headers": {"Content-Type": "application/x-ndjson"},
+    }
+
+
+def measure(client, headers, request: dict, count: int) -> dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+    resp = client.post(
+        request["url"],
+        content=request["content"],
+        headers={**headers, **request["headers"]},
+    )
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ok = resp.status_code == 200 and resp.json().get("announced") == count
+    return {
+        "status": resp.status_code,
+        "ok": ok,
+        "seconds": elapsed,
+        "rows_per_sec": count / elapsed if ok else 0.0,
+        "peak_mib": peak / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    report = []
+    with TestClient(tracker.app) as client:
+        user_id, headers = login(client)
+        port = 20000
+        for count in args.files:
+            row = {"files": count}
+            for name, make_request in (
+                ("announce", json_request),
+                ("stream", stream_request),
+            ):
+                port += 1
+                request = make_request(user_id, port, count)
+                row[name] = measure(client, headers, request, count)
+                del request
+                # Empty the library again so the next run starts clean
+                client.post(
+                    "/announce",
+                    json={"user_id": user_id, "port": port, "files": []},
+                    headers=headers,
+                )
+            report.append(row)
+
+            for name in ("announce", "stream"):
+                r = row[name]
+                print(
+                    f"{count:>8} files {name:<9} "
+                    + (
+                        f"{r['rows_per_sec']:10.0f} rows/s"
+                        if r["ok"]
+                        else f"failed ({r['status']})"
+                    )
+                    + f"  {r['seconds']:7.2f} s  peak {r['peak_mib']:8.1f} MiB"
+                )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
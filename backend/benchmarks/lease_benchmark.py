@@ -0,0 +1,283 @@
+"""Compare session expiry with leases in peer_sessions and in partitions.
+
+Runs the same churn twice, first with heartbeats updating
+peer_sessions.last_heartbeat, then with LEASE_BUCKET_SECONDS set so they go
+to the partitioned session_leases table. Each round a share of the peers
+goes offline and as many new ones come online, the others send a heartbeat
+(the batched UDP path) and an expiry cycle runs. Reports heartbeat and
+cleanup latency, the rows updated and deleted per table (each one a dead
+tuple for vacuum), the growth of peer_sessions and how long a VACUUM of the
+tables takes afterwards.
+
+Run from the backend directory against a local Postgres:
+
+    python -m benchmarks.lease_benchmark --sessions 5000 --rounds 40
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import statistics
+import time
+
+from sqlalchemy import delete, text
+
+from app import crud, database, leases, models, schemas
+from app.expiry import ExpiryWorker
+from app.leases import lease_partitions
+from app.store import SqlTrackerStore
+
+USERNAME = "bench_lease"
+LAYOUTS = ("table", "partitioned")
+TABLES = ("peer_sessions", "session_files", "session_leases")
+
+
+def address(port: int) -> str:
+    return f"10.88.{port // 250 % 250}.{port % 250 + 1}"
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+async def ensure_user() -> int:
+    async with database.SessionLocal() as db:
+        user = await crud.get_user_by_username(db, USERNAME)
+        if user is None:
+            user = await crud.create_user(
+                db,
+                schemas.UserCreate(
+                    username=USERNAME,
+                    password_hash="x",
+                    email=f"{USERNAME}@bench.local",
+                ),
+            )
+        return user.user_id
+
+
+async def clear_sessions(user_id: int) -> None:
+    async with database.SessionLocal() as db:
+        await db.execute(
+            delete(models.PeerSession).where(models.PeerSession.user_id == user_id)
+        )
+        await db.commit()
+
+
+async def ensure_catalog(size: int) -> list[str]:
+    """Files the peers share, created once and kept between runs"""
+    hashes = [
+        hashlib.sha256(f"lease-bench:{i}".encode()).hexdigest() for i in range(size)
+    ]
+    async with database.engine.connect() as conn:
+        raw = (await conn.get_raw_connection()).driver_connection
+        existing = await raw.fetchval(
+            "SELECT count(*) FROM files WHERE file_hash = ANY($1::varchar[])", hashes
+        )
+        if existing < size:
+            await raw.execute(
+                "INSERT INTO files (file_hash, file_name, file_size) "
+                "SELECT h, 'lease-bench-' || h, 1 FROM unnest($1::varchar[]) h "
+                "ON CONFLICT DO NOTHING",
+                hashes,
+            )
+            await conn.commit()
+    return hashes
+
+
+async def connect_peers(
+    user_id: int, ports: list[int], files: int, catalog: list[str], rng
+) -> None:
+    """Sessions coming online with their libraries, as announces would add them"""
+    async with database.engine.connect() as conn:
+        raw = (await conn.get_raw_connection()).driver_connection
+        await raw.copy_records_to_table(
+            "peer_sessions",
+            records=[(user_id, address(port), port, 1) for port in ports],
+            columns=["user_id", "ip_address", "port", "library_version"],
+        )
+        rows = await raw.fetch(
+            "SELECT session_id FROM peer_sessions "
+            "WHERE user_id = $1 AND port = ANY($2::int[])",
+            user_id,
+            ports,
+        )
+        await raw.copy_records_to_table(
+            "session_files",
+            records=[
+                (row[0], file_hash)
+                for row in rows
+                for file_hash in rng.sample(catalog, files)
+            ],
+            columns=["session_id", "file_hash"],
+        )
+        if leases.enabled():
+            await raw.copy_records_to_table(
+                "session_leases",
+                records=[(row[0], leases.current_bucket()) for row in rows],
+                columns=["session_id", "bucket"],
+            )
+        await conn.commit()
+
+
+async def table_stats() -> dict:
+    # Statistics are flushed by the backends as their connections close
+    await database.engine.dispose()
+    await asyncio.sleep(1)
+    async with database.engine.connect() as conn:
+        rows = (
+            await conn.execute(
+                text(
+                    "SELECT CASE WHEN relname LIKE 'session_leases_%' "
+                    "THEN 'session_leases' ELSE relname END AS name, "
+                    "sum(n_tup_ins) AS ins, sum(n_tup_upd) AS upd, "
+                    "sum(n_tup_hot_upd) AS hot_upd, sum(n_tup_del) AS deleted "
+                    "FROM pg_stat_user_tables "
+                    "WHERE relname IN ('peer_sessions', 'session_files') "
+                    "OR relname LIKE 'session_leases_%' GROUP BY 1"
+                )
+            )
+        ).all()
+        size = await conn.scalar(text("SELECT pg_total_relation_size('peer_sessions')"))
+    stats = {name: {"ins": 0, "upd": 0, "hot_upd": 0, "del": 0} for name in TABLES}
+    for row in rows:
+        stats[row.name] = {
+            "ins": int(row.ins),
+            "upd": int(row.upd),
+            "hot_upd": int(row.hot_upd),
+            "del": int(row.deleted),
+        }
+    return {"tables": stats, "peer_sessions_bytes": size}
+
+
+async def vacuum() -> float:
+    start = time.perf_counter()
+    async with database.engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for table in TABLES:
+            await conn.execute(text(f"VACUUM {table}"))
+    return time.perf_counter() - start
+
+
+async def run_layout(layout: str, user_id: int, catalog: list[str], args) -> dict:
+    leases.LEASE_BUCKET_SECONDS = args.bucket if layout == "partitioned" else 0
+    rng = random.Random(args.seed)
+    await clear_sessions(user_id)
+    await lease_partitions.prepare()
+    await vacuum()
+
+    worker = ExpiryWorker(SqlTrackerStore(), threshold_seconds=args.timeout)
+    online = list(range(args.sessions))
+    next_port = args.sessions
+    await connect_peers(user_id, online, args.files, catalog, rng)
+    async with database.engine.begin() as conn:
+        # Plans for the freshly loaded sessions, not for an empty table
+        await conn.execute(text("ANALYZE peer_sessions, session_files"))
+    before = await table_stats()
+
+    heartbeat_times, cleanup_times = [], []
+    expired = 0
+    for _ in range(args.rounds):
+        start = time.monotonic()
+        offline = set(rng.sample(online, int(len(online) * args.churn)))
+        online = [port for port in online if port not in offline]
+        joining = list(range(next_port, next_port + len(offline)))
+        next_port += len(offline)
+        if joining:
+            await connect_peers(user_id, joining, args.files, catalog, rng)
+            online.extend(joining)
+
+        heartbeat_start = time.perf_counter()
+        async with database.SessionLocal() as db:
+            await crud.update_last_heartbeats(
+                db, [(user_id, address(port), port) for port in online]
+            )
+        heartbeat_times.append(time.perf_counter() - heartbeat_start)
+
+        cleanup_start = time.perf_counter()
+        expired += await worker.run_cycle()
+        cleanup_times.append(time.perf_counter() - cleanup_start)
+        await asyncio.sleep(max(0.0, args.interval - (time.monotonic() - start)))
+
+    after = await table_stats()
+    vacuum_s = await vacuum()
+
+    # Let everyone left time out so the next layout starts from scratch
+    await asyncio.sleep(args.timeout + args.bucket + 1)
+    while await worker.run_cycle():
+        pass
+    await clear_sessions(user_id)
+
+    return {
+        "heartbeat_p50_ms": percentile(heartbeat_times, 0.5) * 1000,
+        "cleanup_p50_ms": percentile(cleanup_times, 0.5) * 1000,
+        "cleanup_p99_ms": percentile(cleanup_times, 0.99) * 1000,
+        "cleanup_mean_ms": statistics.fmean(cleanup_times) * 1000,
+        "expired": expired,
+        "rows": {
+            table: {
+                key: after["tables"][table][key] - before["tables"][table][key]
+                for key in ("ins", "upd", "hot_upd", "del")
+            }
+            for table in TABLES
+        },
+        "peer_sessions_growth_kb": (
+            after["peer_sessions_bytes"] - before["peer_sessions_bytes"]
+        )
+        / 1024,
+        "vacuum_ms": vacuum_s * 1000,
+        "partitions_dropped": lease_partitions.stats()["dropped"],
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=5000, help="peers online")
+    parser.add_argument("--files", type=int, default=20, help="files per peer")
+    parser.add_argument("--catalog", type=int, default=100000, help="distinct files")
+    parser.add_argument("--rounds", type=int, default=40)
+    parser.add_argument("--interval", type=float, default=2, help="seconds per round")
+    parser.add_argument(
+        "--churn", type=float, default=0.02, help="share of peers replaced per round"
+    )
+    parser.add_argument("--timeout", type=int, default=45, help="peer timeout seconds")
+    parser.add_argument("--bucket", type=int, default=5, help="lease bucket seconds")
+    parser.add_argument("--layouts", nargs="+", choices=LAYOUTS, default=LAYOUTS)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    async with database.engine.begin() as conn:
+        await conn.run_sync(database.Base.metadata.create_all)
+    user_id = await ensure_user()
+    catalog = await ensure_catalog(args.catalog)
+
+    report = {}
+    for layout in args.layouts:
+        report[layout] = r = await run_layout(layout, user_id, catalog, args)
+        print(
+            f"{layout:<12} heartbeat p50 {r['heartbeat_p50_ms']:8.2f} ms  "
+            f"cleanup p50 {r['cleanup_p50_ms']:8.2f} ms  "
+            f"p99 {r['cleanup_p99_ms']:8.2f} ms  expired {r['expired']}"
+        )
+        for table, rows in r["rows"].items():
+            print(
+                f"{'':<12} {table:<15} updated {rows['upd']:>9} "
+                f"(hot {rows['hot_upd']:>9})  deleted {rows['del']:>9}"
+            )
+        print(
+            f"{'':<12} peer_sessions grew {r['peer_sessions_growth_kb']:.0f} kB, "
+            f"vacuum {r['vacuum_ms']:.1f} ms, "
+            f"partitions dropped {r['partitions_dropped']}"
+        )
+    await database.engine.dispose()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
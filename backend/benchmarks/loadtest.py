@@ -0,0 +1,347 @@
+"""Load test the tracker with many virtual peers over its HTTP API.
+
+Every virtual peer announces a library (log-normally distributed sizes),
+pings on an interval, searches with a mix of queries and now and then goes
+offline and comes back with a changed library. Reports throughput and
+p50/p99 latency per endpoint plus the database row counts, and can save
+them as JSON to compare runs between commits.
+
+Run from the backend directory against a local Postgres, either with the
+app in-process or against a running tracker:
+
+    python -m benchmarks.loadtest --peers 2000 --duration 60 --json run.json
+    python -m benchmarks.loadtest --url http://localhost:8000 --peers 500
+    python -m benchmarks.loadtest --peers 2000 --compare run.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import statistics
+import subprocess
+import time
+from contextlib import AsyncExitStack
+from datetime import timedelta
+
+import httpx
+from sqlalchemy import delete, func, select
+
+from app import auth, crud, database, models, schemas
+
+WORDS = [
+    "physics", "chemistry", "maths", "biology", "notes", "lecture", "chapter",
+    "assignment", "solutions", "exam", "midterm", "final", "lab", "report",
+    "calculus", "algebra", "mechanics", "thermo", "quantum", "organic",
+]  # fmt: skip
+
+USER_PREFIX = "loadtest_"
+OPERATIONS = ("announce", "ping", "search")
+
+
+def file_entry(ident: int) -> dict:
+    name = (
+        f"{WORDS[ident % len(WORDS)]}_{WORDS[ident // len(WORDS) % len(WORDS)]}"
+        f"_{ident}.pdf"
+    )
+    return {
+        "file_hash": hashlib.sha256(name.encode()).hexdigest(),
+        "file_name": name,
+        "file_size": ident * 1024,
+    }
+
+
+def make_library(rng: random.Random, mean_files: int, catalog: int) -> list[dict]:
+    """Library of a peer: most are small, a few are very large"""
+    sigma = 1.0
+    size = int(rng.lognormvariate(math.log(max(mean_files, 1)) - sigma**2 / 2, sigma))
+    # Popular files (low idents) are shared by many peers
+    idents = {int(rng.paretovariate(1.2) * 10) % catalog for _ in range(size)}
+    return [file_entry(i) for i in idents]
+
+
+def make_query(rng: random.Random) -> str:
+    """Query mix: words, prefixes, two word phrases and misses"""
+    kind = rng.random()
+    if kind < 0.4:
+        return rng.choice(WORDS)
+    if kind < 0.6:
+        return rng.choice(WORDS)[: rng.randint(2, 4)]
+    if kind < 0.9:
+        return f"{rng.choice(WORDS)}_{rng.choice(WORDS)}"
+    return f"missing{rng.randrange(10**6)}"
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+class Recorder:
+    def __init__(self):
+        self.timings: dict[str, list[float]] = {op: [] for op in OPERATIONS}
+        self.errors: dict[str, int] = {op: 0 for op in OPERATIONS}
+
+    def summary(self, elapsed: float) -> dict:
+        report = {}
+        for op in OPERATIONS:
+            samples = self.timings[op]
+            report[op] = {
+                "count": len(samples),
+                "errors": self.errors[op],
+                "per_sec": len(samples) / elapsed,
+                "mean_ms": statistics.fmean(samples) * 1000 if samples else 0.0,
+                "p50_ms": percentile(samples, 0.50) * 1000 if samples else 0.0,
+                "p99_ms": percentile(samples, 0.99) * 1000 if samples else 0.0,
+            }
+        return report
+
+
+class VirtualPeer:
+    def __init__(self, index: int, user_id: int, token: str, args, seed: int):
+        self.index = index
+        self.user_id = user_id
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.args = args
+        self.rng = random.Random(seed)
+        self.port = 10000 + index
+        self.ip_address = f"10.{index // 62500}.{index // 250 % 250}.{index % 250 + 1}"
+        self.version = 0
+
+    async def request(self, client, recorder, limit, op: str, method: str, url, **kw):
+        async with limit:
+            start = time.perf_counter()
+            try:
+                resp = await client.request(method, url, headers=self.headers, **kw)
+                ok = resp.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            elapsed = time.perf_counter() - start
+        if ok:
+            recorder.timings[op].append(elapsed)
+        else:
+            recorder.errors[op] += 1
+
+    async def announce(self, client, recorder, limit):
+        self.version += 1
+        payload = {
+            "user_id": self.user_id,
+            "port": self.port,
+            "ip_address": self.ip_address,
+            "files": make_library(self.rng, self.args.files, self.args.catalog),
+            "version": self.version,
+        }
+        await self.request(
+            client, recorder, limit, "announce", "POST", "/announce", json=payload
+        )
+
+    async def run(self, client, recorder, limit, deadline: float):
+        args = self.args
+        # Spread the initial announces over the first ping interval
+        await asyncio.sleep(self.rng.uniform(0, args.ping_interval))
+        await self.announce(client, recorder, limit)
+
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * args.ping_interval)
+            if time.monotonic() >= deadline:
+                break
+
+            if self.rng.random() < args.churn:
+                # Offline for a while, then back with a changed library
+                await asyncio.sleep(self.rng.uniform(1, 3) * args.ping_interval)
+                await self.announce(client, recorder, limit)
+                continue
+
+            await self.request(
+                client,
+                recorder,
+                limit,
+                "ping",
+                "POST",
+                "/ping",
+                json={"ip_address": self.ip_address, "port": self.port, "load": 0},
+            )
+            for _ in range(self._searches()):
+                await self.request(
+                    client,
+                    recorder,
+                    limit,
+                    "search",
+                    "GET",
+                    "/search",
+                    params={"q": make_query(self.rng), "limit": 50},
+                )
+
+    def _searches(self) -> int:
+        """Searches per ping interval, Poisson distributed around the mean"""
+        threshold = math.exp(-self.args.searches)
+        count, product = 0, self.rng.random()
+        while product > threshold:
+            count += 1
+            product *= self.rng.random()
+        return count
+
+
+async def ensure_users(count: int) -> list[tuple[int, str]]:
+    users = []
+    async with database.SessionLocal() as db:
+        for i in range(count):
+            username = f"{USER_PREFIX}{i}"
+            user = await crud.get_user_by_username(db, username)
+            if user is None:
+                # A real hash is not needed, tokens are minted directly
+                user = await crud.create_user(
+                    db,
+                    schemas.UserCreate(
+                        username=username,
+                        password_hash="x",
+                        email=f"{username}@bench.local",
+                    ),
+                )
+            token = auth.create_access_token({"sub": username}, timedelta(hours=12))
+            users.append((user.user_id, token))
+    return users
+
+
+async def clear_sessions() -> None:
+    async with database.SessionLocal() as db:
+        loadtest_users = select(models.User.user_id).where(
+            models.User.username.startswith(USER_PREFIX)
+        )
+        await db.execute(
+            delete(models.PeerSession).where(
+                models.PeerSession.user_id.in_(loadtest_users)
+            )
+        )
+        await db.commit()
+
+
+async def row_counts() -> dict:
+    async with database.SessionLocal() as db:
+        return {
+            model.__tablename__: await db.scalar(
+                select(func.count()).select_from(model)
+            )
+            for model in (
+                models.User,
+                models.PeerSession,
+                models.SessionFile,
+                models.File,
+            )
+        }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline: dict) -> None:
+    print(f"\nagainst {baseline.get('commit') or 'baseline'}:")
+    for op in OPERATIONS:
+        new, old = report["results"][op], baseline["results"][op]
+        changes = []
+        for key in ("per_sec", "p50_ms", "p99_ms"):
+            if old[key]:
+                changes.append(f"{key} {(new[key] / old[key] - 1) * 100:+6.1f}%")
+        print(f"{op:<9} " + "  ".join(changes))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="tracker to load, default: the app in-process")
+    parser.add_argument("--peers", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--files", type=int, default=200, help="mean library size")
+    parser.add_argument("--catalog", type=int, default=100000, help="distinct files")
+    parser.add_argument("--ping-interval", type=float, default=5, help="seconds")
+    parser.add_argument(
+        "--searches", type=float, default=0.5, help="searches per ping interval"
+    )
+    parser.add_argument(
+        "--churn", type=float, default=0.02, help="chance to go offline per interval"
+    )
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    args = parser.parse_args()
+
+    async with database.engine.begin() as conn:
+        await conn.run_sync(database.Base.metadata.create_all)
+    users = await ensure_users(args.peers)
+    await clear_sessions()
+
+    recorder = Recorder()
+    async with AsyncExitStack() as stack:
+        if args.url:
+            client = httpx.AsyncClient(
+                base_url=args.url,
+                limits=httpx.Limits(max_connections=args.connections),
+                timeout=30,
+            )
+        else:
+            from app import main as tracker
+
+            await stack.enter_async_context(tracker.lifespan(tracker.app))
+            client = httpx.AsyncClient(
+                # Errors of the app count as 500s instead of aborting the run
+                transport=httpx.ASGITransport(
+                    app=tracker.app, raise_app_exceptions=False
+                ),
+                base_url="http://tracker",
+                timeout=30,
+            )
+        await stack.enter_async_context(client)
+
+        limit = asyncio.Semaphore(args.connections)
+        peers = [
+            VirtualPeer(i, user_id, token, args, args.seed * 100003 + i)
+            for i, (user_id, token) in enumerate(users)
+        ]
+        start = time.monotonic()
+        deadline = start + args.duration
+        await asyncio.gather(
+            *(peer.run(client, recorder, limit, deadline) for peer in peers)
+        )
+        elapsed = time.monotonic() - start
+
+        counts = await row_counts()
+
+    report = {
+        "commit": git_commit(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+        "elapsed_s": elapsed,
+        "results": recorder.summary(elapsed),
+        "row_counts": counts,
+    }
+    await clear_sessions()
+    await database.engine.dispose()
+
+    for op in OPERATIONS:
+        r = report["results"][op]
+        print(
+            f"{op:<9} {r['per_sec']:8.1f} req/s  p50 {r['p50_ms']:8.2f} ms  "
+            f"p99 {r['p99_ms']:8.2f} ms  errors {r['errors']}"
+        )
+    print("rows: " + ", ".join(f"{k} {v}" for k, v in counts.items()))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,260 @@
+"""Compare fuzzy (trigram) and text (token) search on a synthetic catalog.
+
+Loads a catalog of shared files (1M by default) held by a pool of peer
+sessions once, reusing it on later runs, then runs the same query mix
+through both modes of crud.search_files. Reports p50/p99 latency and the
+number of results per query kind, and the share of those results whose
+name holds every word of the query: words out of order or split by
+camelCase only match in text mode. Fuzzy searches need the pg_trgm GIN
+index to be comparable, without it they scan the whole catalog.
+
+Run from the backend directory against a local Postgres:
+
+    python -m benchmarks.search_benchmark --files 1000000
+    python -m benchmarks.search_benchmark --files 1000000 --drop
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import statistics
+import time
+
+from sqlalchemy import delete, exists, func, select
+
+from app import crud, database, models, schemas
+from app.search_index import name_tokens, text_query
+
+SUBJECTS = [
+    "physics", "chemistry", "maths", "biology", "calculus", "algebra",
+    "mechanics", "thermodynamics", "quantum", "organic", "statistics",
+    "economics", "history", "geography", "literature", "programming",
+    "networks", "databases", "compilers", "electronics",
+]  # fmt: skip
+KINDS = [
+    "notes", "lecture", "assignment", "solutions", "exam", "midterm",
+    "final", "lab", "report", "slides", "summary", "cheatsheet",
+]  # fmt: skip
+EXTENSIONS = ["pdf", "pdf", "pdf", "docx", "pptx", "txt", "zip"]
+
+USERNAME = "bench_search"
+QUERY_KINDS = ("word", "phrase", "reordered", "prefix", "miss")
+MODES = ("fuzzy", "text")
+
+
+def file_name(rng: random.Random) -> str:
+    """A file name in one of the styles people actually use"""
+    subject, kind = rng.choice(SUBJECTS), rng.choice(KINDS)
+    chapter = rng.randint(1, 30)
+    ext = rng.choice(EXTENSIONS)
+    style = rng.random()
+    if style < 0.3:
+        return f"{subject}_{kind}_ch{chapter}.{ext}"
+    if style < 0.55:
+        return f"{subject.title()}{kind.title()}Ch{chapter}.{ext}"
+    if style < 0.75:
+        return f"{kind.title()} {chapter} - {subject.title()}.{ext}"
+    if style < 0.9:
+        return f"{subject}-{kind}-{rng.randint(2015, 2025)}.{ext}"
+    return f"{subject}{chapter}_{kind}_v{rng.randint(1, 5)}.{ext}"
+
+
+def make_query(rng: random.Random, kind: str) -> str:
+    subject, word = rng.choice(SUBJECTS), rng.choice(KINDS)
+    if kind == "word":
+        return subject
+    if kind == "phrase":
+        return f"{subject} {word}"
+    if kind == "reordered":
+        return f"{word} {subject} ch{rng.randint(1, 30)}"
+    if kind == "prefix":
+        return subject[: rng.randint(3, 5)]
+    return f"missing{rng.randrange(10**6)}"
+
+
+def has_all_words(name: str, query: str) -> bool:
+    words, prefix = text_query(query)
+    tokens = set(name_tokens(name))
+    return tokens.issuperset(words) and (
+        prefix is None or any(token.startswith(prefix) for token in tokens)
+    )
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+async def ensure_user(db) -> int:
+    user = await crud.get_user_by_username(db, USERNAME)
+    if user is None:
+        user = await crud.create_user(
+            db,
+            schemas.UserCreate(
+                username=USERNAME,
+                password_hash="x",
+                email=f"{USERNAME}@bench.local",
+            ),
+        )
+    return user.user_id
+
+
+async def loaded_files(db, user_id: int) -> int:
+    """Distinct files shared by the sessions of the benchmark user"""
+    return await db.scalar(
+        select(func.count(func.distinct(models.SessionFile.file_hash)))
+        .join(models.PeerSession)
+        .where(models.PeerSession.user_id == user_id)
+    )
+
+
+async def load_catalog(user_id: int, files: int, sessions: int, seed: int) -> None:
+    rng = random.Random(seed)
+    async with database.engine.connect() as conn:
+        raw = (await conn.get_raw_connection()).driver_connection
+        await raw.copy_records_to_table(
+            "peer_sessions",
+            records=[
+                (user_id, f"10.77.{i // 250}.{i % 250 + 1}", 30000 + i, 1)
+                for i in range(sessions)
+            ],
+            columns=["user_id", "ip_address", "port", "library_version"],
+        )
+        session_ids = [
+            row[0]
+            for row in await raw.fetch(
+                "SELECT session_id FROM peer_sessions WHERE user_id = $1", user_id
+            )
+        ]
+
+        def file_records():
+            for i in range(files):
+                file_hash = hashlib.sha256(f"search-bench:{seed}:{i}".encode())
+                yield file_hash.hexdigest(), file_name(rng), rng.randrange(2**30)
+
+        def holder_records():
+            # Most files have one or two peers, a few are shared widely
+            for i in range(files):
+                file_hash = hashlib.sha256(f"search-bench:{seed}:{i}".encode())
+                peers = min(len(session_ids), int(rng.paretovariate(1.5)))
+                for session_id in rng.sample(session_ids, peers):
+                    yield session_id, file_hash.hexdigest()
+
+        start = time.perf_counter()
+        await raw.copy_records_to_table(
+            "files",
+            records=file_records(),
+            columns=["file_hash", "file_name", "file_size"],
+        )
+        await raw.copy_records_to_table(
+            "session_files",
+            records=holder_records(),
+            columns=["session_id", "file_hash"],
+        )
+        await raw.execute("ANALYZE files; ANALYZE session_files")
+        await conn.commit()
+        print(f"loaded {files} files in {time.perf_counter() - start:.1f} s")
+
+
+async def drop_catalog(user_id: int) -> None:
+    async with database.SessionLocal() as db:
+        # Files are kept by the tracker, remove the ones only the benchmark shared
+        await db.execute(
+            delete(models.PeerSession).where(models.PeerSession.user_id == user_id)
+        )
+        await db.execute(
+            delete(models.File).where(
+                ~exists().where(models.SessionFile.file_hash == models.File.file_hash)
+            )
+        )
+        await db.commit()
+
+
+async def run_queries(args) -> dict:
+    rng = random.Random(args.seed)
+    queries = [
+        (kind, make_query(rng, kind))
+        for _ in range(args.queries)
+        for kind in QUERY_KINDS
+    ]
+    timings = {(kind, mode): [] for kind in QUERY_KINDS for mode in args.modes}
+    results = {(kind, mode): [] for kind in QUERY_KINDS for mode in args.modes}
+    with_all_words = {(kind, mode): 0 for kind in QUERY_KINDS for mode in args.modes}
+
+    async with database.SessionLocal() as db:
+        # Warm up the caches of every mode
+        for mode in args.modes:
+            await crud.search_files(db, "physics notes", limit=args.limit, mode=mode)
+        for kind, query in queries:
+            for mode in args.modes:
+                start = time.perf_counter()
+                rows = await crud.search_files(db, query, limit=args.limit, mode=mode)
+                timings[kind, mode].append(time.perf_counter() - start)
+                results[kind, mode].append(len(rows))
+                with_all_words[kind, mode] += sum(
+                    has_all_words(row.file_name, query) for row in rows
+                )
+            await db.rollback()
+
+    report = {}
+    for kind in QUERY_KINDS:
+        report[kind] = {}
+        for mode in args.modes:
+            samples = timings[kind, mode]
+            returned = sum(results[kind, mode])
+            report[kind][mode] = {
+                "p50_ms": percentile(samples, 0.50) * 1000,
+                "p99_ms": percentile(samples, 0.99) * 1000,
+                "mean_results": statistics.fmean(results[kind, mode]),
+                "all_words": with_all_words[kind, mode] / returned if returned else 0,
+            }
+    return report
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=1000000)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=50, help="per query kind")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument(
+        "--drop", action="store_true", help="remove the catalog when done"
+    )
+    args = parser.parse_args()
+
+    async with database.engine.begin() as conn:
+        await conn.run_sync(database.Base.metadata.create_all)
+    async with database.SessionLocal() as db:
+        user_id = await ensure_user(db)
+        loaded = await loaded_files(db, user_id)
+    if loaded != args.files:
+        # Also clears files left behind when the tracker expired the sessions
+        await drop_catalog(user_id)
+        await load_catalog(user_id, args.files, args.sessions, args.seed)
+
+    report = await run_queries(args)
+    for kind in QUERY_KINDS:
+        for mode in args.modes:
+            r = report[kind][mode]
+            print(
+                f"{kind:<10} {mode:<6} p50 {r['p50_ms']:8.2f} ms  "
+                f"p99 {r['p99_ms']:8.2f} ms  results {r['mean_results']:6.1f}  "
+                f"with all words {r['all_words'] * 100:5.1f}%"
+            )
+
+    if args.drop:
+        await drop_catalog(user_id)
+    await database.engine.dispose()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
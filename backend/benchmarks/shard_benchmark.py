@@ -0,0 +1,176 @@
+"""Throughput of a sharded tracker for different numbers of nodes.
+
+For every node count a local cluster is started (see shard_cluster) and
+every virtual peer announces its library through its own node. Then
+--workers clients send full announces, pings and searches back to back for
+--duration seconds, peers through their node and searches spread over all
+of them like behind a load balancer. Reports requests per second with
+p50/p99 latency per operation, and how evenly the nodes share the catalog.
+
+Every node is a process of its own: the nodes (and the load generator)
+need a core each for throughput to grow with the node count.
+
+Run from the backend directory against a local Postgres (accounts only):
+
+    python -m benchmarks.shard_benchmark --shards 1 2 4 --duration 30
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+import httpx
+
+from app import database
+from app.hash_ring import HashRing
+
+from .loadtest import (
+    OPERATIONS,
+    Recorder,
+    VirtualPeer,
+    ensure_users,
+    file_entry,
+    make_query,
+)
+from .shard_cluster import Cluster
+
+
+def catalog_shares(urls: list[str], catalog: int) -> list[float]:
+    """Share of the catalog's files each node owns"""
+    ring = HashRing(urls)
+    counts = dict.fromkeys(urls, 0)
+    for ident in range(catalog):
+        counts[ring.owner(file_entry(ident)["file_hash"])] += 1
+    return [counts[url] / catalog for url in urls]
+
+
+async def run_cluster(shards: int, users: list[tuple[int, str]], args) -> dict:
+    async with Cluster(shards, args.port) as cluster:
+        clients = [
+            httpx.AsyncClient(
+                base_url=url,
+                limits=httpx.Limits(max_connections=args.workers),
+                timeout=30,
+            )
+            for url in cluster.urls
+        ]
+        try:
+            peers = [
+                VirtualPeer(i, user_id, token, args, args.seed * 100003 + i)
+                for i, (user_id, token) in enumerate(users)
+            ]
+
+            def node(peer: VirtualPeer) -> httpx.AsyncClient:
+                return clients[peer.index % shards]
+
+            limit = asyncio.Semaphore(args.workers)
+            warmup = Recorder()
+            await asyncio.gather(
+                *(peer.announce(node(peer), warmup, limit) for peer in peers)
+            )
+
+            recorder = Recorder()
+            rng = random.Random(args.seed)
+            searches = 0
+            deadline = time.monotonic() + args.duration
+
+            async def worker(mine: list[VirtualPeer]) -> None:
+                nonlocal searches
+                while time.monotonic() < deadline:
+                    peer = rng.choice(mine)
+                    roll = rng.random()
+                    if roll < args.announce_share:
+                        await peer.announce(node(peer), recorder, limit)
+                    elif roll < args.announce_share + args.search_share:
+                        searches += 1
+                        await peer.request(
+                            clients[searches % shards],
+                            recorder,
+                            limit,
+                            "search",
+                            "GET",
+                            "/search",
+                            params={"q": make_query(peer.rng), "limit": 50},
+                        )
+                    else:
+                        await peer.request(
+                            node(peer),
+                            recorder,
+                            limit,
+                            "ping",
+                            "POST",
+                            "/ping",
+                            json={"ip_address": peer.ip_address, "port": peer.port},
+                        )
+
+            start = time.monotonic()
+            await asyncio.gather(
+                *(worker(peers[w :: args.workers]) for w in range(args.workers))
+            )
+            elapsed = time.monotonic() - start
+        finally:
+            for client in clients:
+                await client.aclose()
+
+        results = recorder.summary(elapsed)
+        shares = catalog_shares(cluster.urls, args.catalog)
+        return {
+            "requests_per_sec": sum(r["per_sec"] for r in results.values()),
+            "errors": sum(r["errors"] for r in results.values()),
+            "results": results,
+            "catalog_shares": shares,
+        }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--peers", type=int, default=500)
+    parser.add_argument("--files", type=int, default=200, help="mean library size")
+    parser.add_argument("--catalog", type=int, default=100000, help="distinct files")
+    parser.add_argument("--workers", type=int, default=64, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per run")
+    parser.add_argument(
+        "--announce-share", type=float, default=0.1, help="full announces"
+    )
+    parser.add_argument("--search-share", type=float, default=0.3, help="searches")
+    parser.add_argument("--port", type=int, default=8300, help="of the first node")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+    args.workers = min(args.workers, args.peers)
+
+    async with database.engine.begin() as conn:
+        await conn.run_sync(database.Base.metadata.create_all)
+    users = await ensure_users(args.peers)
+    await database.engine.dispose()
+
+    report = {}
+    for shards in args.shards:
+        report[shards] = r = await run_cluster(shards, users, args)
+        print(
+            f"{shards} node(s) {r['requests_per_sec']:8.1f} req/s  "
+            f"errors {r['errors']}  largest catalog share "
+            f"{max(r['catalog_shares']) * 100:.1f}%"
+        )
+        for op in OPERATIONS:
+            o = r["results"][op]
+            print(
+                f"  {op:<9} {o['per_sec']:8.1f} req/s  p50 {o['p50_ms']:8.2f} ms  "
+                f"p99 {o['p99_ms']:8.2f} ms"
+            )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"config": vars(args), "cores": os.cpu_count(), "results": report},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,288 @@
+"""Run a sharded tracker as several local processes.
+
+Starts one uvicorn process per node on consecutive ports, all with the
+in-memory store and TRACKER_SHARDS listing every node, against the database
+of SQLALCHEMY_DATABASE_URL (accounts only). Runs until interrupted, or with
+--check announces through one node and checks that searches, peer lookups,
+manifest checks, delta announces and pings through every other node see the
+same index.
+
+Run from the backend directory against a local Postgres:
+
+    python -m benchmarks.shard_cluster --nodes 3
+    python -m benchmarks.shard_cluster --nodes 3 --check
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+from app import database, manifests
+from app.hash_ring import HashRing
+
+from .loadtest import ensure_users, file_entry
+
+HOST = "127.0.0.1"
+
+
+def manifest_entry(file: dict) -> dict:
+    """A valid manifest of a made-up file, in a single piece at most"""
+    count = manifests.piece_count(file["file_size"], manifests.MAX_PIECE_SIZE)
+    digests = [hashlib.sha256(file["file_name"].encode()).digest()] * count
+    return {
+        "file_hash": file["file_hash"],
+        "file_size": file["file_size"],
+        "piece_size": manifests.MAX_PIECE_SIZE,
+        "merkle_root": manifests.merkle_root(digests).hex(),
+        "pieces": base64.b64encode(b"".join(digests)).decode(),
+    }
+
+
+class Cluster:
+    """Tracker nodes running as child processes, stopped on exit"""
+
+    def __init__(self, nodes: int, base_port: int, log_level: str = "warning"):
+        self.urls = [f"http://{HOST}:{base_port + i}" for i in range(nodes)]
+        self.log_level = log_level
+        self.processes: list[subprocess.Popen] = []
+
+    def node_env(self, url: str) -> dict:
+        env = dict(os.environ)
+        env.update(
+            TRACKER_STORE="memory",
+            TRACKER_STORE_WRITE_THROUGH="false",
+            TRACKER_SHARDS=",".join(self.urls),
+            TRACKER_SHARD_SELF=url,
+            # Every node would bind the same UDP port
+            HEARTBEAT_UDP_PORT="0",
+        )
+        return env
+
+    async def start(self, timeout: float = 60) -> None:
+        for url in self.urls:
+            port = url.rsplit(":", 1)[1]
+            self.processes.append(
+                subprocess.Popen(
+                    [sys.executable, "-m", "uvicorn", "app.main:app"]
+                    + ["--host", HOST, "--port", port, "--log-level", self.log_level],
+                    env=self.node_env(url),
+                )
+            )
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient(timeout=1) as client:
+            for url, process in zip(self.urls, self.processes):
+                while True:
+                    if process.poll() is not None:
+                        raise RuntimeError(f"Tracker node {url} exited")
+                    try:
+                        if (await client.get(f"{url}/")).status_code == 200:
+                            break
+                    except httpx.HTTPError:
+                        pass
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"Tracker node {url} did not start")
+                    await asyncio.sleep(0.2)
+
+    def stop(self) -> None:
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+
+    async def __aenter__(self) -> "Cluster":
+        try:
+            await self.start()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.stop()
+
+
+async def check(cluster: Cluster) -> bool:
+    """Announce through the first node, read through all of them"""
+    (user_id, token), (_, other_token) = await ensure_users(2)
+    headers = {"Authorization": f"Bearer {token}"}
+    ring = HashRing(cluster.urls)
+    files = [file_entry(i) for i in range(300)]
+    ok = True
+
+    def report(name: str, passed: bool, detail: str = "") -> None:
+        nonlocal ok
+        ok = ok and passed
+        print(f"{'ok ' if passed else 'FAIL'} {name} {detail}")
+
+    async with httpx.AsyncClient(timeout=30, headers=headers) as client:
+        first, last = cluster.urls[0], cluster.urls[-1]
+        session = {"user_id": user_id, "port": 7001, "ip_address": "10.1.2.3"}
+
+        response = await client.post(
+            f"{first}/announce", json={**session, "files": files, "version": 1}
+        )
+        report("announce", response.status_code == 200, str(response.json()))
+        owners = {ring.owner(file["file_hash"]) for file in files}
+        report("files on every node", owners == set(cluster.urls), f"{len(owners)}")
+
+        async def search(url: str, q: str) -> set[str]:
+            hashes, cursor = [], None
+            while True:
+                params = {"q": q, "limit": 20, "mode": "text"}
+                if cursor:
+                    params["cursor"] = cursor
+                response = await client.get(f"{url}/search", params=params)
+                response.raise_for_status()
+                hashes += [result["file_hash"] for result in response.json()]
+                cursor = response.headers.get("X-Next-Cursor")
+                if cursor is None:
+                    break
+            if len(hashes) != len(set(hashes)):
+                report("pages without duplicates", False, url)
+            return set(hashes)
+
+        expected = {f["file_hash"] for f in files if "physics" in f["file_name"]}
+        for url in cluster.urls:
+            found = await search(url, "physics")
+            report(f"search via {url}", found == expected, f"{len(found)} files")
+
+        # Enough searches for REPLICATION_MIN_DEMAND, peers counted by the owners
+        for _ in range(5):
+            await search(last, "physics")
+        response = await client.get(
+            f"{last}/replication/hints",
+            params={"limit": 10},
+            headers={"Authorization": f"Bearer {other_token}"},
+        )
+        hints = response.json() if response.status_code == 200 else []
+        report(
+            "replication hints",
+            len(hints) == 10
+            and all(h["file_hash"] in expected and h["peers"] == 1 for h in hints),
+            f"{len(hints)} hints",
+        )
+        response = await client.get(f"{last}/replication/hints")
+        report("no hints of shared files", response.json() == [], str(response.json()))
+
+        for file in files[:10]:
+            response = await client.get(f"{last}/files/{file['file_hash']}/peers")
+            peers = response.json() if response.status_code == 200 else []
+            if not (len(peers) == 1 and peers[0]["port"] == 7001):
+                report("peers via the last node", False, file["file_hash"])
+                break
+        else:
+            report("peers via the last node", True)
+
+        # Checked against the nodes owning the files, the unshared one refused
+        unshared = file_entry(len(files))
+        response = await client.post(
+            f"{last}/manifests",
+            json={"manifests": [manifest_entry(f) for f in files[:20] + [unshared]]},
+        )
+        result = response.json() if response.status_code == 200 else {}
+        report(
+            "manifests of shared files",
+            result.get("rejected") == [unshared["file_hash"]],
+            str(result),
+        )
+
+        removed = [file["file_hash"] for file in files[:150]]
+        response = await client.post(
+            f"{last}/announce/delta",
+            json={**session, "base_version": 1, "version": 2, "removed": removed},
+        )
+        report("delta announce", response.status_code == 200, str(response.json()))
+        found = await search(first, "physics")
+        report("search after delta", found == expected - set(removed), f"{len(found)}")
+
+        response = await client.post(
+            f"{last}/announce/delta",
+            json={**session, "base_version": 1, "version": 3, "removed": removed},
+        )
+        report("stale delta refused", response.status_code == 409)
+
+        response = await client.post(
+            f"{cluster.urls[len(cluster.urls) // 2]}/ping",
+            json={"ip_address": session["ip_address"], "port": 7001, "load": 2},
+        )
+        report("ping", response.json().get("status") == "success")
+
+        def ndjson(version: int, records: list) -> bytes:
+            header = {**session, "version": version}
+            return b"".join(json.dumps(r).encode() + b"\n" for r in [header] + records)
+
+        middle = cluster.urls[len(cluster.urls) // 2]
+        streamed = files[100:]
+        response = await client.post(
+            f"{middle}/announce/stream",
+            content=ndjson(4, streamed + [{"file_hash": "bad"}]),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        found = await search(first, "physics")
+        report(
+            "bad streamed record changes no node",
+            response.status_code == 422 and found == expected - set(removed),
+            f"{response.status_code} {len(found)}",
+        )
+        response = await client.post(
+            f"{middle}/announce/stream",
+            content=ndjson(4, streamed),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        found = await search(first, "physics")
+        report(
+            "streamed announce",
+            response.status_code == 200
+            and found == expected & {f["file_hash"] for f in streamed},
+            f"{response.json()} {len(found)}",
+        )
+
+        response = await client.post(
+            f"{first}/announce", json={**session, "files": [], "version": 5}
+        )
+        found = await search(last, "physics")
+        report("empty announce clears every node", not found, f"{len(found)}")
+    return ok
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8100, help="port of the first")
+    parser.add_argument("--check", action="store_true", help="check, then stop")
+    args = parser.parse_args()
+
+    async with database.engine.begin() as conn:
+        await conn.run_sync(database.Base.metadata.create_all)
+
+    async with Cluster(args.nodes, args.port, log_level="info") as cluster:
+        print("tracker nodes: " + ", ".join(cluster.urls))
+        if args.check:
+            passed = await check(cluster)
+        else:
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                passed = True
+    await database.engine.dispose()
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,185 @@
+"""Compare the SQL and in-memory tracker stores on a synthetic workload.
+
+Both stores get the same announces, heartbeats and searches, and every
+search result is checked to be identical between them (same files, same
+order, same peers), so the run doubles as a contract check.
+
+Run from the backend directory against a local Postgres:
+
+    python -m benchmarks.store_benchmark --clients 200 --files 500
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import statistics
+import time
+
+from sqlalchemy import delete
+
+from app import crud, database, models, schemas
+from app.memory_store import MemoryTrackerStore
+from app.store import SqlTrackerStore, TrackerStore
+
+WORDS = [
+    "physics", "chemistry", "maths", "biology", "notes", "lecture", "chapter",
+    "assignment", "solutions", "exam", "midterm", "final", "lab", "report",
+    "calculus", "algebra", "mechanics", "thermo", "quantum", "organic",
+]  # fmt: skip
+
+USER_PREFIX = "bench_store_"
+
+
+def make_library(rng: random.Random, client: int, size: int) -> list[schemas.FileBase]:
+    files = []
+    for i in range(size):
+        # Half of the files are shared by several clients
+        ident = rng.randrange(size * 4) if i % 2 else size * 4 + client * size + i
+        name = (
+            f"{WORDS[ident % len(WORDS)]}_{WORDS[ident // len(WORDS) % len(WORDS)]}"
+            f"_{ident}.pdf"
+        )
+        files.append(
+            schemas.FileBase(
+                file_hash=hashlib.sha256(name.encode()).hexdigest(),
+                file_name=name,
+                file_size=ident * 1024,
+            )
+        )
+    return files
+
+
+async def ensure_users(db, count: int) -> list[int]:
+    user_ids = []
+    for i in range(count):
+        username = f"{USER_PREFIX}{i}"
+        user = await crud.get_user_by_username(db, username)
+        if user is None:
+            user = await crud.create_user(
+                db,
+                schemas.UserCreate(
+                    username=username,
+                    password_hash="x",
+                    email=f"{username}@bench.local",
+                ),
+            )
+        user_ids.append(user.user_id)
+    return user_ids
+
+
+async def clear_sessions(db, user_ids: list[int]) -> None:
+    await db.execute(
+        delete(models.PeerSession).where(models.PeerSession.user_id.in_(user_ids))
+    )
+    await db.commit()
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+    }
+
+
+async def run(store: TrackerStore, db, workload: dict) -> tuple[dict, list]:
+    timings: dict[str, list[float]] = {"announce": [], "ping": [], "search": []}
+
+    for payload in workload["announces"]:
+        start = time.perf_counter()
+        await store.upsert_file_announcement(db, payload, payload.ip_address)
+        timings["announce"].append(time.perf_counter() - start)
+
+    for payload in workload["announces"]:
+        start = time.perf_counter()
+        await store.update_last_heartbeat(
+            db, payload.user_id, payload.ip_address, payload.port
+        )
+        timings["ping"].append(time.perf_counter() - start)
+
+    results = []
+    for query in workload["queries"]:
+        start = time.perf_counter()
+        found = await store.search_files(db, query, limit=50)
+        timings["search"].append(time.perf_counter() - start)
+        results.append([(r.file_hash, sorted(p.port for p in r.peers)) for r in found])
+
+    return {name: summarize(samples) for name, samples in timings.items()}, results
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--files", type=int, default=200, help="files per client")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    async with database.engine.begin() as conn:
+        await conn.run_sync(database.Base.metadata.create_all)
+    db = database.SessionLocal()
+    user_ids = await ensure_users(db, args.clients)
+
+    workload = {
+        "announces": [
+            schemas.FileAnnounce(
+                user_id=user_id,
+                port=9000 + i,
+                ip_address=f"10.0.{i // 250}.{i % 250 + 1}",
+                files=make_library(rng, i, args.files),
+                version=1,
+            )
+            for i, user_id in enumerate(user_ids)
+        ],
+        "queries": [
+            rng.choice(
+                [
+                    rng.choice(WORDS),
+                    rng.choice(WORDS)[:4],
+                    f"{rng.choice(WORDS)}_{rng.choice(WORDS)}",
+                    rng.choice(WORDS)[:2],
+                ]
+            )
+            for _ in range(args.queries)
+        ],
+    }
+
+    report = {}
+    outputs = {}
+    for name, store in (("sql", SqlTrackerStore()), ("memory", MemoryTrackerStore())):
+        await clear_sessions(db, user_ids)
+        report[name], outputs[name] = await run(store, db, workload)
+    await clear_sessions(db, user_ids)
+
+    mismatches = sum(a != b for a, b in zip(outputs["sql"], outputs["memory"]))
+    report["search_mismatches"] = mismatches
+
+    for op in ("announce", "ping", "search"):
+        sql, mem = report["sql"][op], report["memory"][op]
+        print(
+            f"{op:<9} sql p50 {sql['p50_ms']:8.3f} ms  p99 {sql['p99_ms']:8.3f} ms | "
+            f"memory p50 {mem['p50_ms']:8.3f} ms  p99 {mem['p99_ms']:8.3f} ms"
+        )
+    print(f"search results differing between stores: {mismatches}/{args.queries}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    await db.close()
+    await database.engine.dispose()
+    raise SystemExit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
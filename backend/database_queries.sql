@@ -9,35 +9,84 @@ CREATE TABLE files (
     file_hash CHAR(64) PRIMARY KEY, -- SHA-256 is 64 hex characters
     file_name VARCHAR(255) NOT NULL, -- Canonical name (usually the first name it was uploaded with)
     file_size BIGINT NOT NULL, -- Size in bytes
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- Name tokens for text searches, SEARCH_VECTOR_SQL in app/models.py:
+    -- split on camelCase, acronyms, letter/digit boundaries and separators
+    search_vector TSVECTOR GENERATED ALWAYS AS (
+        array_to_tsvector(string_to_array(trim(regexp_replace(lower(
+            regexp_replace(regexp_replace(regexp_replace(regexp_replace(file_name,
+                '([a-z])([A-Z])', '\1 \2', 'g'),
+                '([A-Z])([A-Z][a-z])', '\1 \2', 'g'),
+                '([[:alpha:]])([0-9])', '\1 \2', 'g'),
+                '([0-9])([[:alpha:]])', '\1 \2', 'g')),
+            '[^[:alnum:]]+', ' ', 'g')), ' '))
+    ) STORED
+);
+-- Piece hashes of a file, published by a client sharing it. No foreign key
+-- to files: the manifest describes the content and outlives its peers
+CREATE TABLE file_manifests (
+    file_hash VARCHAR(64) PRIMARY KEY,
+    file_size BIGINT NOT NULL,
+    piece_size INT NOT NULL,
+    merkle_root BYTEA NOT NULL, -- Root of the Merkle tree over the pieces
+    pieces BYTEA NOT NULL, -- SHA-256 digests of the pieces, 32 bytes each, in order
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
 );
-CREATE TABLE active_peers (
-    peer_id SERIAL PRIMARY KEY,
+-- One row per running client instance, a heartbeat only touches this row
+CREATE TABLE peer_sessions (
+    session_id SERIAL PRIMARY KEY,
     user_id INT NOT NULL,
-    file_hash CHAR(64) NOT NULL,
     ip_address VARCHAR(45) NOT NULL, -- Supports IPv4 and IPv6
     port INT NOT NULL,
     public_url TEXT,
+    public_ip VARCHAR(45), -- Address the client reached the tracker from
+    load INT, -- Uploads in progress, as last reported by the client
+    library_version BIGINT NOT NULL DEFAULT 0, -- Last library version applied, deltas must build on it
     last_heartbeat TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
     -- Constraints
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
-    FOREIGN KEY (file_hash) REFERENCES files(file_hash) ON DELETE CASCADE,
-    
-    -- Ensure a user is not listed twice for the same file
-    UNIQUE (user_id, file_hash) 
+
+    -- One session per client instance
+    UNIQUE (user_id, ip_address, port)
 );
+-- Which session shares which file
+CREATE TABLE session_files (
+    session_id INT NOT NULL,
+    file_hash CHAR(64) NOT NULL,
+
+    PRIMARY KEY (session_id, file_hash),
+    FOREIGN KEY (session_id) REFERENCES peer_sessions(session_id) ON DELETE CASCADE,
+    FOREIGN KEY (file_hash) REFERENCES files(file_hash) ON DELETE CASCADE
+);
+-- Heartbeats when LEASE_BUCKET_SECONDS is set, one row per session and lease
+-- bucket (epoch second the bucket starts at). The tracker creates the table,
+-- its DEFAULT partition and one partition per bucket, dropping expired ones
+-- whole. No foreign key to peer_sessions, which would make every drop lock it
+CREATE TABLE session_leases (
+    session_id INT NOT NULL,
+    bucket BIGINT NOT NULL,
+
+    PRIMARY KEY (session_id, bucket)
+) PARTITION BY RANGE (bucket);
+CREATE TABLE session_leases_default PARTITION OF session_leases DEFAULT;
+-- e.g. CREATE TABLE session_leases_1700000010 PARTITION OF session_leases
+--      FOR VALUES FROM (1700000010) TO (1700000040);
 -- 1. Index for fast searching by filename (e.g., "Find all files with 'Physics'")
 -- TRGM index (requires pg_trgm extension) is best for partial matching, 
 -- but a standard index works for exact prefix matches.
--- Run this in your Postgres DB
+-- The tracker creates both on startup, /search ranks by similarity(file_name, q)
 CREATE EXTENSION IF NOT EXISTS pg_trgm;
 CREATE INDEX idx_file_name_trgm ON files USING gin (file_name gin_trgm_ops);
 
 -- CREATE INDEX idx_files_name ON files(file_name);
 
+-- Inverted index of name tokens, for /search?mode=text
+CREATE INDEX idx_file_search_vector ON files USING gin (search_vector);
+
 -- 2. Index to quickly find who has a specific file
-CREATE INDEX idx_active_peers_hash ON active_peers(file_hash);
+CREATE INDEX idx_session_files_hash ON session_files(file_hash);
 
--- 3. Index for the Heartbeat Cleanup Job (to quickly find offline users)
-CREATE INDEX idx_last_heartbeat ON active_peers(last_heartbeat);
\ No newline at end of file
+-- 3. Index for the Heartbeat Cleanup Job (to quickly find offline sessions)
+CREATE INDEX idx_last_heartbeat ON peer_sessions(last_heartbeat);
\ No newline at end of file
@@ -0,0 +1,14 @@
+import os
+
+import pytest
+
+# app.database reads these on import, no connection is made by the tests
+os.environ.setdefault(
+    "SQLALCHEMY_DATABASE_URL", "postgresql://peershare@localhost:5432/peershare_test"
+)
+os.environ.setdefault("SECRET_KEY", "test-secret-key-of-at-least-32-bytes")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
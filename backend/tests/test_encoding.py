@@ -0,0 +1,89 @@
+"""Compressed request bodies are inflated in bounded pieces"""
+
+import gzip
+import os
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from app import encoding
+
+zstandard = pytest.importorskip("zstandard")
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.router.route_class = encoding.DecodingRoute
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        size, largest = 0, 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            largest = max(largest, len(chunk))
+        return {"size": size, "largest": largest}
+
+    return TestClient(app)
+
+
+def post(client, body: bytes, coding: str, step: int = 64 * 1024):
+    def chunks():
+        for i in range(0, len(body), step):
+            yield body[i : i + step]
+
+    return client.post("/echo", content=chunks(), headers={"Content-Encoding": coding})
+
+
+@pytest.mark.parametrize("step", [7, 1000, 64 * 1024])
+def test_zstd_body(client, step):
+    payload = os.urandom(300_000) + b"notes" * 200_000
+    body = zstandard.ZstdCompressor().compress(payload)
+
+    response = post(client, body, "zstd", step)
+
+    assert response.status_code == 200
+    assert response.json()["size"] == len(payload)
+
+
+def test_zstd_output_is_bounded_per_read(client, monkeypatch):
+    monkeypatch.setattr(encoding, "REQUEST_MAX_DECOMPRESSED_BYTES", 16 * MiB)
+    # Long runs of one byte compress into RLE blocks, a few bytes each
+    body = zstandard.ZstdCompressor().compress(b"\0" * 15 * MiB)
+
+    response = post(client, body, "zstd")
+
+    assert response.json() == {
+        "size": 15 * MiB,
+        "largest": encoding.INFLATE_STEP_BYTES,
+    }
+
+
+@pytest.mark.parametrize("coding", ["zstd", "gzip"])
+def test_bomb_is_refused(client, coding):
+    payload = b"\0" * 256 * MiB
+    if coding == "zstd":
+        body = zstandard.ZstdCompressor().compress(payload)
+    else:
+        body = gzip.compress(payload)
+
+    assert post(client, body, coding).status_code == 413
+
+
+@pytest.mark.parametrize("coding", ["zstd", "gzip"])
+def test_truncated_body_is_refused(client, coding):
+    payload = os.urandom(100_000)
+    if coding == "zstd":
+        body = zstandard.ZstdCompressor(write_checksum=True).compress(payload)
+    else:
+        body = gzip.compress(payload)
+
+    assert post(client, body[:-3], coding).status_code == 400
+    assert post(client, body, coding).status_code == 200
+
+
+def test_corrupt_zstd_body_is_refused(client):
+    assert post(client, b"not zstd at all", "zstd").status_code == 400
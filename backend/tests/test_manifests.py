@@ -0,0 +1,83 @@
+"""Manifests built by the client must pass the tracker's check_manifest"""
+
+import hashlib
+import importlib
+from pathlib import Path
+
+import pytest
+
+from app import manifests
+
+CLIENT_DIR = Path(__file__).resolve().parents[2] / "client"
+MiB = 1024 * 1024
+
+
+@pytest.fixture
+def client_utils(monkeypatch, tmp_path):
+    # The client's config creates its app directory under HOME on import
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    monkeypatch.syspath_prepend(str(CLIENT_DIR))
+    return importlib.import_module("client_app.utils")
+
+
+def digests(count: int) -> list[bytes]:
+    return [hashlib.sha256(str(i).encode()).digest() for i in range(count)]
+
+
+@pytest.mark.parametrize(
+    "file_size",
+    [0, 1, MiB - 1, MiB, 3 * MiB, 5 * MiB + 7],
+    ids=["empty", "one-byte", "single-piece", "exact-piece", "three", "six"],
+)
+def test_hashed_file_passes_check(client_utils, tmp_path, file_size):
+    path = tmp_path / "notes.pdf"
+    path.write_bytes(bytes(i % 251 for i in range(file_size)))
+
+    manifest = client_utils.hash_file(str(path))
+
+    assert manifest["file_hash"] == hashlib.sha256(path.read_bytes()).hexdigest()
+    assert len(manifest["pieces"]) == manifests.DIGEST_SIZE * manifests.piece_count(
+        file_size, manifest["piece_size"]
+    )
+    manifests.check_manifest(
+        manifest["file_size"],
+        manifest["piece_size"],
+        manifest["merkle_root"],
+        manifest["pieces"],
+    )
+
+
+@pytest.mark.parametrize("count", [0, 1, 2, 3, 5, 7, 8, 9, 100, 8191])
+def test_merkle_roots_agree(client_utils, count):
+    assert client_utils.merkle_root(digests(count)) == manifests.merkle_root(
+        digests(count)
+    )
+
+
+@pytest.mark.parametrize("file_size", [8192 * MiB, 8192 * MiB + 1, 30000 * MiB])
+def test_large_files_stay_within_piece_limit(client_utils, file_size):
+    piece_size = client_utils.piece_size_for(file_size)
+    pieces = digests(manifests.piece_count(file_size, piece_size))
+
+    manifests.check_manifest(
+        file_size,
+        piece_size,
+        client_utils.merkle_root(pieces).hex(),
+        b"".join(pieces),
+    )
+
+
+def test_tampered_piece_is_refused(client_utils, tmp_path):
+    path = tmp_path / "notes.pdf"
+    path.write_bytes(b"x" * (3 * MiB))
+    manifest = client_utils.hash_file(str(path))
+    pieces = bytearray(manifest["pieces"])
+    pieces[0] ^= 1
+
+    with pytest.raises(ValueError):
+        manifests.check_manifest(
+            manifest["file_size"],
+            manifest["piece_size"],
+            manifest["merkle_root"],
+            bytes(pieces),
+        )
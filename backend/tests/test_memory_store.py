@@ -0,0 +1,398 @@
+"""Store contract checks against MemoryTrackerStore, no database needed"""
+
+import hashlib
+
+import pytest
+
+from app import events, schemas
+from app.memory_store import MemoryTrackerStore
+from app.store import TrackerStore
+
+pytestmark = pytest.mark.anyio
+
+IP = "10.0.0.1"
+published: list[tuple[list[str], list[str]]] = []
+
+
+@events.subscribe
+def record(added, removed):
+    published.append(([file.file_hash for file in added], list(removed)))
+
+
+def file(name: str, size: int = 1024) -> schemas.FileBase:
+    return schemas.FileBase(
+        file_hash=hashlib.sha256(name.encode()).hexdigest(),
+        file_name=name,
+        file_size=size,
+    )
+
+
+def announce(user_id: int, files, port: int = 9000, version: int = 1):
+    return schemas.FileAnnounce(
+        user_id=user_id, port=port, files=files, version=version
+    )
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("app.memory_store.time.time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def store():
+    published.clear()
+    store = MemoryTrackerStore()
+    # Usernames are otherwise looked up in Postgres on first announce
+    store._usernames.update({1: "alice", 2: "bob"})
+    return store
+
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        TrackerStore()
+
+
+async def test_announce_publishes_added_files(store):
+    notes, slides = file("physics_notes.pdf"), file("physics_slides.pdf")
+
+    result = await store.upsert_file_announcement(
+        None, announce(1, [notes, slides]), IP
+    )
+
+    assert result.announced == 2
+    assert result.version == 1
+    assert published == [([notes.file_hash, slides.file_hash], [])]
+    assert await store.count_sessions(None) == 1
+
+
+async def test_reannounce_only_reports_changes(store):
+    notes, slides, lab = (
+        file("physics_notes.pdf"),
+        file("physics_slides.pdf"),
+        file("chemistry_lab.pdf"),
+    )
+    await store.upsert_file_announcement(None, announce(1, [notes, slides]), IP)
+    published.clear()
+
+    result = await store.upsert_file_announcement(
+        None, announce(1, [slides, lab], version=2), IP
+    )
+
+    assert [f.file_hash for f in result.added] == [lab.file_hash]
+    assert result.removed == [notes.file_hash]
+    assert published == [([lab.file_hash], [notes.file_hash])]
+    assert await store.get_file_peers(None, notes.file_hash) == []
+
+
+async def test_streamed_announce(store):
+    notes = file("physics_notes.pdf")
+
+    async def files():
+        yield notes
+
+    header = schemas.AnnounceStreamHeader(user_id=1, port=9000, version=1)
+    result = await store.stream_file_announcement(None, header, files(), IP)
+
+    assert result.announced == 1
+    assert published == [([notes.file_hash], [])]
+
+
+async def test_streamed_announce_in_chunks(store, monkeypatch):
+    monkeypatch.setattr("app.memory_store.STREAM_CHUNK_SIZE", 2)
+    old, kept = file("old_notes.pdf"), file("lecture_0.pdf")
+    await store.upsert_file_announcement(None, announce(1, [old, kept]), IP)
+    published.clear()
+    library = [file(f"lecture_{i}.pdf") for i in range(5)]
+
+    async def files(fail: bool = False):
+        for f in library:
+            yield f
+        if fail:
+            raise ValueError("bad record")
+
+    header = schemas.AnnounceStreamHeader(user_id=1, port=9000, version=2)
+    with pytest.raises(ValueError):
+        await store.stream_file_announcement(None, header, files(fail=True), IP)
+
+    assert published == []
+    assert {r.file_hash for r in await store.search_files(None, "lecture")} == {
+        kept.file_hash
+    }
+
+    result = await store.stream_file_announcement(None, header, files(), IP)
+
+    assert result.announced == 5
+    assert [r for _, r in published] == [[old.file_hash], [], []]
+    assert sorted(h for added, _ in published for h in added) == sorted(
+        f.file_hash for f in library[1:]
+    )
+    assert len(await store.search_files(None, "lecture")) == 5
+    assert await store.get_file_peers(None, old.file_hash) == []
+
+
+async def test_failed_stream_leaves_no_new_session(store):
+    async def files():
+        yield file("physics_notes.pdf")
+        raise ValueError("bad record")
+
+    header = schemas.AnnounceStreamHeader(user_id=2, port=9001, version=1)
+    with pytest.raises(ValueError):
+        await store.stream_file_announcement(None, header, files(), IP)
+
+    assert await store.count_sessions(None) == 0
+    assert await store.search_files(None, "physics") == []
+
+
+async def test_delta(store):
+    notes, lab = file("physics_notes.pdf"), file("chemistry_lab.pdf")
+    await store.upsert_file_announcement(None, announce(1, [notes]), IP)
+    published.clear()
+
+    delta = schemas.FileAnnounceDelta(
+        user_id=1,
+        port=9000,
+        base_version=1,
+        version=2,
+        added=[lab],
+        removed=[notes.file_hash],
+    )
+    result = await store.apply_file_delta(None, delta, IP)
+
+    assert result.announced == 1
+    assert result.version == 2
+    assert published == [([lab.file_hash], [notes.file_hash])]
+    assert [r.file_hash for r in await store.search_files(None, "chemistry")] == [
+        lab.file_hash
+    ]
+    assert await store.search_files(None, "physics") == []
+
+
+async def test_delta_of_another_version_is_refused(store):
+    await store.upsert_file_announcement(None, announce(1, [file("a.pdf")]), IP)
+    published.clear()
+
+    delta = schemas.FileAnnounceDelta(
+        user_id=1, port=9000, base_version=5, version=6, added=[file("b.pdf")]
+    )
+
+    assert await store.apply_file_delta(None, delta, IP) is None
+    assert published == []
+
+
+async def test_heartbeats(store):
+    notes = file("physics_notes.pdf")
+    await store.upsert_file_announcement(None, announce(1, [notes]), IP)
+    await store.upsert_file_announcement(None, announce(2, [notes], port=9001), IP)
+
+    assert await store.update_last_heartbeat(None, 1, IP, 9000, load=3) == 1
+    assert await store.update_last_heartbeat(None, 1, IP, 1234) == 0
+    assert (
+        await store.update_last_heartbeats(
+            None, [(1, IP, 9000), (2, IP, 9001), (3, IP, 1)]
+        )
+        == 2
+    )
+
+    peers = {
+        peer.username: peer
+        for peer in await store.get_file_peers(None, notes.file_hash)
+    }
+    assert peers["alice"].load == 3
+    assert peers["bob"].load is None
+
+
+async def test_expiry_keeps_renewed_sessions(store, clock):
+    notes, slides = file("physics_notes.pdf"), file("physics_slides.pdf")
+    await store.upsert_file_announcement(None, announce(1, [notes]), IP)
+    await store.upsert_file_announcement(
+        None, announce(2, [notes, slides], port=9001), IP
+    )
+    published.clear()
+
+    clock.now += 40
+    await store.update_last_heartbeat(None, 1, IP, 9000)
+    clock.now += 30
+    assert store.next_expiry_in(60) == 0
+
+    result = await store.remove_inactive_peers(None, threshold_seconds=60)
+
+    assert result.expired == 1
+    assert sorted(result.removed) == sorted([notes.file_hash, slides.file_hash])
+    assert published == [([], result.removed)]
+    assert await store.count_sessions(None) == 1
+    assert [p.username for p in await store.get_file_peers(None, notes.file_hash)] == [
+        "alice"
+    ]
+    assert await store.get_file_peers(None, slides.file_hash) == []
+    assert store.next_expiry_in(60) == 30
+
+
+async def test_expiry_in_batches(store, clock):
+    for port in range(9000, 9005):
+        await store.upsert_file_announcement(
+            None, announce(1, [file(f"notes_{port}.pdf")], port=port), IP
+        )
+    clock.now += 120
+
+    first = await store.remove_inactive_peers(None, threshold_seconds=60, batch_size=3)
+    second = await store.remove_inactive_peers(None, threshold_seconds=60, batch_size=3)
+
+    assert (first.expired, second.expired) == (3, 2)
+    assert await store.count_sessions(None) == 0
+
+
+async def test_fuzzy_search(store):
+    notes, slides, lab = (
+        file("physics_notes.pdf", 100),
+        file("physics_slides.ppt", 2000),
+        file("chemistry_lab.pdf", 300),
+    )
+    await store.upsert_file_announcement(None, announce(1, [notes, slides, lab]), IP)
+    await store.upsert_file_announcement(None, announce(2, [notes], port=9001), IP)
+
+    results = await store.search_files(None, "physics")
+
+    assert {r.file_hash for r in results} == {notes.file_hash, slides.file_hash}
+    assert [r.score for r in results] == sorted(
+        (r.score for r in results), reverse=True
+    )
+    by_hash = {r.file_hash: r for r in results}
+    assert sorted(p.username for p in by_hash[notes.file_hash].peers) == [
+        "alice",
+        "bob",
+    ]
+
+    assert [
+        r.file_hash for r in await store.search_files(None, "physics", extension="ppt")
+    ] == [slides.file_hash]
+    assert [
+        r.file_hash for r in await store.search_files(None, "physics", max_size=1000)
+    ] == [notes.file_hash]
+    # Too short for a trigram, matched as a prefix
+    assert {r.file_hash for r in await store.search_files(None, "ph")} == {
+        notes.file_hash,
+        slides.file_hash,
+    }
+
+
+async def test_search_pages(store):
+    files = [file(f"lecture_{i:02}.pdf") for i in range(7)]
+    await store.upsert_file_announcement(None, announce(1, files), IP)
+
+    seen = []
+    cursor = None
+    while True:
+        page = await store.search_files(None, "lecture", limit=3, cursor=cursor)
+        seen.extend(r.file_hash for r in page)
+        if len(page) < 3:
+            break
+        cursor = (page[-1].score, page[-1].file_hash)
+
+    assert sorted(seen) == sorted(f.file_hash for f in files)
+    assert len(seen) == len(set(seen))
+
+
+async def test_text_search(store):
+    notes, other = file("PhysicsNotesCh3.pdf"), file("ChemistryNotes.pdf")
+    await store.upsert_file_announcement(None, announce(1, [notes, other]), IP)
+
+    results = await store.search_files(None, "physics notes ch", mode="text")
+
+    assert [r.file_hash for r in results] == [notes.file_hash]
+
+
+async def test_file_peer_counts(store):
+    notes, lab = file("physics_notes.pdf"), file("chemistry_lab.pdf")
+    await store.upsert_file_announcement(None, announce(1, [notes, lab]), IP)
+    await store.upsert_file_announcement(None, announce(2, [notes], port=9001), IP)
+
+    counts = sorted([count async for count in store.file_peer_counts(None)])
+
+    assert counts == sorted(
+        [(notes.file_hash, notes.file_name, 2), (lab.file_hash, lab.file_name, 1)]
+    )
+
+
+async def test_failed_write_through_leaves_memory_untouched(store, monkeypatch):
+    async def fail(*args, **kwargs):
+        raise ConnectionError("database down")
+
+    notes = file("physics_notes.pdf")
+    await store.upsert_file_announcement(None, announce(1, [notes]), IP)
+    published.clear()
+    store.write_through = True
+    monkeypatch.setattr("app.memory_store.crud.upsert_file_announcement", fail)
+    monkeypatch.setattr("app.memory_store.crud.remove_inactive_peers", fail)
+
+    with pytest.raises(ConnectionError):
+        await store.upsert_file_announcement(
+            None, announce(1, [file("chemistry_lab.pdf")], version=2), IP
+        )
+    with pytest.raises(ConnectionError):
+        await store.remove_inactive_peers(None, threshold_seconds=-60)
+
+    assert published == []
+    assert [r.file_hash for r in await store.search_files(None, "physics")] == [
+        notes.file_hash
+    ]
+    assert await store.search_files(None, "chemistry") == []
+
+
+async def test_remove_user_sessions(store):
+    notes, lab = file("physics_notes.pdf"), file("chemistry_lab.pdf")
+    await store.upsert_file_announcement(None, announce(1, [notes, lab]), IP)
+    await store.upsert_file_announcement(None, announce(1, [notes], port=9001), IP)
+    await store.upsert_file_announcement(None, announce(2, [notes], port=9002), IP)
+    published.clear()
+
+    result = await store.remove_user_sessions(None, 1)
+
+    assert result.expired == 2
+    assert sorted(result.removed) == sorted(
+        [notes.file_hash, lab.file_hash, notes.file_hash]
+    )
+    assert published == [([], result.removed)]
+    assert await store.count_sessions(None) == 1
+    assert await store.search_files(None, "chemistry") == []
+
+
+async def test_files_shared_by(store):
+    notes, lab, slides = (
+        file("physics_notes.pdf"),
+        file("chemistry_lab.pdf"),
+        file("physics_slides.pdf"),
+    )
+    await store.upsert_file_announcement(None, announce(1, [notes]), IP)
+    await store.upsert_file_announcement(None, announce(1, [lab], port=9001), IP)
+    await store.upsert_file_announcement(None, announce(2, [slides], port=9002), IP)
+
+    hashes = [notes.file_hash, lab.file_hash, slides.file_hash, "0" * 64]
+
+    assert await store.files_shared_by(None, 1, hashes) == {
+        notes.file_hash,
+        lab.file_hash,
+    }
+    assert await store.files_shared_by(None, 3, hashes) == set()
+
+
+async def test_count_file_peers(store):
+    notes, lab = file("physics_notes.pdf"), file("chemistry_lab.pdf")
+    await store.upsert_file_announcement(None, announce(1, [notes, lab]), IP)
+    await store.upsert_file_announcement(None, announce(2, [notes], port=9002), IP)
+
+    hashes = [notes.file_hash, lab.file_hash, "0" * 64]
+
+    assert await store.count_file_peers(None, hashes) == {
+        notes.file_hash: 2,
+        lab.file_hash: 1,
+    }
@@ -0,0 +1,64 @@
+"""Search results are only tagged when no change could have made them stale"""
+
+import hashlib
+
+from app import schemas
+from app.search_cache import FileVersions, SearchCache
+
+
+def file(name: str) -> schemas.FileBase:
+    return schemas.FileBase(
+        file_hash=hashlib.sha256(name.encode()).hexdigest(),
+        file_name=name,
+        file_size=1024,
+    )
+
+
+def result(file: schemas.FileBase) -> schemas.SearchResult:
+    return schemas.SearchResult(**file.model_dump(), peers=[])
+
+
+def test_results_are_tagged_when_nothing_changed():
+    versions = FileVersions(100, 100)
+    key = SearchCache.make_key("physics", 50)
+    versions.apply([file("chemistry_lab.pdf")], [])
+
+    since = versions.seq
+    assert versions.etag(key, [result(file("physics_notes.pdf"))], since)
+
+
+def test_file_shared_during_search_voids_tag():
+    versions = FileVersions(100, 100)
+    fuzzy = SearchCache.make_key("physics", 50)
+    text = SearchCache.make_key("physics notes", 50, mode="text")
+
+    since = versions.seq
+    versions.apply([file("physics_notes_ch2.pdf")], [])
+
+    assert versions.etag(fuzzy, [], since) is None
+    assert versions.etag(text, [], since) is None
+    # Files the query cannot match change nothing
+    versions.apply([file("chemistry_lab.pdf")], [])
+    assert versions.etag(fuzzy, [], versions.seq - 1)
+
+
+def test_listed_file_changed_during_search_voids_tag():
+    versions = FileVersions(100, 100)
+    notes = file("physics_notes.pdf")
+    key = SearchCache.make_key("physics", 50)
+
+    since = versions.seq
+    versions.apply([], [notes.file_hash])
+
+    assert versions.etag(key, [result(notes)], since) is None
+
+
+def test_forgotten_names_void_older_searches():
+    versions = FileVersions(100, 2)
+    key = SearchCache.make_key("physics", 50)
+
+    since = versions.seq
+    versions.apply([file(f"chemistry_{i}.pdf") for i in range(3)], [])
+
+    assert versions.etag(key, [], since) is None
+    assert versions.etag(key, [], versions.seq)
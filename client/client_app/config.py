@@ -19,8 +19,13 @@ DEFAULT_CONFIG = {
     "download_folder": os.path.abspath("./downloads"),
     "ngrok_authtoken": "",
     "jwt_token": "",
+    "refresh_token": "",
     "username": "",
     "user_id": -1,
+    # Disk space lent to seeding files the network lacks, 0 = don't seed
+    "seed_quota_mb": 0,
+    # Files downloaded for seeding, by hash, counted against the quota
+    "seeded_files": {},
 }
 
 
@@ -76,6 +81,10 @@ class ConfigManager:
     def DOWNLOAD_FOLDER(self) -> str:
         return self.get("download_folder")
 
+    @property
+    def SEED_QUOTA_MB(self) -> int:
+        return int(self.get("seed_quota_mb") or 0)
+
     @property
     def NGROK_TOKEN(self) -> str:
         return self.get("ngrok_authtoken")
@@ -84,6 +93,10 @@ class ConfigManager:
     def JWT_TOKEN(self) -> str:
         return self.get("jwt_token")
 
+    @property
+    def REFRESH_TOKEN(self) -> str:
+        return self.get("refresh_token")
+
     @property
     def USERNAME(self) -> str:
         return self.get("username")
@@ -1,12 +1,26 @@
+import gzip
 import logging
 import os
+import shutil
 import sys
-from typing import List, Optional
+import tempfile
+import threading
+from typing import Callable, List, Optional
+from urllib.parse import urlparse
 
 import requests
+from pydantic import BaseModel
 from watchdog.observers import Observer
 
-from . import config, p2p_server, schemas, tunnel_manager, utils, watcher
+from . import (
+    config,
+    downloader,
+    p2p_server,
+    schemas,
+    tunnel_manager,
+    utils,
+    watcher,
+)
 
 # Configure logging
 handlers = [
@@ -21,6 +35,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Libraries larger than this are announced as an NDJSON stream
+STREAM_ANNOUNCE_THRESHOLD = 5000
+# Piece manifests published per request, the tracker accepts up to 256
+MANIFEST_BATCH_SIZE = 256
+# Replication hints asked for per seeding round
+SEED_HINT_LIMIT = 10
+
 
 class PeerShareError(Exception):
     """Base exception for client errors"""
@@ -43,17 +64,43 @@ class PeerShareClient:
         port: int = config.settings.PORT,
         folder: str = config.settings.SHARED_FOLDER,
         jwt_token: str = config.settings.JWT_TOKEN,
+        refresh_token: str = config.settings.REFRESH_TOKEN,
     ):
         self.user_id: Optional[int] = user_id
         self.username = username
         self.password = password
         self.access_token: Optional[str] = jwt_token
+        self.refresh_token: Optional[str] = refresh_token
 
         self.port = port
         self.folder = folder
 
         self.local_ip = utils.get_local_ip()
-        self.server = p2p_server.P2PServer(port, folder)
+        self.public_url: Optional[str] = None
+        # Piece manifests of the shared files by hash, also served to peers
+        self._manifests: dict[str, schemas.FileManifest] = {}
+        # Hashes whose manifest the tracker already has (or refused)
+        self._published_manifests: set[str] = set()
+        # Cleared when the tracker turns out not to take manifests
+        self._publish_manifests = True
+        # Cleared when the tracker turns out not to give replication hints
+        self._seeding_supported = True
+        self.server = p2p_server.P2PServer(port, folder, self._manifests)
+        self.observer = None
+
+        # Files last announced to the tracker, keyed by hash, and the library
+        # version the tracker acknowledged for them (0 = never announced)
+        self._library: dict[str, schemas.FileBase] = {}
+        self._library_version = 0
+        self._announce_lock = threading.RLock()
+
+        # UDP heartbeat channel handed out by the tracker, None = use HTTP
+        self._heartbeat: Optional[schemas.HeartbeatChannel] = None
+        self._heartbeat_seq = 0
+        # Load last sent to the tracker, UDP heartbeats don't carry it
+        self._reported_load: Optional[int] = None
+        # Cleared when the tracker turns out not to accept gzipped bodies
+        self._compress_requests = True
 
     def _get_headers(self) -> dict[str, str]:
         """Get request headers with authentication"""
@@ -83,9 +130,11 @@ class PeerShareClient:
             token_resp = schemas.TokenResponse(**resp.json())
 
             self.access_token = token_resp.access_token
+            self.refresh_token = token_resp.refresh_token
             self.user_id = token_resp.user.user_id
 
             config.settings.set("jwt_token", self.access_token)
+            config.settings.set("refresh_token", self.refresh_token or "")
             config.settings.set("user_id", self.user_id)
             config.settings.set("username", self.username)
 
@@ -96,6 +145,65 @@ class PeerShareClient:
             logger.error(f"Login connection failed: {e}")
             raise PeerShareError(f"Login connection failed: {e}")
 
+    def refresh_access_token(self) -> bool:
+        """Get a new access token with the refresh token, False if that failed"""
+        if not self.refresh_token:
+            return False
+        try:
+            url = f"{config.settings.TRACKER_SERVER_URL}/token/refresh"
+            resp = requests.post(url, json={"refresh_token": self.refresh_token})
+            resp.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Token refresh failed: {e}")
+            return False
+
+        tokens = schemas.TokenPair(**resp.json())
+        self.access_token = tokens.access_token
+        self.refresh_token = tokens.refresh_token
+        config.settings.set("jwt_token", self.access_token)
+        config.settings.set("refresh_token", self.refresh_token)
+        logger.info("Refreshed the access token")
+        return True
+
+    def _with_refresh(self, send: Callable[[], requests.Response]) -> requests.Response:
+        """Send a request, once more with a refreshed token if it was rejected"""
+        resp = send()
+        if resp.status_code == 401 and self.refresh_access_token():
+            resp = send()
+        return resp
+
+    def _post_json(self, path: str, payload: BaseModel) -> requests.Response:
+        """POST a model as JSON, gzipped when large and the tracker accepts it"""
+        url = f"{config.settings.TRACKER_SERVER_URL}{path}"
+        body = payload.model_dump_json().encode()
+        compressed = None
+        if self._compress_requests and len(body) >= utils.COMPRESS_MIN_BYTES:
+            compressed = gzip.compress(body, 5)
+
+        def send(data: bytes, encoding: Optional[str]) -> requests.Response:
+            headers = {"Content-Type": "application/json"}
+            if encoding:
+                headers["Content-Encoding"] = encoding
+            # Headers are rebuilt per attempt, a refresh changes the token
+            return self._with_refresh(
+                lambda: requests.post(
+                    url, data=data, headers={**self._get_headers(), **headers}
+                )
+            )
+
+        if compressed is None:
+            return send(body, None)
+
+        resp = send(compressed, "gzip")
+        if resp.status_code in (415, 422):
+            # Older trackers can't read gzipped bodies, retry it plain
+            plain = send(body, None)
+            if plain.ok:
+                logger.info("Tracker does not accept compressed requests")
+                self._compress_requests = False
+            return plain
+        return resp
+
     def initialize(self):
         """Setup folder and start server"""
         if not os.path.exists(self.folder):
@@ -108,54 +216,318 @@ class PeerShareClient:
 
     def announce_files(self) -> int:
         """Scans files and announce them to tracker server"""
-        logger.info(f"Scanning folder {self.folder}...")
-        files_data = utils.scan_folder(self.folder)  # Returns list of dicts
+        with self._announce_lock:
+            logger.info(f"Scanning folder {self.folder}...")
+            files_data = utils.scan_folder(self.folder)  # Returns list of dicts
 
-        if not files_data:
-            logger.warning("No files to share")
-            return 0
+            # An empty folder still has to be announced if files were shared
+            # before, so the tracker drops them
+            if not files_data and not self._library:
+                logger.warning("No files to share")
+                return 0
 
-        valid_files = [schemas.FileBase(**f) for f in files_data]
+            valid_files = [schemas.FileBase(**f) for f in files_data]
 
-        ngrok_url = tunnel_manager.start_ngrok_tunnel(
-            self.port, auth_token=config.settings.NGROK_TOKEN
-        )
+            ngrok_url = tunnel_manager.start_ngrok_tunnel(
+                self.port, auth_token=config.settings.NGROK_TOKEN
+            )
 
-        if self.user_id is None:
-            raise RuntimeError(
-                "User_id not available, user must be authenticated first"
+            if self.user_id is None:
+                raise RuntimeError(
+                    "User_id not available, user must be authenticated first"
+                )
+
+            version = self._library_version + 1
+            announce_payload = schemas.FileAnnounce(
+                user_id=self.user_id,
+                port=self.port,
+                ip_address=self.local_ip,
+                public_url=ngrok_url,
+                files=valid_files,
+                version=version,
             )
 
-        announce_payload = schemas.FileAnnounce(
-            user_id=self.user_id,
-            port=self.port,
-            ip_address=self.local_ip,
-            public_url=ngrok_url,
-            files=valid_files,
-        )
+            try:
+                if len(valid_files) > STREAM_ANNOUNCE_THRESHOLD:
+                    resp = self._with_refresh(
+                        lambda: self._post_announce_stream(announce_payload)
+                    )
+                else:
+                    resp = self._post_json("/announce", announce_payload)
+                resp.raise_for_status()
+
+                self.public_url = ngrok_url
+                self._library = {f.file_hash: f for f in valid_files}
+                self._library_version = version
+                self._set_heartbeat_channel(resp.json())
+
+                count = len(valid_files)
+                logger.info(f"Announced {count} files to tracker server")
+
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Failed to announce: {e}")
+                raise PeerShareError(f"Announcement failed: {e}")
+
+            self._set_manifests(files_data)
+            self.publish_manifests()
+            return count
 
-        try:
-            url = f"{config.settings.TRACKER_SERVER_URL}/announce"
-            resp = requests.post(
-                url,
-                json=announce_payload.model_dump(mode="json"),
-                headers=self._get_headers(),
+    def _post_announce_stream(self, payload: schemas.FileAnnounce) -> requests.Response:
+        """Sends a full announce as NDJSON: the header line, then one file per line"""
+
+        def lines():
+            yield payload.model_dump_json(exclude={"files"}).encode() + b"\n"
+            for file in payload.files:
+                yield file.model_dump_json().encode() + b"\n"
+
+        url = f"{config.settings.TRACKER_SERVER_URL}/announce/stream"
+        headers = {**self._get_headers(), "Content-Type": "application/x-ndjson"}
+        return requests.post(url, data=lines(), headers=headers)
+
+    def sync_files(self) -> int:
+        """Announces only the files that changed since the last announce"""
+        with self._announce_lock:
+            if self._library_version == 0:
+                return self.announce_files()
+
+            files_data = utils.scan_folder(self.folder)
+            current = {
+                f.file_hash: f for f in (schemas.FileBase(**d) for d in files_data)
+            }
+            self._set_manifests(files_data)
+
+            added = [f for h, f in current.items() if h not in self._library]
+            removed = [h for h in self._library if h not in current]
+
+            if not added and not removed:
+                logger.info("No library changes to announce")
+                self.publish_manifests()
+                return len(current)
+
+            if self.user_id is None:
+                raise RuntimeError(
+                    "User_id not available, user must be authenticated first"
+                )
+
+            version = self._library_version + 1
+            delta_payload = schemas.FileAnnounceDelta(
+                user_id=self.user_id,
+                port=self.port,
+                ip_address=self.local_ip,
+                public_url=self.public_url,
+                base_version=self._library_version,
+                version=version,
+                added=added,
+                removed=removed,
             )
-            resp.raise_for_status()
 
-            count = len(valid_files)
-            logger.info(f"Announced {count} files to tracker server")
-            return count
+            try:
+                resp = self._post_json("/announce/delta", delta_payload)
+
+                if resp.status_code == 409:
+                    # Tracker lost track of our library (restart, expiry...),
+                    # resync with a full announce
+                    logger.info("Tracker library out of sync, re-announcing all files")
+                    return self.announce_files()
+
+                resp.raise_for_status()
+
+                self._library = current
+                self._library_version = version
+                self._set_heartbeat_channel(resp.json())
+
+                logger.info(
+                    f"Announced delta to tracker server: "
+                    f"{len(added)} added, {len(removed)} removed"
+                )
+
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Failed to announce delta: {e}")
+                raise PeerShareError(f"Delta announcement failed: {e}")
+
+            self.publish_manifests()
+            return len(current)
+
+    def _set_manifests(self, files_data: List[dict]):
+        """Keep the manifests of the scanned files, in place for the P2P server"""
+        manifests = {
+            # Hashed here, nothing to validate
+            f["file_hash"]: schemas.FileManifest.model_construct(**f)
+            for f in files_data
+        }
+        for file_hash in list(self._manifests):
+            if file_hash not in manifests:
+                del self._manifests[file_hash]
+        self._manifests.update(manifests)
+
+    def publish_manifests(self) -> int:
+        """Sends the tracker the piece manifests it doesn't have yet"""
+        pending = [
+            m
+            for h, m in self._manifests.items()
+            if h in self._library and h not in self._published_manifests
+        ]
+        if not pending or not self._publish_manifests:
+            return 0
 
+        stored = 0
+        for i in range(0, len(pending), MANIFEST_BATCH_SIZE):
+            batch = pending[i : i + MANIFEST_BATCH_SIZE]
+            try:
+                resp = self._post_json(
+                    "/manifests", schemas.ManifestBatch(manifests=batch)
+                )
+                if resp.status_code == 404:
+                    logger.info("Tracker does not take piece manifests")
+                    self._publish_manifests = False
+                    return stored
+                resp.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                # Not needed to share files, tried again on the next sync
+                logger.warning(f"Failed to publish piece manifests: {e}")
+                return stored
+
+            result = resp.json()
+            stored += result["stored"]
+            if result["rejected"]:
+                logger.warning(
+                    f"Tracker rejected {len(result['rejected'])} piece manifests"
+                )
+            self._published_manifests.update(m.file_hash for m in batch)
+
+        if stored:
+            logger.info(f"Published {stored} piece manifests")
+        return stored
+
+    def _seeded_bytes(self) -> int:
+        """Disk used by seeded files, forgetting the ones deleted since"""
+        seeded = dict(config.settings.get("seeded_files"))
+        used = 0
+        for file_hash, name in list(seeded.items()):
+            path = os.path.join(self.folder, name)
+            if os.path.isfile(path):
+                used += os.path.getsize(path)
+            else:
+                del seeded[file_hash]
+        if seeded != config.settings.get("seeded_files"):
+            config.settings.set("seeded_files", seeded)
+        return used
+
+    def seed_files(self) -> int:
+        """Downloads and shares files the tracker reports as under-replicated.
+
+        Only runs with a seed quota, files are added while they fit in what
+        is left of it. Returns the number of files added.
+        """
+        quota = config.settings.SEED_QUOTA_MB * 1024 * 1024
+        if quota <= 0 or not self._seeding_supported or self._library_version == 0:
+            return 0
+        remaining = quota - self._seeded_bytes()
+        if remaining <= 0:
+            return 0
+
+        try:
+            resp = self._with_refresh(
+                lambda: requests.get(
+                    f"{config.settings.TRACKER_SERVER_URL}/replication/hints",
+                    params={"limit": SEED_HINT_LIMIT, "max_size": remaining},
+                    headers=self._get_headers(),
+                )
+            )
+            if resp.status_code == 404:
+                logger.info("Tracker does not give replication hints")
+                self._seeding_supported = False
+                return 0
+            resp.raise_for_status()
         except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to announce: {e}")
-            raise PeerShareError(f"Announcement failed: {e}")
+            logger.warning(f"Failed to get replication hints: {e}")
+            return 0
+        hints = [schemas.ReplicationHint(**hint) for hint in resp.json()]
+
+        added = 0
+        # Downloaded aside, a partial file must not be scanned and announced
+        with tempfile.TemporaryDirectory(prefix="peershare-seed-") as staging:
+            for hint in hints:
+                target = os.path.join(self.folder, os.path.basename(hint.file_name))
+                if (
+                    hint.file_hash in self._library
+                    or hint.file_size > remaining
+                    or os.path.exists(target)
+                ):
+                    continue
+                logger.info(
+                    f"Seeding {hint.file_name} ({hint.peers} peers, "
+                    f"demand {hint.demand})"
+                )
+                result = schemas.SearchResult(
+                    file_hash=hint.file_hash,
+                    file_name=os.path.basename(hint.file_name),
+                    file_size=hint.file_size,
+                    peers=[],
+                )
+                if not downloader.download_file_strategy(result, staging):
+                    continue
+                shutil.move(os.path.join(staging, result.file_name), target)
+                seeded = dict(config.settings.get("seeded_files"))
+                seeded[hint.file_hash] = result.file_name
+                config.settings.set("seeded_files", seeded)
+                remaining -= hint.file_size
+                added += 1
+
+        if added:
+            logger.info(f"Seeding {added} more files")
+            self.sync_files()
+        return added
+
+    def _set_heartbeat_channel(self, response: dict):
+        """Remember the UDP heartbeat channel the tracker returned, if any"""
+        channel = response.get("heartbeat")
+        self._heartbeat = schemas.HeartbeatChannel(**channel) if channel else None
+        self._heartbeat_seq = 0
+
+    def _send_udp_heartbeat(self) -> bool:
+        """Send the heartbeat over UDP, False if it has to go over HTTP"""
+        channel = self._heartbeat
+        host = urlparse(config.settings.TRACKER_SERVER_URL).hostname
+        if channel is None or not host:
+            return False
+
+        self._heartbeat_seq += 1
+        if utils.send_udp_heartbeat(
+            host,
+            channel.port,
+            channel.channel_id,
+            bytes.fromhex(channel.key),
+            self._heartbeat_seq,
+        ):
+            return True
+
+        # Lost, blocked or unknown to the tracker: HTTP ping hands out a new one
+        logger.info("UDP heartbeat not acknowledged, falling back to HTTP")
+        self._heartbeat = None
+        return False
 
     def send_heartbeat(self):
         """Ping the server to keep the session alive"""
+        load = self.server.active_uploads
+        if load == self._reported_load and self._send_udp_heartbeat():
+            return
+
         try:
             url = f"{config.settings.TRACKER_SERVER_URL}/ping"
-            requests.post(url, headers=self._get_headers())
+            payload = schemas.PeerPing(
+                ip_address=self.local_ip, port=self.port, load=load
+            )
+            resp = self._with_refresh(
+                lambda: requests.post(
+                    url,
+                    json=payload.model_dump(mode="json"),
+                    headers=self._get_headers(),
+                )
+            )
+            resp.raise_for_status()
+            self._reported_load = load
+            self._set_heartbeat_channel(resp.json())
         except Exception as e:
             logger.warning(f"Ping failed (Tracker might be down): {e}")
 
@@ -179,7 +551,7 @@ class PeerShareClient:
             self.login()
 
         # Start Server
-        self.server = p2p_server.P2PServer(self.port, self.folder)
+        self.server = p2p_server.P2PServer(self.port, self.folder, self._manifests)
         self.server.start()
         self.start_watcher()
 
@@ -187,7 +559,7 @@ class PeerShareClient:
 
     def start_watcher(self):
         self.observer = Observer()
-        event_handler = watcher.FileEventHandler(self.announce_files)
+        event_handler = watcher.FileEventHandler(self.sync_files)
         self.observer.schedule(event_handler, self.folder, recursive=True)
         self.observer.start()
         logger.info(f"Watching folder {self.folder} for changes...")
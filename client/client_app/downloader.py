@@ -1,31 +1,122 @@
 import logging
 import os
-from typing import List
+import threading
+from collections import OrderedDict
+from typing import List, Optional
 
 import requests
 from tqdm import tqdm
 
-from . import config, schemas
+from . import config, schemas, utils
 
 logger = logging.getLogger(__name__)
 
+# Searches whose results are kept to revalidate with the tracker's ETag
+SEARCH_CACHE_SIZE = 64
+
+# (tracker URL, query) -> (ETag, results), most recently used last
+_search_cache: OrderedDict[tuple[str, str], tuple[str, list]] = OrderedDict()
+_search_cache_lock = threading.Lock()
+
 
 def search_tracker(query: str) -> List[schemas.SearchResult]:
-    """Queries the tracker and returns a list of files."""
+    """Queries the tracker and returns a list of files.
+
+    Repeated queries send the ETag of the last results, the tracker answers
+    304 without a body when they are still current.
+    """
+    key = (config.settings.TRACKER_SERVER_URL, query)
+    with _search_cache_lock:
+        cached = _search_cache.get(key)
+    headers = {"Accept": utils.TRACKER_ACCEPT}
+    if cached is not None:
+        headers["If-None-Match"] = cached[0]
+
     try:
         response = requests.get(
-            f"{config.settings.TRACKER_SERVER_URL}/search", params={"q": query}
+            f"{config.settings.TRACKER_SERVER_URL}/search",
+            params={"q": query},
+            headers=headers,
         )
+        if response.status_code == 304 and cached is not None:
+            with _search_cache_lock:
+                if key in _search_cache:
+                    _search_cache.move_to_end(key)
+            return cached[1]
         response.raise_for_status()
-        raw_results = response.json()
-
-        return [schemas.SearchResult(**item) for item in raw_results]
+        raw_results = utils.decode_tracker_response(response)
+        results = [schemas.SearchResult(**item) for item in raw_results]
+
+        etag = response.headers.get("ETag")
+        with _search_cache_lock:
+            if etag:
+                _search_cache[key] = (etag, results)
+                _search_cache.move_to_end(key)
+                while len(_search_cache) > SEARCH_CACHE_SIZE:
+                    _search_cache.popitem(last=False)
+            else:
+                _search_cache.pop(key, None)
+        return results
 
     except Exception as e:
         logger.error(f"Tracker search failed: {e}")
         return []
 
 
+def get_file_peers(file_hash: str, limit: int = 10) -> List[schemas.PeerInfo]:
+    """Asks the tracker for the peers of a file, closest ones first."""
+    try:
+        response = requests.get(
+            f"{config.settings.TRACKER_SERVER_URL}/files/{file_hash}/peers",
+            params={"limit": limit},
+            headers={"Accept": utils.TRACKER_ACCEPT},
+        )
+        if response.status_code == 404:
+            return []
+        response.raise_for_status()
+
+        return [
+            schemas.PeerInfo(**item) for item in utils.decode_tracker_response(response)
+        ]
+
+    except Exception as e:
+        logger.error(f"Tracker peer lookup failed: {e}")
+        return []
+
+
+def get_file_manifest(
+    file_hash: str, peer_urls: List[str]
+) -> Optional[schemas.FileManifest]:
+    """Piece manifest of a file from the tracker, else from one of its peers"""
+    try:
+        response = requests.get(
+            f"{config.settings.TRACKER_SERVER_URL}/files/{file_hash}/manifest",
+            headers={"Accept": utils.TRACKER_ACCEPT},
+        )
+        if response.status_code != 404:
+            response.raise_for_status()
+            manifest = schemas.FileManifest(**utils.decode_tracker_response(response))
+            if manifest.file_hash == file_hash:
+                return manifest
+    except Exception as e:
+        logger.warning(f"Tracker manifest lookup failed: {e}")
+
+    for base_url in peer_urls:
+        try:
+            response = requests.get(
+                f"{base_url}/manifest", params={"hash": file_hash}, timeout=3
+            )
+            response.raise_for_status()
+            manifest = schemas.FileManifest(**response.json())
+            if manifest.file_hash == file_hash:
+                return manifest
+        except Exception as e:
+            logger.debug(f"No manifest from {base_url}: {e}")
+
+    logger.info("No piece manifest found, the file is checked once complete")
+    return None
+
+
 def download_from_peer(
     download_url: str,
     timeout: int,
@@ -34,7 +125,15 @@ def download_from_peer(
     destination: str,
     method_name: str,
     save_path: str,
+    file_hash: str,
+    manifest: Optional[schemas.FileManifest] = None,
 ) -> bool:
+    verifier = utils.PieceVerifier(
+        file_hash,
+        manifest.piece_size if manifest else None,
+        manifest.pieces if manifest else b"",
+    )
+    writing = False
     try:
         # Stream the download so we don't crash RAM on big files
         with requests.get(
@@ -50,10 +149,14 @@ def download_from_peer(
             with tqdm(
                 total=filesize, unit="B", unit_scale=True, desc=filename
             ) as progress_bar:
+                writing = True
                 with open(save_path, "wb") as f:
                     for chunk in r.iter_content(chunk_size=config.CHUNK_SIZE):
+                        # A bad piece drops this peer before the rest arrives
+                        verifier.update(chunk)
                         f.write(chunk)
                         progress_bar.update(len(chunk))
+            verifier.finish()
 
         logger.info(f"Download Complete! Saved to: {save_path}")
         return True
@@ -61,6 +164,9 @@ def download_from_peer(
     except Exception as e:
         logger.warning(f"Error during {method_name}: {e}")
 
+    # Don't leave a corrupt or partial file behind
+    if writing and os.path.exists(save_path):
+        os.remove(save_path)
     return False
 
 
@@ -76,13 +182,17 @@ def download_file_strategy(file_data: schemas.SearchResult, destination: str) ->
 
     save_path = os.path.join(destination, filename)
 
-    # Try every peer until one works
-    for peer in file_data.peers:
+    # Fresh peer list ranked by the tracker, the search result may be stale
+    peers = get_file_peers(file_data.file_hash) or file_data.peers
+
+    candidates_by_peer = []
+    for peer in peers:
         candidates = []
 
-        # 1. Local LAN
-        local_url = f"http://{peer.ip_address}:{peer.port}"
-        candidates.append((local_url, "Local LAN"))
+        # 1. Local LAN, pointless if the tracker knows the peer is elsewhere
+        if peer.same_network is not False:
+            local_url = f"http://{peer.ip_address}:{peer.port}"
+            candidates.append((local_url, "Local LAN"))
 
         # 2. Public Tunnel (Ngrok)
         if peer.public_url:
@@ -90,7 +200,15 @@ def download_file_strategy(file_data: schemas.SearchResult, destination: str) ->
             if not public_url.startswith("http"):
                 public_url = f"http://{public_url}"
             candidates.append((public_url, "Public Tunnel"))
+        candidates_by_peer.append(candidates)
+
+    manifest = get_file_manifest(
+        file_data.file_hash,
+        [base_url for candidates in candidates_by_peer for base_url, _ in candidates],
+    )
 
+    # Try every peer until one works
+    for candidates in candidates_by_peer:
         for base_url, method_name in candidates:
             timeout = 3 if method_name == "Local LAN" else 15
             download_url = f"{base_url}/download"
@@ -103,6 +221,8 @@ def download_file_strategy(file_data: schemas.SearchResult, destination: str) ->
                 destination,
                 method_name,
                 save_path,
+                file_data.file_hash,
+                manifest,
             ):
                 return True
 
@@ -4,10 +4,10 @@ import os
 import socketserver
 import threading
 from pathlib import Path
-from typing import cast
+from typing import Optional, cast
 from urllib.parse import parse_qs, urlparse
 
-from . import config
+from . import config, schemas
 
 # Configure logging
 logging.basicConfig(
@@ -18,15 +18,25 @@ logger = logging.getLogger(__name__)
 
 
 class PeerTCPServer(socketserver.TCPServer):
-    def __init__(self, server_address, handler, shared_folder: str):
+    def __init__(
+        self,
+        server_address,
+        handler,
+        shared_folder: str,
+        manifests: dict[str, schemas.FileManifest],
+    ):
         super().__init__(server_address, handler)
         self.shared_folder: str = shared_folder
+        self.manifests = manifests  # piece manifests of the shared files by hash
+        self.active_uploads = 0  # reported to the tracker as our load
 
 
 class PeerRequestHandler(http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
         # Parse the URL /download?name=test.txt
         parsed_url = urlparse(self.path)
+        if parsed_url.path == "/manifest":
+            return self._send_manifest(parse_qs(parsed_url.query))
         if parsed_url.path != "/download":
             return self.send_error(404, "Endpoint not found")
 
@@ -63,8 +73,23 @@ class PeerRequestHandler(http.server.SimpleHTTPRequestHandler):
         else:
             self.send_error(404, "File not found")
 
-    def _send_file(self, file_path: Path, filename: str):
+    def _send_manifest(self, params: dict):
+        """Piece manifest of a shared file: /manifest?hash=<sha256>"""
+        file_hash = params.get("hash", [""])[0].lower()
+        manifest = cast(PeerTCPServer, self.server).manifests.get(file_hash)
+        if manifest is None:
+            return self.send_error(404, "No manifest for this file")
+
+        body = manifest.model_dump_json().encode()
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
+    def _send_file(self, file_path: Path, filename: str):
+        server = cast(PeerTCPServer, self.server)
+        server.active_uploads += 1
         try:
             self.send_response(200)
             self.send_header("Content-type", "application/octet-stream")
@@ -81,12 +106,20 @@ class PeerRequestHandler(http.server.SimpleHTTPRequestHandler):
             logging.info(f"Served: {filename} -> {self.client_address[0]}")
         except Exception as e:
             logging.error(f"Upload error: {e}")
+        finally:
+            server.active_uploads -= 1
 
 
 class P2PServer:
-    def __init__(self, port: int, shared_folder: str):
+    def __init__(
+        self,
+        port: int,
+        shared_folder: str,
+        manifests: Optional[dict[str, schemas.FileManifest]] = None,
+    ):
         self.port = port
         self.shared_folder = shared_folder
+        self.manifests = manifests if manifests is not None else {}
         self.server_thread = None
         self.httpd = None
 
@@ -96,7 +129,7 @@ class P2PServer:
 
         # create the server with the custom class with custom shared folder
         self.httpd = PeerTCPServer(
-            ("", self.port), PeerRequestHandler, self.shared_folder
+            ("", self.port), PeerRequestHandler, self.shared_folder, self.manifests
         )
 
         self.server_thread = threading.Thread(
@@ -105,6 +138,11 @@ class P2PServer:
         self.server_thread.start()
         logging.info(f"File Server running on port {self.port}")
 
+    @property
+    def active_uploads(self) -> int:
+        """Files being uploaded to other peers right now"""
+        return self.httpd.active_uploads if self.httpd else 0
+
     def stop(self):
         """Stops the server and releases the port"""
         if self.httpd:
@@ -2,7 +2,9 @@ import re
 from datetime import datetime
 from typing import List, Optional
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import Base64Bytes, BaseModel, Field, field_validator, model_validator
+
+from . import utils
 
 # --- Shared Models (Mirroring Backend) ---
 
@@ -38,10 +40,17 @@ class UserResponse(BaseModel):
 
 class TokenResponse(BaseModel):
     access_token: str
+    refresh_token: Optional[str] = None
     token_type: str
     user: UserResponse
 
 
+class TokenPair(BaseModel):
+    access_token: str
+    refresh_token: str
+    token_type: str
+
+
 class FileBase(BaseModel):
     file_hash: str = Field(..., min_length=64, max_length=64)
     file_name: str = Field(..., min_length=1, max_length=255)
@@ -60,6 +69,56 @@ class FileAnnounce(BaseModel):
     ip_address: Optional[str] = None
     public_url: Optional[str] = None
     files: List[FileBase]
+    version: int = 0
+
+
+class FileAnnounceDelta(BaseModel):
+    user_id: int
+    port: int
+    ip_address: Optional[str] = None
+    public_url: Optional[str] = None
+    base_version: int
+    version: int
+    added: List[FileBase] = []
+    removed: List[str] = []
+
+
+class FileManifest(BaseModel):
+    file_hash: str = Field(..., min_length=64, max_length=64)
+    file_size: int = Field(..., ge=0)
+    piece_size: int = Field(..., gt=0)
+    merkle_root: str
+    pieces: Base64Bytes  # SHA-256 digests of the pieces, concatenated
+
+    @model_validator(mode="after")
+    def validate_pieces(self):
+        # Manifests may come from any peer, only keep consistent ones
+        count = -(-self.file_size // self.piece_size)
+        if len(self.pieces) != count * utils.DIGEST_SIZE:
+            raise ValueError("Piece hashes don't match the file size")
+        digests = [
+            self.pieces[i : i + utils.DIGEST_SIZE]
+            for i in range(0, len(self.pieces), utils.DIGEST_SIZE)
+        ]
+        if utils.merkle_root(digests).hex() != self.merkle_root.lower():
+            raise ValueError("Merkle root does not match the piece hashes")
+        return self
+
+
+class ManifestBatch(BaseModel):
+    manifests: List[FileManifest]
+
+
+class PeerPing(BaseModel):
+    ip_address: Optional[str] = None
+    port: int
+    load: Optional[int] = None
+
+
+class HeartbeatChannel(BaseModel):
+    port: int
+    channel_id: int
+    key: str
 
 
 # --- Search Models ---
@@ -72,6 +131,16 @@ class PeerInfo(BaseModel):
     public_url: Optional[str] = None
     username: str
     last_heartbeat: datetime
+    load: Optional[int] = None
+    same_network: Optional[bool] = None
+
+
+class ReplicationHint(BaseModel):
+    file_hash: str
+    file_name: str
+    file_size: int
+    peers: int
+    demand: float
 
 
 class SearchResult(BaseModel):
@@ -1,13 +1,40 @@
 import hashlib
+import hmac
 import logging
 import os
 import socket
-from typing import Any, Dict, List
+import struct
+from typing import Any, Dict, List, Optional
 
 from .config import CHUNK_SIZE
 
+try:
+    import msgpack
+except ImportError:  # optional, the tracker answers in JSON then
+    msgpack = None
+
 logger = logging.getLogger(__name__)
 
+# Accept header of tracker queries, msgpack is smaller and faster to parse
+TRACKER_ACCEPT = (
+    "application/msgpack, application/json;q=0.9" if msgpack else "application/json"
+)
+# Request bodies at least this large are gzipped
+COMPRESS_MIN_BYTES = 1024
+
+# Piece manifests, must match the tracker's app/manifests.py. Pieces are
+# PIECE_SIZE, doubled until a file has at most MAX_PIECES of them
+PIECE_SIZE = CHUNK_SIZE
+MAX_PIECES = 8192
+DIGEST_SIZE = 32
+
+# UDP heartbeat wire format, must match the tracker's app/heartbeat.py
+HEARTBEAT_VERSION = 1
+HEARTBEAT_HEADER = struct.Struct("!BQI")  # version, channel id, sequence number
+HEARTBEAT_TAG_SIZE = 16
+HEARTBEAT_ACK = struct.Struct("!BQIB")  # version, channel id, sequence, status
+HEARTBEAT_ACK_OK = 0
+
 
 def get_file_hash(filepath: str) -> str:
     """Calculate SHA-256 hash of a file"""
@@ -18,6 +45,118 @@ def get_file_hash(filepath: str) -> str:
     return hasher.hexdigest()
 
 
+def piece_size_for(file_size: int) -> int:
+    """Piece size of a file, a power of two multiple of CHUNK_SIZE"""
+    piece_size = PIECE_SIZE
+    while -(-file_size // piece_size) > MAX_PIECES:
+        piece_size *= 2
+    return piece_size
+
+
+def merkle_root(digests: List[bytes]) -> bytes:
+    """Root of the SHA-256 tree over piece digests, an unpaired node moves up"""
+    if not digests:
+        return hashlib.sha256().digest()
+    level = digests
+    while len(level) > 1:
+        parents = [
+            hashlib.sha256(level[i] + level[i + 1]).digest()
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+def hash_file(filepath: str) -> Dict[str, Any]:
+    """SHA-256 of a file and its piece manifest, in a single read"""
+    file_size = os.path.getsize(filepath)
+    piece_size = piece_size_for(file_size)
+    hasher = hashlib.sha256()
+    digests = []
+    with open(filepath, "rb") as file:
+        # Pieces are whole chunks, every chunk belongs to a single piece
+        piece = hashlib.sha256()
+        filled = 0
+        while chunk := file.read(CHUNK_SIZE):
+            hasher.update(chunk)
+            piece.update(chunk)
+            filled += len(chunk)
+            if filled == piece_size:
+                digests.append(piece.digest())
+                piece = hashlib.sha256()
+                filled = 0
+        if filled:
+            digests.append(piece.digest())
+    return {
+        "file_hash": hasher.hexdigest(),
+        "file_size": file_size,
+        "piece_size": piece_size,
+        "merkle_root": merkle_root(digests).hex(),
+        "pieces": b"".join(digests),
+    }
+
+
+class PieceVerifier:
+    """Checks a download against its hash, piece by piece with a manifest.
+
+    A bad piece raises ValueError as soon as it is complete, so a peer
+    sending corrupt data is dropped without waiting for the whole file.
+    """
+
+    def __init__(
+        self, file_hash: str, piece_size: Optional[int] = None, pieces: bytes = b""
+    ):
+        self.file_hash = file_hash
+        self.piece_size = piece_size  # None checks the whole file only
+        self.pieces = pieces
+        self._file = hashlib.sha256()
+        self._piece = hashlib.sha256()
+        self._filled = 0
+        self.verified = 0  # pieces checked so far
+
+    def _check_piece(self) -> None:
+        offset = self.verified * DIGEST_SIZE
+        expected = self.pieces[offset : offset + DIGEST_SIZE]
+        if self._piece.digest() != expected:
+            raise ValueError(f"Piece {self.verified} does not match its hash")
+        self.verified += 1
+        self._piece = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data: bytes) -> None:
+        self._file.update(data)
+        if self.piece_size is None:
+            return
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.piece_size - self._filled)
+            self._piece.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.piece_size:
+                self._check_piece()
+
+    def finish(self) -> None:
+        """Check the last piece and the whole file, raises ValueError"""
+        if self.piece_size is not None:
+            if self._filled:
+                self._check_piece()
+            if self.verified * DIGEST_SIZE != len(self.pieces):
+                raise ValueError("File is shorter than its manifest")
+        if self._file.hexdigest() != self.file_hash:
+            raise ValueError("File does not match its hash")
+
+
+def decode_tracker_response(response) -> Any:
+    """Body of a tracker response, whether it came as msgpack or JSON"""
+    content_type = response.headers.get("Content-Type", "")
+    if msgpack is not None and content_type.startswith("application/msgpack"):
+        return msgpack.unpackb(response.content)
+    return response.json()
+
+
 def get_local_ip() -> str:
     """Finds the internal WiFi IP address."""
 
@@ -45,14 +184,33 @@ def scan_folder(folder_path: str) -> List[Dict[str, Any]]:
             filepath = os.path.join(root, filename)
 
             try:
-                files_payload.append(
-                    {
-                        "file_hash": get_file_hash(filepath),
-                        "file_name": filename,
-                        "file_size": os.path.getsize(filepath),
-                    }
-                )
+                # The piece manifest comes along, FileBase ignores it
+                files_payload.append({"file_name": filename, **hash_file(filepath)})
             except Exception as e:
                 logger.warning(f"Skipping file {filename}: {e}")
 
     return files_payload
+
+
+def send_udp_heartbeat(
+    host: str, port: int, channel_id: int, key: bytes, seq: int, timeout: float = 1.0
+) -> bool:
+    """Sends one signed heartbeat datagram, True if the tracker acknowledged it"""
+    header = HEARTBEAT_HEADER.pack(HEARTBEAT_VERSION, channel_id, seq)
+    tag = hmac.new(key, header, hashlib.sha256).digest()[:HEARTBEAT_TAG_SIZE]
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(timeout)
+    try:
+        s.sendto(header + tag, (host, port))
+        while True:
+            data = s.recv(64)
+            if len(data) != HEARTBEAT_ACK.size:
+                continue
+            _, ack_channel, ack_seq, status = HEARTBEAT_ACK.unpack(data)
+            if ack_channel == channel_id and ack_seq == seq:
+                return status == HEARTBEAT_ACK_OK
+    except OSError:
+        return False
+    finally:
+        s.close()
@@ -23,6 +23,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# How often under-replicated files are looked for when a seed quota is set
+SEED_INTERVAL_SECONDS = 600
+
 
 client_service: Optional[PeerShareClient] = None
 client_thread: Optional[threading.Thread] = None
@@ -58,8 +61,18 @@ def start_background_service():
 
         logger.info("Background P2P service stopped.")
 
+    def run_seeding_background():
+        # Separate from heartbeats, a download may take a while
+        while not stop_event.wait(SEED_INTERVAL_SECONDS):
+            try:
+                if client_service:
+                    client_service.seed_files()
+            except Exception as e:
+                logger.warning(f"Seeding failed: {e}")
+
     client_thread = threading.Thread(target=run_client_background, daemon=True)
     client_thread.start()
+    threading.Thread(target=run_seeding_background, daemon=True).start()
 
 
 @asynccontextmanager
@@ -75,7 +88,10 @@ async def lifespan(app: FastAPI):
             logger.info(f"Restoring session of user: {saved_username}")
 
             client_service = PeerShareClient(
-                user_id=saved_user_id, username=saved_username, jwt_token=saved_token
+                user_id=saved_user_id,
+                username=saved_username,
+                jwt_token=saved_token,
+                refresh_token=config.settings.REFRESH_TOKEN,
             )
 
             client_service.initialize()
@@ -190,6 +206,7 @@ def logout():
 
     client_service = None
     config.settings.set("jwt_token", "")
+    config.settings.set("refresh_token", "")
     config.settings.set("username", "")
     config.settings.set("user_id", -1)
     return {"status": "success", "message": "Logged out and server stopped"}
@@ -222,6 +239,7 @@ def get_config():
         "port": config.settings.PORT,
         "shared_folder": config.settings.SHARED_FOLDER,
         "download_folder": config.settings.DOWNLOAD_FOLDER,
+        "seed_quota_mb": config.settings.SEED_QUOTA_MB,
         "ngrok_configured": config.settings.NGROK_TOKEN,
         "jwt_token": config.settings.JWT_TOKEN,
         "username": config.settings.USERNAME,
@@ -233,7 +251,8 @@ def get_config():
 def update_config(payload: dict):
     """
     Update configuration settings.
-    Payload can contain: port, shared_folder, download_folder, ngrok_authtoken
+    Payload can contain: port, shared_folder, download_folder, ngrok_authtoken,
+    seed_quota_mb
     """
     allowed_keys = [
         "tracker_server_url",
@@ -241,6 +260,7 @@ def update_config(payload: dict):
         "shared_folder",
         "download_folder",
         "ngrok_authtoken",
+        "seed_quota_mb",
     ]
     try:
         updated_keys = []
@@ -15,6 +15,7 @@ export default function Settings() {
     port: "",
     shared_folder: "",
     download_folder: "",
+    seed_quota_mb: "",
     ngrok_authtoken: "",
   });
 
@@ -25,6 +26,7 @@ export default function Settings() {
         port: String(data.port),
         shared_folder: data.shared_folder,
         download_folder: data.download_folder,
+        seed_quota_mb: String(data.seed_quota_mb),
         ngrok_authtoken: data.ngrok_configured,
       });
     })
@@ -80,6 +82,13 @@ export default function Settings() {
           onChange={(e) => setConfig({ ...config, download_folder: e.target.value })}
         />
       </div>
+      <div className="space-y-2">
+        <Label>Disk space to seed under-replicated files (MB, 0 to disable)</Label>
+        <Input
+          value={config.seed_quota_mb}
+          onChange={(e) => setConfig({ ...config, seed_quota_mb: e.target.value })}
+        />
+      </div>
       <div className="space-y-2">
         <Label>NGROK AUTHTOKEN</Label>
         <Input